@@ -0,0 +1,58 @@
+"""Concurrent /chat throughput as the number of clients grows.
+
+Every client registers, then sends a few chat turns at the same time as the others.
+The fake model takes --latency seconds per call, either awaited ("async", how the
+handlers call ChatGroq.ainvoke) or slept on the event loop ("blocking", how the old
+synchronous llm.invoke behaved). Async throughput should grow with the number of
+clients; blocking throughput stays flat at about one model call at a time.
+
+Usage:
+    python benchmarks/chat_concurrency.py [--latency 0.2] [--clients 1,2,4,8,16] [--turns 3]
+"""
+import argparse
+import asyncio
+import time
+
+import harness
+
+MESSAGES = [
+    "I have had a throbbing headache for three days and I feel tired",
+    "No, I have not seen a doctor about it yet",
+    "I took paracetamol twice but it only helped a little",
+    "I also feel a bit dizzy when I stand up",
+]
+
+
+async def client_session(client, index, turns, latencies):
+    _, headers = await harness.register(client, index)
+    for turn in range(turns):
+        started = time.perf_counter()
+        await harness.chat(client, headers, MESSAGES[turn % len(MESSAGES)])
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(client, mode, clients, turns, latency):
+    harness.install_fake_llm(latency, blocking=mode == "blocking")
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(client_session(client, index, turns, latencies) for index in range(clients)))
+    elapsed = time.perf_counter() - started
+    return len(latencies) / elapsed, latencies
+
+
+async def main(args):
+    print(f"fake model latency {args.latency * 1000:.0f} ms, {args.turns} turns per client")
+    async with harness.running_app() as client:
+        for mode in ("blocking", "async"):
+            for clients in args.clients:
+                with harness.quiet():
+                    throughput, latencies = await run(client, mode, clients, args.turns, args.latency)
+                print(f"{mode:8}  clients {clients:3}  {throughput:6.2f} turns/s  turn {harness.describe(latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake model call")
+    parser.add_argument("--clients", type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4, 8, 16])
+    parser.add_argument("--turns", type=int, default=3, help="chat turns per client")
+    asyncio.run(main(parser.parse_args()))
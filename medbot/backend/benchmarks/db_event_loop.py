@@ -0,0 +1,75 @@
+"""Event loop lag and throughput under load, awaited vs blocking database calls.
+
+Every collection call the repository makes is given --db-latency seconds of round
+trip, either awaited ("async", how the Motor repository behaves) or slept on the
+event loop thread ("blocking", how the handlers' direct pymongo calls behaved).
+Concurrent clients register, chat and read their history while a monitor measures
+how late the loop runs a 5 ms timer. With async calls the lag stays near zero; with
+blocking calls it grows with the load, and every other request waits behind it.
+
+Usage:
+    python benchmarks/db_event_loop.py [--clients 16] [--turns 3] [--db-latency 0.005] [--llm-latency 0.05]
+"""
+import argparse
+import asyncio
+import time
+
+import harness
+
+repository = harness.repository
+MESSAGES = [
+    "I have had a throbbing headache for three days and I feel tired",
+    "No, I have not seen a doctor about it yet",
+    "I took paracetamol twice but it only helped a little",
+]
+
+
+async def client_session(client, index, turns, latencies):
+    started = time.perf_counter()
+    user_id, headers = await harness.register(client, index)
+    latencies.append(time.perf_counter() - started)
+    for turn in range(turns):
+        started = time.perf_counter()
+        await harness.chat(client, headers, MESSAGES[turn % len(MESSAGES)])
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    response = await client.get(f"/chat_history/{user_id}", headers=headers)
+    response.raise_for_status()
+    latencies.append(time.perf_counter() - started)
+
+
+async def run(client, mode, args):
+    harness.install_fake_llm(args.llm_latency)
+    latency = harness.DatabaseLatency(args.db_latency, blocking=mode == "blocking")
+    for collection in (repository.users_collection, repository.chat_messages_collection, repository.summaries_collection):
+        latency.wrap(collection)
+    latencies = []
+    try:
+        with harness.LoopLagMonitor() as monitor:
+            started = time.perf_counter()
+            await asyncio.gather(*(client_session(client, index, args.turns, latencies) for index in range(args.clients)))
+            elapsed = time.perf_counter() - started
+    finally:
+        latency.restore()
+    return len(latencies) / elapsed, latencies, monitor.lags, latency.calls
+
+
+async def main(args):
+    print(f"{args.clients} clients, {args.turns} turns each, database {args.db_latency * 1000:.0f} ms "
+          f"and model {args.llm_latency * 1000:.0f} ms per call")
+    async with harness.running_app() as client:
+        for mode in ("blocking", "async"):
+            with harness.quiet():
+                throughput, latencies, lags, calls = await run(client, mode, args)
+            print(f"{mode:8}  {throughput:6.1f} requests/s  {calls:4} db calls")
+            print(f"          request   {harness.describe(latencies)}")
+            print(f"          loop lag  {harness.describe(lags)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=3, help="chat turns per client")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per database call")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per fake model call")
+    asyncio.run(main(parser.parse_args()))
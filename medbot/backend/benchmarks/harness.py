@@ -0,0 +1,258 @@
+"""Shared setup for the benchmark scripts in this directory.
+
+Runs the real FastAPI app in-process with mongomock-motor standing in for MongoDB
+and a fake chat model (fixed latency, canned replies) standing in for Groq, so the
+numbers measure MedBot's own overhead and concurrency rather than the network.
+
+Needs the backend dependencies plus mongomock-motor and httpx:
+    pip install mongomock-motor httpx
+
+Scripts set any environment variables they depend on *before* importing this module,
+because main.py reads its configuration at import time.
+"""
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager, contextmanager, redirect_stdout
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+# Must be patched before repository.py creates its client
+import motor.motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+
+motor.motor_asyncio.AsyncIOMotorClient = lambda uri=None, **options: AsyncMongoMockClient()
+
+import httpx
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+import main
+import repository
+
+DIAGNOSIS_REPLY = """## LIKELY CONDITION
+Tension-type headache, most likely brought on by stress and poor sleep.
+
+## ACTION STEPS
+• Rest in a quiet, dark room
+• Stay hydrated and take paracetamol if needed
+• Keep a headache diary
+
+## NOTE
+See a doctor if the headache is sudden and severe or lasts more than a week."""
+
+CRITICALITY_REPLY = """## URGENCY LEVEL
+ROUTINE
+
+## TIMEFRAME
+Within a week
+
+## PRECAUTIONS
+• Avoid screens late at night
+• Keep regular meals
+
+## DISCLAIMER
+This is not a substitute for professional medical care."""
+
+
+# Reply a well-behaved model would give to one of MedBot's prompts
+def canned_reply(prompt):
+    # Most specific first: later prompts quote earlier JSON replies in the patient history
+    if '"is_urgent"' in prompt:
+        return '{"is_urgent": false, "urgency_level": "ROUTINE", "timeframe": "Within a week", "precautions": ["Rest", "Stay hydrated"]}'
+    if '"move_to_diagnosis"' in prompt:
+        return '{"next_question": "Does anything make it better or worse?", "move_to_diagnosis": false, "reasoning": "Need duration"}'
+    if '"urgency_level"' in prompt:
+        return ('{"urgency_level": "ROUTINE", "category": "general", "reasoning": "Mild, no red flags", '
+                '"key_symptoms": ["headache"], "recommended_questions": [], '
+                '"next_question": "How long have you had the headache?", "first_aid_steps": []}')
+    if '"is_valid"' in prompt:
+        return '{"is_valid": true, "reason": "The answer addresses the question"}'
+    if "'YES' or 'NO'" in prompt:
+        return "NO"
+    if "LIKELY CONDITION" in prompt:
+        return DIAGNOSIS_REPLY
+    if "URGENCY LEVEL" in prompt:
+        return CRITICALITY_REPLY
+    if "case summary" in prompt:
+        return "Chief Complaint: headache for three days. Assessment: likely tension-type headache."
+    return "How long have you had these symptoms?"
+
+
+# Stands in for ChatGroq: waits `latency` seconds, then answers with reply(prompt).
+# blocking=True sleeps on the event loop thread, like the old synchronous llm.invoke did.
+class FakeChatModel:
+    def __init__(self, latency=0.2, reply=canned_reply, blocking=False):
+        self.latency = latency
+        self.reply = reply
+        self.blocking = blocking
+        self.calls = 0
+
+    def bind(self, **kwargs):
+        return self
+
+    async def wait(self):
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+    async def ainvoke(self, prompt):
+        self.calls += 1
+        await self.wait()
+        return AIMessage(content=self.reply(prompt))
+
+    async def astream(self, prompt):
+        self.calls += 1
+        await self.wait()
+        for word in self.reply(prompt).split(" "):
+            yield AIMessageChunk(content=word + " ")
+
+
+# Put a FakeChatModel behind every model tier and empty the LLM cache; returns {tier: model}
+def install_fake_llm(latency=0.2, reply=canned_reply, blocking=False):
+    models = {}
+    for tier, cached_llm in main.llm.tiers.items():
+        models[tier] = FakeChatModel(latency, reply, blocking)
+        cached_llm.model = cached_llm.json_model = models[tier]
+    main.llm_local_cache.entries.clear()
+    return models
+
+
+# Count database round trips by wrapping the Motor collection methods the app uses
+class MongoCallCounter:
+    METHODS = ("find_one", "find", "insert_one", "update_one", "replace_one", "bulk_write",
+               "delete_one", "count_documents", "find_one_and_update")
+
+    def __init__(self):
+        self.calls = 0
+        self.patched = []
+
+    def wrap(self, collection):
+        for name in self.METHODS:
+            original = getattr(collection, name, None)
+            if original is None:
+                continue
+
+            def counted(*args, __original=original, **kwargs):
+                self.calls += 1
+                return __original(*args, **kwargs)
+
+            setattr(collection, name, counted)
+            self.patched.append((collection, name, original))
+        return self
+
+    def restore(self):
+        for collection, name, original in reversed(self.patched):
+            setattr(collection, name, original)
+        self.patched = []
+
+
+# Give every awaited collection call a round-trip time, either awaited (like Motor) or
+# slept on the event loop thread (like the blocking pymongo calls the handlers used to make)
+class DatabaseLatency(MongoCallCounter):
+    METHODS = ("find_one", "insert_one", "insert_many", "update_one", "replace_one", "bulk_write",
+               "delete_one", "delete_many", "count_documents", "find_one_and_update")
+
+    def __init__(self, latency, blocking=False):
+        super().__init__()
+        self.latency = latency
+        self.blocking = blocking
+
+    def wrap(self, collection):
+        for name in self.METHODS:
+            original = getattr(collection, name, None)
+            if original is None:
+                continue
+
+            async def delayed(*args, __original=original, **kwargs):
+                self.calls += 1
+                if self.blocking:
+                    time.sleep(self.latency)
+                else:
+                    await asyncio.sleep(self.latency)
+                return await __original(*args, **kwargs)
+
+            setattr(collection, name, delayed)
+            self.patched.append((collection, name, original))
+        return self
+
+
+# Samples how late the event loop runs a timer: near zero unless something blocks the loop
+class LoopLagMonitor:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - expected, 0.0))
+
+    def __enter__(self):
+        self.task = asyncio.get_running_loop().create_task(self.sample())
+        return self
+
+    def __exit__(self, *exc_info):
+        self.task.cancel()
+
+
+# Silence the app's per-request print() logging while a workload runs
+@contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else 0.0
+
+
+def describe(values):
+    return (f"p50 {percentile(values, 0.50) * 1000:7.1f} ms  p95 {percentile(values, 0.95) * 1000:7.1f} ms  "
+            f"p99 {percentile(values, 0.99) * 1000:7.1f} ms  max {max(values, default=0) * 1000:7.1f} ms")
+
+
+# The app with its startup/shutdown hooks run, and an httpx client talking to it in-process
+@asynccontextmanager
+async def running_app():
+    for handler in main.app.router.on_startup:
+        await handler()
+    transport = httpx.ASGITransport(app=main.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://medbot", timeout=120) as client:
+            yield client
+    finally:
+        for handler in main.app.router.on_shutdown:
+            await handler()
+
+
+# Register a patient and return (user_id, bearer headers)
+async def register(client, index=0):
+    response = await client.post("/register", json={
+        "name": f"Patient {index}",
+        "email": f"patient{index}-{time.monotonic_ns()}@example.com",
+        "password": "correct horse battery staple",
+        "gender": "female",
+        "age": 30 + index % 40,
+    })
+    response.raise_for_status()
+    body = response.json()
+    return body["user_id"], {"Authorization": f"Bearer {body['access_token']}"}
+
+
+async def chat(client, headers, text):
+    response = await client.post("/chat", json={"user_id": "", "response": text}, headers=headers)
+    response.raise_for_status()
+    return response.json()
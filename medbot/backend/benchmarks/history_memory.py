@@ -0,0 +1,89 @@
+"""Memory held per chat turn by UserData.history: EventLog vs the legacy list of dicts.
+
+Runs real /chat conversations, then rebuilds each session's history twice from the
+same value and validation-details objects: as an EventLog, and as the legacy
+list of single-key dicts (what EventLog.to_legacy returns). tracemalloc measures what
+each container allocates on top of the values, which both shapes share. It also
+reports the persisted size per turn: EventLog rows vs legacy dicts, as JSON and as the
+BSON MongoDB stores.
+
+Usage:
+    python benchmarks/history_memory.py [--sessions 20] [--turns 6]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import tracemalloc
+
+import bson
+
+import harness
+
+main = harness.main
+MESSAGES = [
+    "I have had a throbbing headache for three days and I feel tired",
+    "No, I have not seen a doctor about it yet",
+    "I took paracetamol twice but it only helped a little",
+    "I also feel a bit dizzy when I stand up",
+    "It gets worse in the evening after work",
+    "No other symptoms",
+]
+
+
+# Bytes allocated by build() and still held once it returns. Garbage left over from
+# the conversations is collected first so a collection mid-build cannot offset the count.
+def allocated_bytes(build):
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+    return held, result
+
+
+async def run_sessions(client, sessions, turns):
+    user_ids = []
+    for index in range(sessions):
+        user_id, headers = await harness.register(client, index)
+        for turn in range(turns):
+            await harness.chat(client, headers, MESSAGES[turn % len(MESSAGES)])
+        user_ids.append(user_id)
+    return user_ids
+
+
+async def main_async(args):
+    harness.install_fake_llm(latency=0)
+    async with harness.running_app() as client:
+        with harness.quiet():
+            user_ids = await run_sessions(client, args.sessions, args.turns)
+        logs = [(await main.session_store.get(user_id)).history for user_id in user_ids]
+
+    rows = [log.to_rows() for log in logs]
+    entries = sum(len(log) for log in logs)
+    event_log_bytes, _ = allocated_bytes(lambda: [main.EventLog.from_rows(user_rows) for user_rows in rows])
+    legacy_bytes, legacy = allocated_bytes(lambda: [log.to_legacy() for log in logs])
+    rows_json = sum(len(json.dumps(user_rows, default=str)) for user_rows in rows)
+    legacy_json = sum(len(json.dumps(entries, default=str)) for entries in legacy)
+    rows_bson = sum(len(bson.encode({"history": user_rows})) for user_rows in rows)
+    legacy_bson = sum(len(bson.encode({"history": entries})) for entries in legacy)
+
+    turns = args.sessions * args.turns
+    print(f"{args.sessions} sessions x {args.turns} turns, {entries} history entries ({entries / turns:.1f} per turn)")
+    print(f"in memory   legacy dicts {legacy_bytes / turns:7.0f} B/turn   EventLog {event_log_bytes / turns:7.0f} B/turn "
+          f"({(1 - event_log_bytes / legacy_bytes) * 100:.0f}% less)")
+    print(f"JSON        legacy dicts {legacy_json / turns:7.0f} B/turn   EventLog rows {rows_json / turns:7.0f} B/turn "
+          "(rows also carry a timestamp)")
+    print(f"BSON        legacy dicts {legacy_bson / turns:7.0f} B/turn   EventLog rows {rows_bson / turns:7.0f} B/turn")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=6, help="chat turns per session")
+    asyncio.run(main_async(parser.parse_args()))
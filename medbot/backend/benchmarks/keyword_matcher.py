@@ -0,0 +1,94 @@
+"""KeywordMatcher.scan vs the per-call-site keyword loops it replaced.
+
+The "loops" side is every `in` check an answer used to go through, copied from the
+handlers before the matcher: accident and chronic-condition lists, the condition
+disclosure and brief-answer checks, the multi-part triggers and follow-ups, and the
+asthma/inhaler/breathing red flags, each over a freshly lowercased copy. The
+"matcher" side is one triage_matcher.scan over the same answer. Answers come from
+the labeled validation fixtures, also repeated to --long-words words, plus a
+diagnosis-length paragraph (about 1000 characters), to show how both scale with
+text length.
+
+The two are not equivalent: the loops match raw substrings (so "hit" fires on
+"white"), the matcher applies each category's word/prefix rule.
+
+Usage:
+    python benchmarks/keyword_matcher.py [--repeat 2000] [--long-words 60]
+"""
+import argparse
+import json
+import os
+import timeit
+
+import harness
+
+main = harness.main
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "validation_answers.json")
+
+ACCIDENT_KEYWORDS = ["accident", "crash", "fell", "injured", "hit", "collision", "car accident"]
+CHRONIC_CONDITIONS = ["diabetes", "diabetic", "hypertension", "asthma", "copd", "arthritis", "thyroid"]
+DISCLOSURE_CONDITIONS = ["diabetes", "diabetic", "hypertension", "asthma", "chronic"]
+BRIEF_SYMPTOM_WORDS = ["diabetes", "pain", "ache", "hurt", "sick"]
+BREATHING_PHRASES = ["can't breathe", "cant breathe", "difficulty breathing"]
+DIAGNOSIS_TEXT = (
+    "Based on your symptoms of a persistent throbbing headache for three days, fatigue, mild dizziness when standing, "
+    "and partial relief from paracetamol, the most likely explanation is a tension-type headache or migraine. "
+    "Dehydration and poor sleep can make both worse. Other possibilities include sinusitis if you also have facial pressure, "
+    "or raised blood pressure. Recommendations: drink plenty of water, rest in a quiet dark room, keep taking paracetamol "
+    "as directed on the pack but no more than four doses in 24 hours, and avoid screens for long periods. Track when the "
+    "headaches start and what you were doing. Seek medical care promptly if the headache becomes sudden and severe, if you "
+    "develop a stiff neck, fever, confusion, weakness or numbness on one side, trouble speaking, or changes in vision. "
+    "If you have difficulty breathing, chest pain or fainting, call emergency services right away. A doctor may check your "
+    "blood pressure, ask about your sleep and stress, and may suggest a short course of other medication."
+)
+MULTI_PART_PATTERNS = [
+    {"triggers": ["yes", "i have", "i did", "consulted"], "required_follow_up": ["diagnosis", "said", "told me", "found"]},
+    {"triggers": ["yes", "i have", "i did", "taking", "took"],
+     "required_follow_up": ["medication", "drug", "pill", "medicine", "paracetamol", "ibuprofen"]},
+]
+
+
+# The keyword checks the handlers used to run on an answer, one lowercased copy each
+def legacy_loops(response):
+    results = {}
+    results["accident"] = any(keyword in response.lower() for keyword in ACCIDENT_KEYWORDS)
+    results["chronic_condition"] = [c for c in CHRONIC_CONDITIONS if c in response.lower()]
+    results["condition_disclosure"] = any(condition in response.lower() for condition in DISCLOSURE_CONDITIONS)
+    results["brief_symptom"] = any(word in response.lower() for word in BRIEF_SYMPTOM_WORDS)
+    for index, pattern in enumerate(MULTI_PART_PATTERNS):
+        lower_response = response.lower()
+        has_trigger = any(trigger in lower_response for trigger in pattern["triggers"])
+        has_follow_up = any(follow_up in lower_response for follow_up in pattern["required_follow_up"])
+        results[f"multi_part_{index}"] = (has_trigger, has_follow_up)
+    lowered = response.lower()
+    results["asthma"] = "asthma" in lowered
+    results["lost_inhaler"] = "lost" in lowered and "inhaler" in lowered
+    results["breathing"] = any(phrase in lowered for phrase in BREATHING_PHRASES)
+    return results
+
+
+def per_call_microseconds(function, texts, repeat):
+    seconds = timeit.timeit(lambda: [function(text) for text in texts], number=repeat)
+    return seconds / (repeat * len(texts)) * 1e6
+
+
+def main_cli(args):
+    with open(FIXTURES, encoding="utf-8") as f:
+        answers = [case["response"] for case in json.load(f)]
+    long_answers = [" ".join(((answer + " ") * args.long_words).split()[:args.long_words]) for answer in answers]
+
+    for label, texts in (("fixture answers", answers), (f"{args.long_words}-word answers", long_answers),
+                         ("diagnosis text", [DIAGNOSIS_TEXT])):
+        average = sum(len(text) for text in texts) / len(texts)
+        repeat = args.repeat * len(answers) // len(texts)
+        loops = per_call_microseconds(legacy_loops, texts, repeat)
+        matcher = per_call_microseconds(main.triage_matcher.scan, texts, repeat)
+        print(f"{label:18} ({average:5.0f} chars)  loops {loops:6.1f} us  matcher {matcher:6.1f} us  "
+              f"({loops / matcher:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000, help="passes over the answers")
+    parser.add_argument("--long-words", type=int, default=60, help="length of the repeated long answers")
+    main_cli(parser.parse_args())
@@ -0,0 +1,100 @@
+"""/chat latency during a login storm, bcrypt on the worker pool vs on the event loop.
+
+Chat clients send their turns while --storm concurrent clients each log in
+--logins times. "pool" is the current setup, with hashing on the bounded
+password_executor; "inline" verifies passwords on the event loop, as login_user
+used to. A quiet run with no logins gives the baseline. The fake model answers with --llm-latency, so
+chat latency above that is time spent waiting for the loop.
+
+bcrypt's cost factor comes from BCRYPT_ROUNDS (10 here unless set; production uses 12).
+
+Usage:
+    python benchmarks/login_storm.py [--clients 8] [--turns 4] [--storm 8] [--logins 3] [--llm-latency 0.05]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("BCRYPT_ROUNDS", "10")
+
+import harness
+
+main = harness.main
+MESSAGES = [
+    "I have had a throbbing headache for three days and I feel tired",
+    "No, I have not seen a doctor about it yet",
+    "I took paracetamol twice but it only helped a little",
+    "I also feel a bit dizzy when I stand up",
+]
+PASSWORD = "correct horse battery staple"
+pooled_verify_password = main.verify_password
+
+
+# How verify_password ran before the worker pool: bcrypt on the event loop thread
+async def inline_verify_password(plain_password, hashed_password):
+    return main.pwd_context.verify(plain_password, hashed_password)
+
+
+async def chat_client(client, headers, turns, latencies):
+    for turn in range(turns):
+        started = time.perf_counter()
+        await harness.chat(client, headers, MESSAGES[turn % len(MESSAGES)])
+        latencies.append(time.perf_counter() - started)
+
+
+async def login_client(client, email, count, logins):
+    for _ in range(count):
+        started = time.perf_counter()
+        response = await client.post("/login", json={"email": email, "password": PASSWORD})
+        response.raise_for_status()
+        logins.append(time.perf_counter() - started)
+
+
+async def run(client, chat_headers, storm_emails, mode, args):
+    main.verify_password = inline_verify_password if mode == "inline" else pooled_verify_password
+    latencies, logins = [], []
+    count = 0 if mode == "quiet" else args.logins
+    try:
+        await asyncio.gather(
+            *(chat_client(client, headers, args.turns, latencies) for headers in chat_headers),
+            *(login_client(client, email, count, logins) for email in storm_emails)
+        )
+    finally:
+        main.verify_password = pooled_verify_password
+    return latencies, logins
+
+
+async def register_storm_account(client, index):
+    email = f"storm{index}-{time.monotonic_ns()}@example.com"
+    response = await client.post("/register", json={
+        "name": f"Storm {index}", "email": email, "password": PASSWORD, "gender": "male", "age": 40,
+    })
+    response.raise_for_status()
+    return email
+
+
+async def main_async(args):
+    harness.install_fake_llm(args.llm_latency)
+    print(f"bcrypt rounds {main.BCRYPT_ROUNDS}, pool of {main.PASSWORD_HASH_CONCURRENCY} workers, "
+          f"{args.clients} chat clients x {args.turns} turns, {args.storm} clients logging in")
+    async with harness.running_app() as client:
+        with harness.quiet():
+            storm_emails = [await register_storm_account(client, index) for index in range(args.storm)]
+        for mode in ("quiet", "inline", "pool"):
+            with harness.quiet():
+                chat_headers = [(await harness.register(client, index))[1] for index in range(args.clients)]
+                latencies, logins = await run(client, chat_headers, storm_emails, mode, args)
+            print(f"{mode:6}  chat   {harness.describe(latencies)}")
+            if logins:
+                print(f"        login  {harness.describe(logins)}  ({len(logins)} logins)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8, help="concurrent chat clients")
+    parser.add_argument("--turns", type=int, default=4, help="chat turns per client")
+    parser.add_argument("--storm", type=int, default=8, help="concurrent clients logging in")
+    parser.add_argument("--logins", type=int, default=3, help="logins per storm client")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per fake model call")
+    asyncio.run(main_async(parser.parse_args()))
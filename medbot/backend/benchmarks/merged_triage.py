@@ -0,0 +1,79 @@
+"""Latency and model calls of the first-turn and criticality assessments, merged vs two calls.
+
+Runs assess_initial_urgency (on an answer with no accident or chronic-condition
+keywords, so it goes to the model) and assess_criticality with MERGED_TRIAGE off
+and on. The fake model takes --latency seconds per call; each round uses a fresh
+patient and wording so nothing is served from the LLM cache. "routine" cases get
+PROMPT/ROUTINE replies and "urgent" cases URGENT ones.
+
+Usage:
+    python benchmarks/merged_triage.py [--rounds 10] [--latency 0.2]
+"""
+import argparse
+import asyncio
+import time
+
+import harness
+
+main = harness.main
+URGENT_TRIAGE_REPLY = ('{"urgency_level": "URGENT", "category": "respiratory", "reasoning": "Severe breathing difficulty", '
+                       '"key_symptoms": ["shortness of breath"], "recommended_questions": [], "next_question": "", '
+                       '"first_aid_steps": ["Call emergency services", "Sit upright", "Loosen tight clothing", '
+                       '"Use a rescue inhaler if prescribed"]}')
+
+
+def urgent_reply(prompt):
+    if '"is_urgent"' in prompt:
+        return ('{"is_urgent": true, "urgency_level": "URGENT", "timeframe": "Immediately", '
+                '"precautions": ["Call emergency services"]}')
+    if '"move_to_diagnosis"' in prompt:
+        return harness.canned_reply(prompt)
+    if '"urgency_level"' in prompt:
+        return URGENT_TRIAGE_REPLY
+    if "'YES' or 'NO'" in prompt:
+        return "YES"
+    return "1. Call emergency services\n2. Sit upright\n3. Loosen tight clothing\n4. Stay calm"
+
+
+async def timed(models, handler, state):
+    calls = sum(model.calls for model in models.values())
+    started = time.perf_counter()
+    await handler(state)
+    return time.perf_counter() - started, sum(model.calls for model in models.values()) - calls
+
+
+async def run(scenario, merged, rounds, latency):
+    models = harness.install_fake_llm(latency, reply=urgent_reply if scenario == "urgent" else harness.canned_reply)
+    main.MERGED_TRIAGE = merged
+    results = {"initial": ([], []), "criticality": ([], [])}
+    for index in range(rounds):
+        user_id = f"{scenario}-{merged}-{index}"
+        answer = f"I have had a throbbing headache and blurred vision for {index + 2} days"
+        await main.update_user_data(user_id, "symptoms", answer)
+        await main.update_user_data(user_id, "diagnosis", f"Possible migraine, case {index}")
+        for stage, handler, state in (
+            ("initial", main.assess_initial_urgency, {"user_id": user_id, "response": answer}),
+            ("criticality", main.assess_criticality, {"user_id": user_id}),
+        ):
+            elapsed, calls = await timed(models, handler, state)
+            results[stage][0].append(elapsed)
+            results[stage][1].append(calls)
+    return results
+
+
+async def main_async(args):
+    print(f"fake model latency {args.latency * 1000:.0f} ms, {args.rounds} rounds")
+    for scenario in ("routine", "urgent"):
+        for merged in (False, True):
+            with harness.quiet():
+                results = await run(scenario, merged, args.rounds, args.latency)
+            mode = "merged" if merged else "two-call"
+            for stage, (latencies, calls) in results.items():
+                print(f"{scenario:7}  {mode:8}  {stage:11}  {sum(calls) / len(calls):4.1f} calls  {harness.describe(latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake model call")
+    asyncio.run(main_async(parser.parse_args()))
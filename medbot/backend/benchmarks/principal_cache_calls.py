@@ -0,0 +1,78 @@
+"""Database calls per /chat turn with a cold and a warm principal cache.
+
+Every collection call the repository and the session store make is counted while
+patients chat. "cold" empties the principal cache before each turn, which is what
+every turn cost before the cache (one users lookup to authenticate the token); "warm"
+leaves it to fill as it does in production. Buffered transcript writes are flushed
+before counting, so their batched bulk_writes are included. Sessions are kept in the
+Mongo session store (SESSION_STORE=mongo unless set), so its reads and writes count too.
+
+Usage:
+    python benchmarks/principal_cache_calls.py [--clients 10] [--turns 5]
+"""
+import argparse
+import asyncio
+import os
+
+os.environ.setdefault("SESSION_STORE", "mongo")
+
+import harness
+
+main = harness.main
+repository = harness.repository
+MESSAGES = [
+    "I have had a throbbing headache for three days and I feel tired",
+    "No, I have not seen a doctor about it yet",
+    "I took paracetamol twice but it only helped a little",
+    "I also feel a bit dizzy when I stand up",
+    "No other symptoms",
+]
+
+
+# Collection behind the session store, if sessions are kept in MongoDB
+def session_collection():
+    backing_store = getattr(main.session_store, "backing_store", None)
+    return getattr(backing_store, "collection", None)
+
+
+async def run(client, sessions, turns, cold):
+    users = harness.MongoCallCounter().wrap(repository.users_collection)
+    session_calls = harness.MongoCallCounter()
+    if session_collection() is not None:
+        session_calls.wrap(session_collection())
+    others = harness.MongoCallCounter()
+    for collection in (repository.chat_messages_collection, repository.summaries_collection):
+        others.wrap(collection)
+    try:
+        for turn in range(turns):
+            for headers in sessions:
+                if cold:
+                    main.principal_cache.entries.clear()
+                await harness.chat(client, headers, MESSAGES[turn % len(MESSAGES)])
+        await repository.transcript_writer.flush()
+    finally:
+        users.restore()
+        session_calls.restore()
+        others.restore()
+    return users.calls, session_calls.calls, others.calls
+
+
+async def main_async(args):
+    harness.install_fake_llm(latency=0)
+    async with harness.running_app() as client:
+        for mode in ("cold", "warm"):
+            with harness.quiet():
+                sessions = [(await harness.register(client, index))[1] for index in range(args.clients)]
+                await repository.transcript_writer.flush()
+                user_calls, session_calls, other_calls = await run(client, sessions, args.turns, cold=mode == "cold")
+            turns = args.clients * args.turns
+            print(f"{mode:5}  users {user_calls / turns:5.2f}  sessions {session_calls / turns:5.2f}  "
+                  f"transcripts/summaries {other_calls / turns:5.2f}  "
+                  f"total {(user_calls + session_calls + other_calls) / turns:5.2f} db calls per turn ({turns} turns)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per client")
+    asyncio.run(main_async(parser.parse_args()))
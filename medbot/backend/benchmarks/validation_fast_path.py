@@ -0,0 +1,116 @@
+"""LLM-call reduction and agreement of the local answer classifier on a labeled fixture set.
+
+Every answer in fixtures/validation_answers.json is validated twice through
+validate_response: once with the fast path disabled and once with it enabled. The
+fake LLM answers with the fixture's label, so it acts as a perfect oracle and only
+its call count matters. Then fast_validate_response is scored against the labels
+for the answers it handled: validity, and each details field it extracts.
+
+Finally every answer the classifier extracts anything from is scored, whatever its
+confidence: an extraction agrees when all its fields match the label. Reported
+separately for the extractions that clear --min-confidence and those sent on to the
+LLM, this shows whether the confidence tells the two apart.
+
+Usage:
+    python benchmarks/validation_fast_path.py [--fixtures PATH] [--min-confidence 1.0] [--verbose]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+from collections import Counter
+
+import harness
+
+main = harness.main
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "validation_answers.json")
+RESPONSE_PATTERN = re.compile(r'User Response: "(.*?)"\n', re.DOTALL)
+
+
+def oracle(fixtures):
+    labels = {case["response"]: case["label"] for case in fixtures}
+
+    def reply(prompt):
+        match = RESPONSE_PATTERN.search(prompt)
+        label = labels.get(match.group(1)) if match else None
+        return json.dumps({"reason": "labeled", **(label or {"is_valid": True})})
+
+    return reply
+
+
+async def count_llm_calls(fixtures, min_confidence):
+    models = harness.install_fake_llm(latency=0, reply=oracle(fixtures))
+    main.FAST_VALIDATION_MIN_CONFIDENCE = min_confidence
+    for case in fixtures:
+        await main.validate_response(case["question"], case["response"], case["expected_type"])
+    return sum(model.calls for model in models.values())
+
+
+# Extractions that do (True) or don't (False) clear min_confidence -> Counter of whether all their fields agree
+def score_extractions(fixtures, min_confidence, verbose):
+    main.FAST_VALIDATION_MIN_CONFIDENCE = 0.0
+    extractions = {True: Counter(), False: Counter()}
+    for case in fixtures:
+        result = main.fast_validate_response(case["response"], case["expected_type"])
+        if result is None:
+            continue
+        details = result["details"]
+        agrees = all(main.compare_validation_details(details, case["label"]).values())
+        extractions[details["confidence"] >= min_confidence][agrees] += 1
+        if verbose and details["confidence"] < min_confidence:
+            print(f"  confidence {details['confidence']:.2f} ({'agrees' if agrees else 'differs'}) for {case['response']!r}")
+    main.FAST_VALIDATION_MIN_CONFIDENCE = min_confidence
+    return extractions
+
+
+def score_fast_path(fixtures, verbose):
+    handled = 0
+    validity = Counter()
+    fields = Counter()
+    for case in fixtures:
+        result = main.fast_validate_response(case["response"], case["expected_type"])
+        if result is None:
+            continue
+        handled += 1
+        label = case["label"]
+        validity[result["is_valid"] == label["is_valid"]] += 1
+        for field, same in main.compare_validation_details(result["details"], label).items():
+            fields[(field, same)] += 1
+            if verbose and not same:
+                print(f"  {field} differs for {case['response']!r}: {result['details'][field]} vs label {label.get(field)}")
+    return handled, validity, fields
+
+
+async def main_async(args):
+    with open(args.fixtures, encoding="utf-8") as f:
+        fixtures = json.load(f)
+
+    min_confidence = args.min_confidence
+    with harness.quiet():
+        baseline = await count_llm_calls(fixtures, min_confidence=2.0)
+        tiered = await count_llm_calls(fixtures, min_confidence=min_confidence)
+
+    print(f"{len(fixtures)} labeled answers")
+    print(f"LLM validation calls: {baseline} without the fast path, {tiered} with it "
+          f"({(1 - tiered / baseline) * 100 if baseline else 0:.0f}% fewer)")
+
+    handled, validity, fields = score_fast_path(fixtures, args.verbose)
+    print(f"fast path answered {handled}/{len(fixtures)}; is_valid agrees with the label on {validity[True]}/{handled}")
+    for field in main.FAST_VALIDATION_FIELDS:
+        total = fields[(field, True)] + fields[(field, False)]
+        if total:
+            print(f"  {field:24} agrees on {fields[(field, True)]}/{total} ({fields[(field, True)] / total * 100:.0f}%)")
+
+    extractions = score_extractions(fixtures, min_confidence, args.verbose)
+    for accepted, label in ((True, f"at confidence >= {min_confidence}"), (False, "sent to the LLM")):
+        total = sum(extractions[accepted].values())
+        print(f"extractions {label}: {extractions[accepted][True]}/{total} agree with the label")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--min-confidence", type=float, default=harness.main.FAST_VALIDATION_MIN_CONFIDENCE)
+    parser.add_argument("--verbose", action="store_true", help="list every field that disagrees with its label")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,171 @@
+"""/view_summary lookup latency as a user's history grows: legacy scan vs summaries collection.
+
+For each history size, one user gets that many entries, one summary every
+--turns-per-summary entries. The legacy lookup loads the user document with its
+whole chat_history array and compares every entry's id, as view_summary used to.
+The current one is repository.find_summary, a find_one on (user_id, summary_id).
+Both are timed over random summaries; the bytes each lookup reads are reported too.
+
+mongomock-motor has no indexes, so this benchmark needs a real mongod: pass
+--mongodb-uri or set BENCHMARK_MONGODB_URI, otherwise it is skipped. It works in
+a scratch database that is dropped afterwards. For each size the find_summary
+query is also explained; the run fails unless it is answered by an IXSCAN that
+examines the same number of documents at every size.
+
+Usage:
+    python benchmarks/view_summary_latency.py --mongodb-uri mongodb://localhost:27017 [--sizes 100,1000,5000] [--lookups 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bson
+import motor.motor_asyncio
+from pymongo.errors import ServerSelectionTimeoutError
+
+# harness replaces the client with mongomock-motor; keep the real one for the scratch database
+MotorClient = motor.motor_asyncio.AsyncIOMotorClient
+
+import harness
+
+repository = harness.repository
+
+SCRATCH_DATABASE = "medbot_benchmark"
+
+
+def build_history(size, turns_per_summary):
+    started = datetime(2024, 1, 1)
+    history = []
+    for index in range(size):
+        ts = started + timedelta(minutes=index)
+        entry_id = int(ts.timestamp() * 1000)
+        if index % turns_per_summary == turns_per_summary - 1:
+            history.append({"id": entry_id, "type": "summary", "title": "Summary", "timestamp": ts.isoformat(),
+                            "content": "## Medical Case Summary\n\nChief complaint: headache. " * 8})
+        else:
+            history.append({"id": entry_id, "timestamp": ts.isoformat(),
+                            "user_message": "I have had a throbbing headache for three days",
+                            "bot_response": "How long have you had these symptoms? " * 4})
+    return history
+
+
+# Point the repository at the scratch database on the real server
+def use_database(db):
+    global legacy_users
+    repository.db = db
+    repository.users_collection = db.users
+    repository.chat_messages_collection = db.chat_messages
+    repository.summaries_collection = db.summaries
+    legacy_users = db.legacy_users
+
+
+# What view_summary did before the summaries collection existed
+async def legacy_find_summary(user_id, summary_id):
+    user_doc = await legacy_users.find_one({"user_id": user_id})
+    for entry in user_doc.get("chat_history", []):
+        if str(entry.get("id")) == summary_id:
+            return entry, user_doc
+    return None, user_doc
+
+
+async def load(user_id, history):
+    await legacy_users.delete_many({})
+    await repository.summaries_collection.delete_many({})
+    await repository.chat_messages_collection.delete_many({})
+
+    await legacy_users.insert_one({"user_id": user_id, "chat_history": history})
+    for entry in history:
+        ts = datetime.fromisoformat(entry["timestamp"])
+        if entry.get("type") == "summary":
+            await repository.upsert_summary(user_id, entry)
+        else:
+            await repository.append_chat_message(user_id, entry, ts)
+
+
+async def time_lookups(find, user_id, summary_ids, lookups):
+    latencies = []
+    for summary_id in random.choices(summary_ids, k=lookups):
+        started = time.perf_counter()
+        await find(user_id, summary_id)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def plan_stages(plan):
+    stages = {plan["stage"]} if "stage" in plan else set()
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages |= plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages |= plan_stages(child)
+    return stages
+
+
+# How the server answers find_summary's query: the plan's stages and the documents it examined
+async def explain_find_summary(user_id, summary_id):
+    explained = await repository.db.command({
+        "explain": {"find": "summaries", "filter": {"user_id": user_id, "summary_id": summary_id}, "limit": 1},
+        "verbosity": "executionStats",
+    })
+    stats = explained["executionStats"]
+    return plan_stages(explained["queryPlanner"]["winningPlan"]), stats["totalDocsExamined"], stats["totalKeysExamined"]
+
+
+async def main_async(args):
+    client = MotorClient(args.mongodb_uri, **{**repository.MONGO_CLIENT_OPTIONS, "serverSelectionTimeoutMS": 5000})
+    try:
+        await client.admin.command("ping")
+    except ServerSelectionTimeoutError as e:
+        print(f"skipped: no MongoDB server reachable at {args.mongodb_uri} ({e})")
+        return 0
+    use_database(client[SCRATCH_DATABASE])
+
+    failures = []
+    docs_examined = set()
+    try:
+        await repository.create_indexes()
+        random.seed(0)
+        for size in args.sizes:
+            user_id = f"patient-{size}"
+            history = build_history(size, args.turns_per_summary)
+            await load(user_id, history)
+            summary_ids = [str(entry["id"]) for entry in history if entry.get("type") == "summary"]
+
+            legacy = await time_lookups(legacy_find_summary, user_id, summary_ids, args.lookups)
+            indexed = await time_lookups(repository.find_summary, user_id, summary_ids, args.lookups)
+            _, user_doc = await legacy_find_summary(user_id, summary_ids[0])
+            summary = await repository.find_summary(user_id, summary_ids[0])
+            stages, docs, keys = await explain_find_summary(user_id, summary_ids[-1])
+            docs_examined.add(docs)
+            # MongoDB 8 answers some equality lookups with an EXPRESS_IXSCAN
+            if not any(stage.endswith("IXSCAN") for stage in stages) or "COLLSCAN" in stages:
+                failures.append(f"{size} entries: find_summary planned as {'/'.join(sorted(stages))}")
+
+            print(f"{size:6} entries  legacy  {harness.describe(legacy)}  reads {len(bson.encode(user_doc)) / 1024:8.1f} KiB")
+            print(f"{'':14}indexed {harness.describe(indexed)}  reads {len(bson.encode(summary)) / 1024:8.1f} KiB"
+                  f"  plan {'/'.join(sorted(stages))}, examined {docs} docs / {keys} keys")
+    finally:
+        await client.drop_database(SCRATCH_DATABASE)
+
+    if len(docs_examined) > 1:
+        failures.append(f"find_summary examined {sorted(docs_examined)} documents depending on history size")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongodb-uri", default=os.getenv("BENCHMARK_MONGODB_URI"))
+    parser.add_argument("--sizes", type=lambda value: [int(n) for n in value.split(",")], default=[100, 1000, 5000])
+    parser.add_argument("--turns-per-summary", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+    if not args.mongodb_uri:
+        print("skipped: needs a real MongoDB server (mongomock has no indexes); pass --mongodb-uri or set BENCHMARK_MONGODB_URI")
+        sys.exit(0)
+    sys.exit(asyncio.run(main_async(args)))
@@ -1,40 +1,548 @@
 from fastapi import FastAPI, HTTPException, Depends, status
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, PrivateAttr
 import langgraph
-from langgraph.graph import StateGraph, START
-from typing import Dict, List, Optional
+from langgraph.graph import StateGraph, START, END
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+from typing import Any, Dict, List, Literal, Optional
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_groq import ChatGroq
+from langchain_core.messages import AIMessage, AIMessageChunk
 import os
+import re
+import json
+import string
+import time
+import copy
+import asyncio
+import bisect
+from array import array
+from enum import IntEnum
+import hashlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
-from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from datetime import datetime, timedelta, timezone
 import uuid
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+import repository
+from repository import (
+    append_chat_message,
+    find_principal,
+    find_summary,
+    find_user_by_email,
+    insert_user,
+    page_chat_messages,
+    record_chat_turn,
+    upsert_summary,
+)
 
 # Load environment variables
 load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
-# MongoDB Connection
-MONGODB_URI = os.getenv("MONGODB_URI")
-client = MongoClient(MONGODB_URI)
-db = client.medbot_db
-users_collection = db.users
+# MongoDB Connection (all queries go through the async repository module)
+db = repository.db
 
 # Password and JWT Security
 SECRET_KEY = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor for new hashes, and how many hash/verify calls may run at once.
+# They run on a dedicated thread pool so a burst of logins can't stall the event loop.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(min(4, os.cpu_count() or 1))))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="bcrypt")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Initialize LLM
-llm = ChatGroq(model="llama-3.3-70b-versatile", groq_api_key=GROQ_API_KEY)
+# Run the next conversation node alongside answer validation (see run_speculative_step)
+SPECULATIVE_EXECUTION = os.getenv("SPECULATIVE_EXECUTION", "false").lower() == "true"
+
+# Local answer classifier: minimum confidence to skip the LLM, and whether to double-check it against the LLM.
+# Its confidence is the share of the answer's symptom and medication mentions its extraction accounts for,
+# so the default of 1.0 sends every partially extracted answer to the LLM.
+FAST_VALIDATION_MIN_CONFIDENCE = float(os.getenv("FAST_VALIDATION_MIN_CONFIDENCE", "1.0"))
+FAST_VALIDATION_SHADOW = os.getenv("FAST_VALIDATION_SHADOW", "false").lower() == "true"
+
+# Get the urgency assessment and its follow-up (next question or first aid) in one LLM call,
+# and the criticality check and assessment in another (see assess_initial_urgency, assess_criticality)
+MERGED_TRIAGE = os.getenv("MERGED_TRIAGE", "false").lower() == "true"
+
+# In-process performance counters, gauges and latency samples (exposed on /debug/metrics)
+class PerfMetrics:
+    def __init__(self, sample_size=1024):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.samples = defaultdict(lambda: deque(maxlen=sample_size))
+    
+    def incr(self, name, amount=1):
+        self.counters[name] += amount
+    
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+    
+    def observe(self, name, value):
+        self.samples[name].append(value)
+    
+    def snapshot(self):
+        histograms = {}
+        for name, values in self.samples.items():
+            ordered = sorted(values)
+            if not ordered:
+                continue
+            histograms[name] = {
+                "count": len(ordered),
+                "p50": ordered[int(0.50 * (len(ordered) - 1))],
+                "p95": ordered[int(0.95 * (len(ordered) - 1))],
+                "p99": ordered[int(0.99 * (len(ordered) - 1))],
+                "max": ordered[-1]
+            }
+        return {"counters": dict(self.counters), "gauges": dict(self.gauges), "histograms": histograms}
+
+perf_metrics = PerfMetrics()
+
+# LLM response cache: seconds to keep a completion per prompt family (families not listed are never cached)
+LLM_CACHE_TTL_SECONDS = {
+    "similar_diagnosis": 24 * 3600,
+    "urgent_advice": 24 * 3600,
+    "accident_questions": 3600,
+    "urgency": 3600,
+    "triage": 3600,
+    "validation": 3600,
+}
+LLM_CACHE_TTL_SECONDS.update(json.loads(os.getenv("LLM_CACHE_TTLS", "{}")))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")  # "memory" or "mongo"
+
+# In-process LRU tier of the LLM cache
+class InMemoryLLMCacheBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+    
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        entry, expires_at = item
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+    
+    def set(self, key, entry, ttl):
+        self.entries[key] = (entry, time.time() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+# Shared tier of the LLM cache, backed by a Motor collection
+class MongoLLMCacheBackend:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def create_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+    
+    async def get(self, key):
+        doc = await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        if not doc:
+            return None
+        return {"content": doc["content"], "latency": doc.get("latency", 0.0)}
+    
+    async def set(self, key, entry, ttl):
+        await self.collection.replace_one(
+            {"_id": key},
+            {"_id": key, **entry, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)},
+            upsert=True
+        )
+
+# Chat model wrapper that serves repeated prompts from the cache.
+# json_mode calls go through the provider's JSON mode and are cached separately.
+class CachedLLM:
+    def __init__(self, model, model_name, local_cache, shared_cache=None):
+        self.model = model
+        self.json_model = model.bind(response_format={"type": "json_object"})
+        self.model_name = model_name
+        self.local_cache = local_cache
+        self.shared_cache = shared_cache
+    
+    def cache_key(self, prompt, json_mode=False):
+        normalized = " ".join(prompt.split())
+        mode = "json" if json_mode else "text"
+        return hashlib.sha256(f"{self.model_name}\0{mode}\0{normalized}".encode("utf-8")).hexdigest()
+    
+    async def lookup(self, key, family):
+        entry = self.local_cache.get(key)
+        if entry is None and self.shared_cache is not None:
+            try:
+                entry = await self.shared_cache.get(key)
+            except PyMongoError as e:
+                print(f"LLM cache lookup failed: {str(e)}")
+            if entry is not None:
+                self.local_cache.set(key, entry, LLM_CACHE_TTL_SECONDS[family])
+        
+        if entry is None:
+            perf_metrics.incr("llm_cache.misses")
+        else:
+            perf_metrics.incr("llm_cache.hits")
+            perf_metrics.incr(f"llm_cache.hits.{family}")
+            perf_metrics.incr("llm_cache.seconds_saved", entry["latency"])
+        total = perf_metrics.counters["llm_cache.hits"] + perf_metrics.counters["llm_cache.misses"]
+        perf_metrics.set_gauge("llm_cache.hit_ratio", perf_metrics.counters["llm_cache.hits"] / total)
+        return entry
+    
+    async def store(self, key, family, content, latency):
+        entry = {"content": content, "latency": latency}
+        ttl = LLM_CACHE_TTL_SECONDS[family]
+        self.local_cache.set(key, entry, ttl)
+        if self.shared_cache is not None:
+            try:
+                await self.shared_cache.set(key, entry, ttl)
+            except PyMongoError as e:
+                print(f"LLM cache store failed: {str(e)}")
+    
+    def record_call(self, latency):
+        perf_metrics.incr("llm.calls")
+        perf_metrics.incr(f"llm.calls.{self.model_name}")
+        perf_metrics.observe("llm.call_seconds", latency)
+        perf_metrics.observe(f"llm.call_seconds.{self.model_name}", latency)
+    
+    async def ainvoke(self, prompt, family="default", json_mode=False):
+        cacheable = LLM_CACHE_TTL_SECONDS.get(family, 0) > 0
+        key = self.cache_key(prompt, json_mode) if cacheable else None
+        if cacheable:
+            entry = await self.lookup(key, family)
+            if entry is not None:
+                return AIMessage(content=entry["content"])
+        
+        started = time.perf_counter()
+        result = await (self.json_model if json_mode else self.model).ainvoke(prompt)
+        latency = time.perf_counter() - started
+        self.record_call(latency)
+        
+        if cacheable:
+            await self.store(key, family, result.content, latency)
+        return result
+    
+    # Overwrite the cached reply for a prompt, e.g. with a repaired version of it
+    async def replace(self, prompt, family, content, latency, json_mode=False):
+        if LLM_CACHE_TTL_SECONDS.get(family, 0) > 0:
+            await self.store(self.cache_key(prompt, json_mode), family, content, latency)
+    
+    async def astream(self, prompt, family="default"):
+        cacheable = LLM_CACHE_TTL_SECONDS.get(family, 0) > 0
+        key = self.cache_key(prompt) if cacheable else None
+        if cacheable:
+            entry = await self.lookup(key, family)
+            if entry is not None:
+                yield AIMessageChunk(content=entry["content"])
+                return
+        
+        started = time.perf_counter()
+        parts = []
+        async for chunk in self.model.astream(prompt):
+            parts.append(chunk.content)
+            yield chunk
+        latency = time.perf_counter() - started
+        self.record_call(latency)
+        
+        if cacheable:
+            await self.store(key, family, "".join(parts), latency)
+
+# Sends each prompt family to a model tier: cheap classification to the small model,
+# diagnosis and summaries to the large one. Same ainvoke/astream interface as CachedLLM.
+class ModelRouter:
+    def __init__(self, tiers, family_tiers, default_tier="large"):
+        self.tiers = tiers
+        self.family_tiers = family_tiers
+        self.default_tier = default_tier
+    
+    @property
+    def shared_cache(self):
+        return self.tiers[self.default_tier].shared_cache
+    
+    def tier_for(self, family):
+        tier = self.family_tiers.get(family, self.default_tier)
+        return tier if tier in self.tiers else self.default_tier
+    
+    def route(self, family, tier=None):
+        return self.tiers[tier or self.tier_for(family)]
+    
+    async def ainvoke(self, prompt, family="default", json_mode=False, tier=None):
+        return await self.route(family, tier).ainvoke(prompt, family=family, json_mode=json_mode)
+    
+    async def replace(self, prompt, family, content, latency, json_mode=False):
+        await self.route(family).replace(prompt, family, content, latency, json_mode=json_mode)
+    
+    def astream(self, prompt, family="default"):
+        return self.route(family).astream(prompt, family=family)
+
+# Initialize LLM: one CachedLLM per tier, sharing the cache (keys include the model name)
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "llama-3.3-70b-versatile")
+LLM_SMALL_MODEL_NAME = os.getenv("LLM_SMALL_MODEL_NAME", "llama-3.1-8b-instant")
+
+# Prompt families answered by the small model; everything else uses the large one
+LLM_FAMILY_TIERS = {
+    "validation": "small",
+    "criticality_check": "small",
+    "urgency": "small",
+}
+LLM_FAMILY_TIERS.update(json.loads(os.getenv("LLM_FAMILY_TIERS", "{}")))
+
+llm_local_cache = InMemoryLLMCacheBackend(LLM_CACHE_MAX_ENTRIES)
+llm_shared_cache = MongoLLMCacheBackend(db.llm_cache) if LLM_CACHE_BACKEND == "mongo" else None
+llm = ModelRouter(
+    {
+        "large": CachedLLM(ChatGroq(model=LLM_MODEL_NAME, groq_api_key=GROQ_API_KEY), LLM_MODEL_NAME, llm_local_cache, llm_shared_cache),
+        "small": CachedLLM(ChatGroq(model=LLM_SMALL_MODEL_NAME, groq_api_key=GROQ_API_KEY), LLM_SMALL_MODEL_NAME, llm_local_cache, llm_shared_cache),
+    },
+    LLM_FAMILY_TIERS
+)
+
+# Queue receiving LLM tokens while a /chat/stream request is being served
+stream_token_sink: ContextVar[Optional[asyncio.Queue]] = ContextVar("stream_token_sink", default=None)
+
+# Generate long-form text, forwarding tokens to the active stream if there is one
+async def stream_llm(prompt, family="default"):
+    sink = stream_token_sink.get()
+    if sink is None:
+        return await llm.ainvoke(prompt, family=family)
+    
+    message = None
+    async for chunk in llm.astream(prompt, family=family):
+        if chunk.content:
+            await sink.put(chunk.content)
+        message = chunk if message is None else message + chunk
+    return message if message is not None else AIMessage(content="")
+
+# First JSON object in a model reply. Prose and code fences around it are skipped,
+# braces inside strings are ignored, and a reply cut off mid-object (max tokens or
+# a partial stream) is closed off before parsing. Returns None if nothing parses.
+def extract_json(text):
+    start = text.find("{")
+    while start != -1:
+        closers = []
+        in_string = escaped = False
+        for index in range(start, len(text)):
+            char = text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                closers.append("}" if char == "{" else "]")
+            elif char in "}]":
+                if closers.pop() != char:
+                    break
+                if not closers:
+                    try:
+                        value = json.loads(text[start:index + 1])
+                    except ValueError:
+                        break
+                    if isinstance(value, dict):
+                        return value
+                    break
+        else:
+            tail = text[start:]
+            if in_string:
+                tail = (tail[:-1] if escaped else tail) + '"'
+            else:
+                tail = tail.rstrip().rstrip(",")
+            try:
+                return json.loads(tail + "".join(reversed(closers)))
+            except ValueError:
+                return None
+        start = text.find("{", start + 1)
+    return None
+
+# Typed replies of the prompt families that answer in JSON
+class UrgencyAssessment(BaseModel):
+    urgency_level: Literal["URGENT", "PROMPT", "ROUTINE"]
+    category: str = "general"
+    reasoning: str = ""
+    key_symptoms: List[str] = []
+    recommended_questions: List[str] = []
+
+# Merged mode: the assessment plus what to tell the patient next
+class TriageAssessment(UrgencyAssessment):
+    next_question: str = ""
+    first_aid_steps: List[str] = []
+
+class CriticalityAssessment(BaseModel):
+    is_urgent: bool
+    urgency_level: Literal["URGENT", "PROMPT", "ROUTINE"]
+    timeframe: str
+    precautions: List[str] = []
+    disclaimer: str = "This is not a substitute for professional medical care."
+    
+    # Same sections the criticality prompt asks for in the two-call mode
+    def to_markdown(self):
+        precautions = "\n".join(f"• {precaution}" for precaution in self.precautions)
+        return (
+            f"## URGENCY LEVEL\n{self.urgency_level}\n\n"
+            f"## TIMEFRAME\n{self.timeframe}\n\n"
+            f"## PRECAUTIONS\n{precautions}\n\n"
+            f"## DISCLAIMER\n{self.disclaimer}"
+        )
+
+class FollowUpPlan(BaseModel):
+    next_question: str = ""
+    move_to_diagnosis: bool
+    reasoning: str = ""
+    additional_context: Dict[str, Any] = {}
+    path_update: Optional[str] = None
+
+class ResponseValidation(BaseModel):
+    is_valid: bool
+    reason: str = ""
+    
+    # Each expected answer type asks for its own extra fields
+    class Config:
+        extra = "allow"
+
+def parse_structured(text, schema):
+    data = extract_json(text)
+    if data is None:
+        raise ValueError("no JSON object found in the reply")
+    return schema.parse_obj(data)
+
+# Ask for a JSON reply matching schema. A reply that does not parse or validate gets
+# one repair round trip on the large model; if that fails too the caller falls back to its defaults (None).
+async def structured_llm(prompt, schema, family):
+    perf_metrics.incr("structured.calls")
+    reply = await llm.ainvoke(prompt, family=family, json_mode=True)
+    try:
+        return parse_structured(reply.content, schema)
+    except ValueError as e:
+        error = e
+    
+    perf_metrics.incr("structured.parse_failures")
+    perf_metrics.incr(f"structured.parse_failures.{family}")
+    perf_metrics.incr("structured.extra_round_trips")
+    perf_metrics.set_gauge("structured.parse_failure_ratio", perf_metrics.counters["structured.parse_failures"] / perf_metrics.counters["structured.calls"])
+    
+    repair_prompt = f"""
+    Your previous reply could not be used: {error}
+    
+    Original instructions:
+    {prompt}
+    
+    Previous reply:
+    {reply.content}
+    
+    Reply again with only the corrected JSON object, with these fields: {", ".join(schema.__fields__)}.
+    """
+    if llm.tier_for(family) != "large":
+        perf_metrics.incr("llm_router.escalations")
+        perf_metrics.incr(f"llm_router.escalations.{family}")
+    started = time.perf_counter()
+    repaired = await llm.ainvoke(repair_prompt, family=f"{family}_repair", json_mode=True, tier="large")
+    try:
+        result = parse_structured(repaired.content, schema)
+    except ValueError as e:
+        print(f"Structured {family} reply could not be repaired: {str(e)}")
+        perf_metrics.incr("structured.repair_failures")
+        perf_metrics.incr(f"structured.repair_failures.{family}")
+        return None
+    
+    perf_metrics.incr("structured.repairs")
+    perf_metrics.incr(f"structured.repairs.{family}")
+    # Don't keep serving the broken reply from the cache
+    await llm.replace(prompt, family, repaired.content, time.perf_counter() - started, json_mode=True)
+    return result
+
+# Prompt budgets in tokens per prompt family (families not listed are never truncated).
+# Tokens are estimated at ~4 characters each, which is close enough for Llama on English text.
+PROMPT_CHARS_PER_TOKEN = 4
+PROMPT_TOKEN_BUDGETS = {
+    "diagnosis": 1200,
+    "summary": 1500,
+    "urgent_steps": 800,
+}
+PROMPT_TOKEN_BUDGETS.update(json.loads(os.getenv("PROMPT_TOKEN_BUDGETS", "{}")))
+
+def estimate_tokens(text):
+    return -(-len(text) // PROMPT_CHARS_PER_TOKEN)
+
+# Variable part of a prompt. Sections are given budget in priority order (highest first).
+# "recent" sections keep their first entry (the presenting complaint) plus as many of the
+# latest entries as fit, dropping the oldest ones in between; "head" sections keep their opening text.
+class PromptSection:
+    def __init__(self, entries, priority=0, keep="recent", separator="\n"):
+        if isinstance(entries, str):
+            entries = entries.split(separator) if keep == "recent" else [entries]
+        self.entries = [entry for entry in entries if entry]
+        self.priority = priority
+        self.keep = keep
+        self.separator = separator
+    
+    @property
+    def text(self):
+        return self.separator.join(self.entries)
+    
+    def fit(self, max_chars):
+        text = self.text
+        if len(text) <= max_chars:
+            return text
+        if self.keep == "recent" and len(self.entries) > 2:
+            first, rest = self.entries[0], self.entries[1:]
+            kept = []
+            used = len(first) + len(self.separator)
+            for entry in reversed(rest):
+                marker = f"[{len(rest) - len(kept) - 1} earlier entries omitted]"
+                if used + len(entry) + len(marker) + 2 * len(self.separator) > max_chars:
+                    break
+                kept.insert(0, entry)
+                used += len(entry) + len(self.separator)
+            if kept:
+                marker = f"[{len(rest) - len(kept)} earlier entries omitted]"
+                return self.separator.join([first, marker] + kept)
+        # Keep the opening text, cut at a word boundary; the marker counts against the budget too
+        if max_chars < 20:
+            return "[omitted]" if max_chars >= len("[omitted]") else ""
+        cut = text[:max_chars - 3]
+        return (cut.rsplit(" ", 1)[0] if " " in cut else cut) + "..."
+
+# Fill template's {placeholders} from the sections, truncating them to the family's token budget
+def build_prompt(family, template, **sections):
+    sections = {name: section if isinstance(section, PromptSection) else PromptSection(section)
+                for name, section in sections.items()}
+    budget = PROMPT_TOKEN_BUDGETS.get(family)
+    remaining = float("inf")
+    if budget is not None:
+        fixed = template.format(**{name: "" for name in sections})
+        remaining = max(budget * PROMPT_CHARS_PER_TOKEN - len(fixed), 0)
+    
+    filled = {}
+    dropped = 0
+    for name, section in sorted(sections.items(), key=lambda item: -item[1].priority):
+        text = section.fit(remaining)
+        filled[name] = text
+        remaining = max(remaining - len(text), 0)
+        dropped += max(len(section.text) - len(text), 0)
+    
+    prompt = template.format(**filled)
+    perf_metrics.observe(f"prompt.tokens.{family}", estimate_tokens(prompt))
+    if dropped:
+        perf_metrics.incr(f"prompt.truncated.{family}")
+        perf_metrics.incr(f"prompt.tokens_dropped.{family}", -(-dropped // PROMPT_CHARS_PER_TOKEN))
+    return prompt
 
 
 # Initialize FastAPI
@@ -49,18 +557,299 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Simulating a persistent database (replace with actual DB if needed)
-user_data_store = {}
+# Private copy of a user's data used while a node runs speculatively
+speculative_session: ContextVar[Optional[dict]] = ContextVar("speculative_session", default=None)
+
+# Session of the user whose chat turn is running, with the updates made so far in the turn;
+# they are written back together when the turn ends
+chat_turn_session: ContextVar[Optional[dict]] = ContextVar("chat_turn_session", default=None)
 
 # User Response Model
 class UserResponse(BaseModel):
     user_id: str
     response: str
 
+# Kinds of entries in a user's conversation history
+class EventKind(IntEnum):
+    ANSWER = 1      # patient input used to describe the case
+    QUESTION = 2    # question shown to the patient
+    STEP = 3        # conversation step marker
+    VALIDATION = 4  # validation outcome of an answer
+    NOTE = 5        # anything else recorded by a handler
+
+ANSWER_KEYS = {"symptoms", "previous_history", "medication_history", "additional_symptoms", "response"}
+CONVERSATION_KINDS = (EventKind.ANSWER, EventKind.NOTE)
+# Notes that still hold the patient's own words, as do partial_<step> answers
+PATIENT_NOTE_KEYS = {"accident_info", "urgent_follow_up"}
+
+def is_patient_input(key):
+    return key in ANSWER_KEYS or key in PATIENT_NOTE_KEYS or key.startswith("partial_")
+
+def event_kind_for(key):
+    if key in ANSWER_KEYS:
+        return EventKind.ANSWER
+    if key == "current_question":
+        return EventKind.QUESTION
+    if key == "current_step":
+        return EventKind.STEP
+    if key == "validation":
+        return EventKind.VALIDATION
+    return EventKind.NOTE
+
+# History keys are interned once per process and referenced by index. Keys include
+# step names the LLM can steer, so only the first HISTORY_KEY_LIMIT distinct keys are
+# interned; entries with any other key keep their own copy of it (see EventLog.key_at).
+HISTORY_KEY_LIMIT = 1024
+UNINTERNED_KEY = 2 ** 32 - 1
+history_keys = []
+history_key_ids = {}
+
+def intern_history_key(key):
+    key_id = history_key_ids.get(key)
+    if key_id is None and len(history_keys) < HISTORY_KEY_LIMIT:
+        key_id = len(history_keys)
+        history_keys.append(key)
+        history_key_ids[key] = key_id
+    return key_id
+
+# Append-only conversation history stored column-wise in compact arrays
+class EventLog:
+    __slots__ = ("kinds", "key_ids", "timestamps", "values", "details", "other_keys")
+    
+    def __init__(self):
+        self.kinds = array("B")
+        self.key_ids = array("I")
+        self.timestamps = array("d")
+        self.values = []
+        self.details = {}  # sparse: entry index -> validation details
+        self.other_keys = None  # sparse, created on first use: entry index -> key that was not interned
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def record(self, key, value, validation_details=None, timestamp=None):
+        key_id = intern_history_key(key)
+        if key_id is None:
+            if self.other_keys is None:
+                self.other_keys = {}
+            self.other_keys[len(self.values)] = key
+            key_id = UNINTERNED_KEY
+        if validation_details:
+            self.details[len(self.values)] = validation_details
+        self.kinds.append(event_kind_for(key))
+        self.key_ids.append(key_id)
+        self.timestamps.append(timestamp if timestamp is not None else time.time())
+        self.values.append(value)
+    
+    def key_at(self, index):
+        key_id = self.key_ids[index]
+        return self.other_keys[index] if key_id == UNINTERNED_KEY else history_keys[key_id]
+    
+    def iter_values(self, *kinds):
+        if not kinds:
+            return iter(self.values)
+        return (value for kind, value in zip(self.kinds, self.values) if kind in kinds)
+    
+    def iter_details(self):
+        return (self.details[index] for index in sorted(self.details))
+    
+    # Legacy JSON shape: one {key: value} dict per entry, plus validation_details
+    def to_legacy(self):
+        entries = []
+        for index, value in enumerate(self.values):
+            entry = {self.key_at(index): value}
+            if index in self.details:
+                entry["validation_details"] = self.details[index]
+            entries.append(entry)
+        return entries
+    
+    # Compact persisted form: [key, value, milliseconds since the previous entry] rows,
+    # with validation details appended to the rows that have them
+    def to_rows(self):
+        rows = []
+        previous_ms = 0
+        for index, (value, timestamp) in enumerate(zip(self.values, self.timestamps)):
+            timestamp_ms = round(timestamp * 1000)
+            row = [self.key_at(index), value, timestamp_ms - previous_ms]
+            if index in self.details:
+                row.append(self.details[index])
+            rows.append(row)
+            previous_ms = timestamp_ms
+        return rows
+    
+    @classmethod
+    def from_rows(cls, rows):
+        log = cls()
+        timestamp_ms = 0
+        for row in rows:
+            if isinstance(row, dict):
+                # Entry saved in the legacy dict shape
+                details = row.get("validation_details")
+                key, value = next((k, v) for k, v in row.items() if k != "validation_details")
+                log.record(key, value, details, 0.0)
+            elif len(row) == 4 and not isinstance(row[2], int):
+                # [key, value, details, timestamp] row saved before timestamps were delta-encoded
+                key, value, details, timestamp = row
+                log.record(key, value, details, timestamp)
+            else:
+                timestamp_ms += row[2]
+                log.record(row[0], row[1], row[3] if len(row) > 3 else None, timestamp_ms / 1000)
+        return log
+
+# ASCII punctuation and whitespace, mapped one to one onto spaces by str.translate
+KEYWORD_SEPARATORS = str.maketrans(string.punctuation + string.whitespace, " " * len(string.punctuation + string.whitespace))
+
+# Matches every keyword category from the triage lexicon in one pass over the text.
+# The text is lowercased once and its ASCII separators turned into spaces, so every
+# word start follows a space and terms of word and prefix categories are found by a
+# single findall of " " plus a trie-shaped alternation of the terms; a literal first
+# character lets the regex engine skip between spaces without trying each position.
+# Terms that contain a separator ("told me", "can't") are then confirmed on the
+# lowercased text, since "told_me" also reads "told me" once spaced. Non-ASCII text
+# can have separators the table does not know, so it uses a word-start lookbehind
+# instead. A term that is a prefix of another term ("i" and "i did") would be hidden
+# by the longer one, so such terms go in a later pattern. Substring categories are
+# plain `in` checks.
+class KeywordMatcher:
+    def __init__(self, lexicon):
+        self.rules = defaultdict(list)  # term -> [(category, match mode)]
+        self.rank = {}  # (category, term) -> position in the category's term list
+        for category, spec in lexicon.items():
+            if category.startswith("_"):
+                continue
+            for rank, term in enumerate(spec["terms"]):
+                term = term.lower()
+                self.rules[term].append((category, spec.get("match", "prefix")))
+                self.rank[(category, term)] = rank
+        
+        self.substring_rules = []  # [(term, categories)]
+        # spaced term (ending in "\0" when it must end a word) -> [(term, whole word, needs confirming, categories)]
+        word_terms = defaultdict(list)
+        for term, rules in self.rules.items():
+            for mode in ("word", "prefix", "substring"):
+                categories = [category for category, rule_mode in rules if rule_mode == mode]
+                if not categories:
+                    continue
+                if mode == "substring":
+                    self.substring_rules.append((term, categories))
+                else:
+                    key = term.translate(KEYWORD_SEPARATORS) + ("\0" if mode == "word" else "")
+                    word_terms[key].append((term, mode == "word", not term.isalnum(), categories))
+        
+        # [(pattern after a space, pattern after any word boundary, spaced term -> rules)]
+        self.patterns = []
+        remaining = set(word_terms)
+        while remaining:
+            layer = {key for key in remaining if not any(other != key and other.startswith(key) for other in remaining)}
+            remaining -= layer
+            trie = self.trie_pattern(layer)
+            self.patterns.append((
+                re.compile(" (?=(" + trie + "))"),
+                re.compile(r"(?<![^\W_])(?=(" + trie + "))"),  # not preceded by a letter or digit, like is_boundary
+                {key.rstrip("\0"): word_terms[key] for key in layer},
+            ))
+    
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+    
+    # Regex alternation of the terms with shared prefixes factored out, so matching does not
+    # retry every term at each position; a trailing "\0" requires the term to end a word
+    @classmethod
+    def trie_pattern(cls, terms):
+        trie = {}
+        for term in terms:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        return cls.trie_node_pattern(trie) or "(?!)"
+    
+    @classmethod
+    def trie_node_pattern(cls, node):
+        branches = [(r"(?![^\W_])" if char == "\0" else re.escape(char)) + cls.trie_node_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{pattern})?" if "" in node else pattern
+    
+    @staticmethod
+    def is_boundary(text, index):
+        return index <= 0 or index >= len(text) or not (text[index - 1].isalnum() and text[index].isalnum())
+    
+    # Whether the term appears in the text starting a word (and ending one, for whole words)
+    def occurs(self, text, term, whole_word):
+        start = text.find(term)
+        while start >= 0:
+            if self.is_boundary(text, start) and (not whole_word or self.is_boundary(text, start + len(term))):
+                return True
+            start = text.find(term, start + 1)
+        return False
+    
+    # Category -> matched terms (in lexicon order) for everything found in the text
+    def scan(self, text):
+        hits = {}
+        lowered = text.lower()
+        spaced = " " + lowered.translate(KEYWORD_SEPARATORS)
+        after_space = spaced.isascii()
+        for space_pattern, boundary_pattern, terms in self.patterns:
+            pattern = space_pattern if after_space else boundary_pattern
+            for found in set(pattern.findall(spaced)):
+                for term, whole_word, confirm, categories in terms[found]:
+                    if confirm and not self.occurs(lowered, term, whole_word):
+                        continue
+                    for category in categories:
+                        hits.setdefault(category, []).append(term)
+        for term, categories in self.substring_rules:
+            if term in lowered:
+                for category in categories:
+                    hits.setdefault(category, []).append(term)
+        for category, found in hits.items():
+            if len(found) > 1:
+                found.sort(key=lambda term: self.rank[(category, term)])
+        return hits
+
+TRIAGE_KEYWORDS_PATH = os.getenv("TRIAGE_KEYWORDS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "triage_keywords.json"))
+triage_matcher = KeywordMatcher.from_file(TRIAGE_KEYWORDS_PATH)
+
+# Number of recent patient entries included in follow-up question prompts
+CONVERSATION_WINDOW = 5
+
+# Patient context maintained entry by entry, so prompts never re-walk the history
+class PatientProfile(BaseModel):
+    # Answers joined for the diagnosis prompt (skips "continue" tokens) and for urgent advice
+    diagnosis_description: str = ""
+    urgent_description: str = ""
+    # Red flags seen in anything the patient wrote (bot questions and advice are not scanned)
+    has_asthma: bool = False
+    lost_inhaler: bool = False
+    breathing_issues: bool = False
+    recent_conversation: List[str] = []
+    
+    def observe(self, kind, value, from_patient):
+        lowered = value.lower()
+        if from_patient:
+            hits = triage_matcher.scan(value)
+            if "asthma" in hits:
+                self.has_asthma = True
+            if "loss" in hits and "inhaler" in hits:
+                self.lost_inhaler = True
+            if "breathing_difficulty" in hits:
+                self.breathing_issues = True
+        
+        if kind == EventKind.ANSWER and len(value) > 3:
+            self.urgent_description = f"{self.urgent_description}\n{value}" if self.urgent_description else value
+            if "continue" not in lowered:
+                self.diagnosis_description = f"{self.diagnosis_description}\n{value}" if self.diagnosis_description else value
+        
+        if kind in CONVERSATION_KINDS:
+            self.recent_conversation = (self.recent_conversation + [f"Patient: {value}"])[-CONVERSATION_WINDOW:]
+
 # User Data Model (for tracking conversation state)
 class UserData(BaseModel):
     user_id: str
-    history: List[Dict[str, str]] = []
     is_existing: bool = False
     symptoms: List[str] = []
     previous_history: str = ""
@@ -68,26 +857,355 @@ class UserData(BaseModel):
     additional_symptoms: str = ""
     diagnosis: str = ""
     critical: bool = False
+    # Cursors maintained by update_user_data; history is only an audit log
+    current_step: Optional[str] = None
+    current_question: Optional[str] = None
+    last_validation: Optional[Dict[str, Any]] = None
+    last_response: Optional[str] = None
+    profile: PatientProfile = Field(default_factory=PatientProfile)
+    _history: EventLog = PrivateAttr(default_factory=EventLog)
+    # Version of the stored document this copy was read from (0 if it was never stored)
+    _version: int = PrivateAttr(default=0)
+    
+    @property
+    def history(self):
+        return self._history
+    
+    # JSON shape returned by the API, with history in its legacy dict-per-entry form
+    def export(self):
+        return {**self.dict(), "history": self._history.to_legacy()}
+    
+    # Document shape used for persistence, with history as compact rows
+    def to_document(self):
+        return {**self.dict(), "history": self._history.to_rows()}
+    
+    @classmethod
+    def from_document(cls, doc):
+        doc = dict(doc)
+        doc.pop("_id", None)
+        rows = doc.pop("history", [])
+        version = doc.pop("version", 0) or 0
+        user = cls(**doc)
+        user._history = EventLog.from_rows(rows)
+        user._version = version
+        return user
+
+# Raised by SessionStore.put when the stored session changed since it was read
+class SessionWriteConflict(Exception):
+    pass
+
+# Conversation state backend, keyed by user_id
+class SessionStore:
+    async def get(self, user_id: str) -> Optional[UserData]:
+        raise NotImplementedError
+    
+    async def put(self, user: UserData):
+        raise NotImplementedError
+    
+    async def contains(self, user_id: str) -> bool:
+        return await self.get(user_id) is not None
+    
+    async def delete(self, user_id: str):
+        raise NotImplementedError
+    
+    async def items(self):
+        raise NotImplementedError
+
+# Limits for the in-memory session cache
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", "1800"))
+SESSION_SWEEP_SECONDS = int(os.getenv("SESSION_SWEEP_SECONDS", "60"))
+SESSION_WRITE_ATTEMPTS = int(os.getenv("SESSION_WRITE_ATTEMPTS", "3"))
+
+# Bounded session cache kept in this process's memory.
+# Least recently used and idle sessions are evicted. With a backing store (shared by all
+# workers) every write goes through to it as a compare-and-set on the session version:
+# a cached copy that another worker has changed since is only found out when it is
+# written, which fails with SessionWriteConflict and drops the copy, so the caller can
+# re-read the session and apply its updates again. Without one, evicted sessions are dropped.
+class InMemorySessionStore(SessionStore):
+    def __init__(self, backing_store=None, max_count=SESSION_MAX_COUNT, max_bytes=SESSION_MAX_BYTES, idle_seconds=SESSION_IDLE_SECONDS):
+        self.backing_store = backing_store
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+        self.last_access = {}
+        self.sizes = {}
+        self.changed = set()  # sessions whose size estimate is out of date
+        self.total_bytes = 0
+    
+    @staticmethod
+    def estimate_bytes(user):
+        return len(json.dumps(user.to_document(), default=str))
+    
+    def touch(self, user_id):
+        self.sessions.move_to_end(user_id)
+        self.last_access[user_id] = time.monotonic()
+    
+    def update_size(self, user_id):
+        size = self.estimate_bytes(self.sessions[user_id])
+        self.total_bytes += size - self.sizes.get(user_id, 0)
+        self.sizes[user_id] = size
+    
+    def update_gauges(self):
+        perf_metrics.set_gauge("sessions.live", len(self.sessions))
+        perf_metrics.set_gauge("sessions.estimated_bytes", self.total_bytes)
+    
+    async def get(self, user_id):
+        user = self.sessions.get(user_id)
+        if user is not None:
+            self.touch(user_id)
+            return user
+        
+        if self.backing_store is None:
+            return None
+        user = await self.backing_store.get(user_id)
+        if user is None:
+            return None
+        cached = self.sessions.get(user_id)
+        if cached is not None and cached._version >= user._version:
+            # A write from this process landed while we were reading
+            self.touch(user_id)
+            return cached
+        self.cache(user)
+        await self.enforce_limits()
+        return user
+    
+    async def put(self, user):
+        if self.backing_store is not None:
+            try:
+                await self.backing_store.put(user)
+            except SessionWriteConflict:
+                # The cached copy was changed in place; drop it so the next get re-reads the store
+                if self.sessions.get(user.user_id) is user:
+                    self.forget(user.user_id)
+                raise
+        if self.cache(user):
+            await self.enforce_limits()
+    
+    # Keep user as the cached copy; returns True if the session was not cached before
+    def cache(self, user):
+        is_new = user.user_id not in self.sessions
+        if is_new:
+            self.sessions[user.user_id] = user
+            self.update_size(user.user_id)
+        else:
+            self.sessions[user.user_id] = user
+            self.changed.add(user.user_id)
+        self.touch(user.user_id)
+        return is_new
+    
+    async def contains(self, user_id):
+        if self.backing_store is not None:
+            return await self.backing_store.contains(user_id)
+        return user_id in self.sessions
+    
+    async def delete(self, user_id):
+        self.forget(user_id)
+        if self.backing_store is not None:
+            await self.backing_store.delete(user_id)
+        await forget_chat_thread(user_id)
+        self.update_gauges()
+    
+    async def items(self):
+        sessions = dict(await self.backing_store.items()) if self.backing_store is not None else {}
+        if self.backing_store is None:
+            sessions.update(self.sessions)
+        return list(sessions.items())
+    
+    def forget(self, user_id):
+        self.sessions.pop(user_id, None)
+        self.last_access.pop(user_id, None)
+        self.changed.discard(user_id)
+        self.total_bytes -= self.sizes.pop(user_id, 0)
+    
+    async def evict(self, user_id, reason):
+        # Writes already went through to the backing store, so there is nothing to save first
+        self.forget(user_id)
+        if self.backing_store is None:
+            await forget_chat_thread(user_id)
+        else:
+            await release_chat_thread(user_id)
+        perf_metrics.incr(f"sessions.evicted.{reason}")
+    
+    async def enforce_limits(self):
+        # The most recently used session is always kept, even if it alone exceeds the byte budget
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_count or self.total_bytes > self.max_bytes):
+            oldest_user_id = next(iter(self.sessions))
+            await self.evict(oldest_user_id, "capacity")
+        self.update_gauges()
+    
+    async def sweep(self):
+        # Sizes of sessions changed since the last sweep are re-estimated here rather than on every write
+        for user_id in list(self.changed):
+            if user_id in self.sessions:
+                self.update_size(user_id)
+        self.changed.clear()
+        
+        cutoff = time.monotonic() - self.idle_seconds
+        for user_id in [uid for uid, accessed in self.last_access.items() if accessed < cutoff]:
+            await self.evict(user_id, "idle")
+        
+        await self.enforce_limits()
+
+# Session store persisted in a MongoDB collection (through Motor), shared by all workers
+class MongoSessionStore(SessionStore):
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def get(self, user_id):
+        doc = await self.collection.find_one({"_id": user_id})
+        if not doc:
+            return None
+        return UserData.from_document(doc)
+    
+    # Compare-and-set on the document version, so a worker holding a stale copy
+    # cannot overwrite changes another worker made in the meantime
+    async def put(self, user):
+        expected = user._version if user._version else {"$in": [0, None]}
+        document = {"_id": user.user_id, **user.to_document(), "version": user._version + 1}
+        try:
+            await self.collection.replace_one({"_id": user.user_id, "version": expected}, document, upsert=True)
+        except DuplicateKeyError:
+            # No document with the expected version, and the upsert hit the existing one
+            perf_metrics.incr("sessions.write_conflicts")
+            raise SessionWriteConflict(user.user_id)
+        user._version += 1
+    
+    async def contains(self, user_id):
+        return await self.collection.count_documents({"_id": user_id}, limit=1) > 0
+    
+    async def delete(self, user_id):
+        await self.collection.delete_one({"_id": user_id})
+    
+    async def items(self):
+        sessions = []
+        async for doc in self.collection.find():
+            sessions.append((doc["user_id"], UserData.from_document(doc)))
+        return sessions
+
+# Consistent hash ring so adding a shard only moves a fraction of the users
+class ConsistentHashRing:
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self.ring.append((self.hash_key(f"{node}#{i}"), node))
+        self.ring.sort()
+        self.positions = [position for position, _ in self.ring]
+    
+    @staticmethod
+    def hash_key(key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
+    
+    def node_for(self, key):
+        index = bisect.bisect(self.positions, self.hash_key(key)) % len(self.ring)
+        return self.ring[index][1]
+
+# Session store that spreads users over several shards by consistent hashing
+class ShardedSessionStore(SessionStore):
+    def __init__(self, shards):
+        self.shards = shards
+        self.ring = ConsistentHashRing(list(shards.keys()))
+    
+    def shard_for(self, user_id):
+        return self.shards[self.ring.node_for(user_id)]
+    
+    async def get(self, user_id):
+        return await self.shard_for(user_id).get(user_id)
+    
+    async def put(self, user):
+        await self.shard_for(user.user_id).put(user)
+    
+    async def contains(self, user_id):
+        return await self.shard_for(user_id).contains(user_id)
+    
+    async def delete(self, user_id):
+        await self.shard_for(user_id).delete(user_id)
+    
+    async def items(self):
+        sessions = []
+        for shard in self.shards.values():
+            sessions.extend(await shard.items())
+        return sessions
+
+# Build the session store from SESSION_STORE ("memory" or "mongo") and SESSION_SHARD_URIS
+def build_session_store():
+    if os.getenv("SESSION_STORE", "memory") != "mongo":
+        return InMemorySessionStore()
+    
+    shard_uris = [uri.strip() for uri in os.getenv("SESSION_SHARD_URIS", "").split(",") if uri.strip()]
+    if not shard_uris:
+        return InMemorySessionStore(MongoSessionStore(db.sessions))
+    
+    return InMemorySessionStore(ShardedSessionStore({
+        f"shard-{i}": MongoSessionStore(repository.make_client(uri).medbot_db.sessions)
+        for i, uri in enumerate(shard_uris)
+    }))
+
+session_store = build_session_store()
+
+# Periodically evict idle sessions
+async def session_eviction_loop():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        try:
+            await session_store.sweep()
+        except Exception as e:
+            print(f"Error sweeping sessions: {str(e)}")
+
+session_eviction_task = None
+
+@app.on_event("startup")
+async def start_session_eviction():
+    global session_eviction_task
+    session_eviction_task = asyncio.create_task(session_eviction_loop())
+
+@app.on_event("shutdown")
+async def stop_session_eviction():
+    if session_eviction_task:
+        session_eviction_task.cancel()
+
+# Chat turn session for user_id, if one of its turns is running
+def current_chat_turn(user_id: str):
+    turn = chat_turn_session.get()
+    return turn if turn and turn["user_id"] == user_id else None
+
+# Session for user_id, or None if it was never created (during a chat turn, the turn's copy)
+async def find_user_data(user_id: str):
+    turn = current_chat_turn(user_id)
+    if turn:
+        return turn["user"]
+    return await session_store.get(user_id)
 
 # Function to get user state
-def get_user_data(user_id: str):
-    return user_data_store.get(user_id, UserData(user_id=user_id))
+async def get_user_data(user_id: str):
+    session = speculative_session.get()
+    if session and session["user"].user_id == user_id:
+        return session["user"]
+    user = await find_user_data(user_id)
+    return user if user is not None else UserData(user_id=user_id)
+
+# Store a new session, unless another worker created it first
+async def create_user_data(user_id: str):
+    turn = current_chat_turn(user_id)
+    if turn:
+        # Written back with the rest of the turn
+        if turn["user"] is None:
+            turn["user"] = UserData(user_id=user_id)
+        return
+    try:
+        await session_store.put(UserData(user_id=user_id))
+    except SessionWriteConflict:
+        pass
 
-# Function to update user data with validation details
-def update_user_data(user_id: str, key: str, value: str, validation_details=None):
-    user = get_user_data(user_id)
-    
-    # Make sure the value is a string, not a dictionary
-    if isinstance(value, dict):
-        # Convert dict to string if accidentally passed
-        value = str(value)
-    
+# Apply one update_user_data change to a session in place
+def apply_user_update(user: UserData, key: str, value: str, validation_details=None):
     # Add the new entry with validation details if provided
-    entry = {key: value}
-    if validation_details:
-        entry["validation_details"] = validation_details
-    
-    user.history.append(entry)
+    user.history.record(key, value, validation_details)
+    user.profile.observe(event_kind_for(key), value, is_patient_input(key))
     
     # Also update specific fields based on key
     if key == "symptoms":
@@ -105,13 +1223,63 @@ def update_user_data(user_id: str, key: str, value: str, validation_details=None
     elif key == "critical":
         user.critical = value.lower() == "yes"
     elif key == "current_question":
-        # Just store in history, don't update specific fields
-        pass
+        user.current_question = value
     elif key == "current_step":
-        # Just store in history, don't update specific fields
-        pass
+        user.current_step = value
+    elif key == "response":
+        user.last_response = value
+    
+    if validation_details:
+        user.last_validation = validation_details
+
+# Function to update user data with validation details
+async def update_user_data(user_id: str, key: str, value: str, validation_details=None):
+    # Make sure the value is a string, not a dictionary
+    if isinstance(value, dict):
+        # Convert dict to string if accidentally passed
+        value = str(value)
     
-    user_data_store[user_id] = user
+    # Speculative writes stay on the private copy until the turn commits them
+    session = speculative_session.get()
+    if session and session["user"].user_id == user_id:
+        apply_user_update(session["user"], key, value, validation_details)
+        session["journal"].append((key, value, validation_details))
+        return
+    
+    # Writes during a chat turn are applied to the turn's copy and stored when it ends
+    turn = current_chat_turn(user_id)
+    if turn:
+        if turn["user"] is None:
+            turn["user"] = UserData(user_id=user_id)
+        apply_user_update(turn["user"], key, value, validation_details)
+        turn["journal"].append((key, value, validation_details))
+        return
+    
+    await write_user_updates(user_id, [(key, value, validation_details)])
+
+# Store updates to a session with one put. user is a copy they were already applied to,
+# if any; when another worker changed the session in the meantime, it is re-read and
+# the updates applied to it again.
+async def write_user_updates(user_id: str, updates, user: Optional[UserData] = None):
+    for attempt in range(SESSION_WRITE_ATTEMPTS):
+        if user is None:
+            user = await session_store.get(user_id) or UserData(user_id=user_id)
+            for key, value, validation_details in updates:
+                apply_user_update(user, key, value, validation_details)
+        try:
+            await session_store.put(user)
+            return
+        except SessionWriteConflict:
+            if attempt == SESSION_WRITE_ATTEMPTS - 1:
+                raise
+            perf_metrics.incr("sessions.write_retries")
+            user = None
+
+# Store everything a chat turn changed with one put (a new session is stored even if unchanged)
+async def commit_chat_turn(turn):
+    user = turn["user"]
+    if user is not None and (turn["journal"] or user._version == 0):
+        await write_user_updates(turn["user_id"], turn["journal"], user)
 
 # Update the ChatState model to track urgency and custom conversation paths
 class ChatState(BaseModel):
@@ -163,7 +1331,7 @@ def ensure_dict(state):
         return state
 
 # Ask question function for conversation flow
-def ask_question(state, question, key, next_step):
+async def ask_question(state, question, key, next_step):
     try:
         state_dict = ensure_dict(state)
         user_id = state_dict["user_id"]
@@ -171,7 +1339,7 @@ def ask_question(state, question, key, next_step):
         
         # Store the response if there is one
         if user_response:
-            update_user_data(user_id, key, user_response)
+            await update_user_data(user_id, key, user_response)
         
         # Set the next question and step
         state_dict["current_question"] = question
@@ -185,7 +1353,7 @@ def ask_question(state, question, key, next_step):
         return state_dict
 
 # Modify the start_node function for proper validation from the beginning
-def start_node(state):
+async def start_node(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
@@ -193,12 +1361,12 @@ def start_node(state):
     # Check if this is a first-time call vs a response to the greeting
     if not user_response:
         # First time - just set up the user and return a greeting
-        user_data = get_user_data(user_id)
-        is_new_user = user_id not in user_data_store
+        user_data = await get_user_data(user_id)
+        is_new_user = not await session_store.contains(user_id)
         state_dict["is_existing"] = not is_new_user
         
         if is_new_user:
-            user_data_store[user_id] = user_data
+            await create_user_data(user_id)
             state_dict["current_question"] = "Hello! I'm your medical assistant. Could you please describe your symptoms or health concern in detail?"
         else:
             state_dict["current_question"] = "Welcome back! How are you feeling today? Please describe your current health concern in detail."
@@ -208,13 +1376,13 @@ def start_node(state):
         return state_dict
     
     # For responses to the greeting, perform the urgency assessment
-    return assess_initial_urgency(state)
+    return await assess_initial_urgency(state)
 
 # Modify the conversation flow to strictly follow the steps
 # Each function should only handle one step and not skip ahead
 
 # Update the symptom collection node - only ask about symptoms
-def collect_symptoms_handler(state):
+async def collect_symptoms_handler(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
@@ -222,7 +1390,7 @@ def collect_symptoms_handler(state):
     # Check if we have a valid response
     if user_response and user_response != "continue":
         # The response has already been validated, so we can extract symptoms
-        update_user_data(user_id, "symptoms", user_response)
+        await update_user_data(user_id, "symptoms", user_response)
     
     # Next question about previous doctor consultation
     state_dict["current_question"] = "Have you consulted a doctor about these symptoms before? If yes, what was their diagnosis?"
@@ -230,13 +1398,13 @@ def collect_symptoms_handler(state):
     return state_dict
 
 # Update the previous_history_handler to enforce complete answers
-def previous_history_handler(state):
+async def previous_history_handler(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
     
     # Always save the response, even if brief
-    update_user_data(user_id, "previous_history", user_response)
+    await update_user_data(user_id, "previous_history", user_response)
     
     # Extract any diagnosis information from the response
     has_consulted_doctor = False
@@ -279,9 +1447,9 @@ def previous_history_handler(state):
     
     # Continue with the conversation flow
     if has_consulted_doctor and extracted_diagnosis:
-        symptoms_text = ", ".join(get_user_data(user_id).symptoms)
+        symptoms_text = ", ".join((await get_user_data(user_id)).symptoms)
         similar_diagnosis_prompt = f"For a patient with symptoms {symptoms_text} and a previous diagnosis of {extracted_diagnosis}, suggest 2-3 similar or related possible diagnoses. Keep it brief."
-        similar_diagnosis = llm.invoke(similar_diagnosis_prompt)
+        similar_diagnosis = await llm.ainvoke(similar_diagnosis_prompt, family="similar_diagnosis")
         response = f"Thank you for sharing that information. Based on your previous diagnosis of {extracted_diagnosis}, some similar conditions could include: {similar_diagnosis.content}\n\nHave you taken any medications for this condition? If yes, what medications and did you experience any side effects?"
         state_dict["current_question"] = response
         state_dict["current_step"] = "medication_history"
@@ -297,18 +1465,17 @@ def previous_history_handler(state):
     return state_dict
 
 # Update the medication_history_handler with validation awareness
-def medication_history_handler(state):
+async def medication_history_handler(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
     
     # Validated response can be processed directly
-    update_user_data(user_id, "medication_history", user_response)
+    await update_user_data(user_id, "medication_history", user_response)
     
     # Extract validation details if available
-    user_data = get_user_data(user_id)
-    validation_details = next((item.get("validation_details") for item in reversed(user_data.history) 
-                              if "validation_details" in item), None)
+    user_data = await get_user_data(user_id)
+    validation_details = user_data.last_validation
     
     # Customize response based on medication information
     medications = []
@@ -325,18 +1492,17 @@ def medication_history_handler(state):
     return state_dict
 
 # Update the additional_symptoms_handler to immediately generate diagnosis
-def additional_symptoms_handler(state):
+async def additional_symptoms_handler(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
     
     # Save validated additional symptoms
-    update_user_data(user_id, "additional_symptoms", user_response)
+    await update_user_data(user_id, "additional_symptoms", user_response)
     
     # Get validation details
-    user_data = get_user_data(user_id)
-    validation_details = next((item.get("validation_details") for item in reversed(user_data.history) 
-                              if "validation_details" in item), None)
+    user_data = await get_user_data(user_id)
+    validation_details = user_data.last_validation
     
     has_additional_symptoms = False
     additional_symptoms = []
@@ -354,7 +1520,7 @@ def additional_symptoms_handler(state):
         intermediate_message = "Thank you for this information. I'll now analyze your symptoms and provide a preliminary diagnosis."
     
     # Store this intermediate message, but DON'T return it - we'll generate the diagnosis right away
-    update_user_data(user_id, "intermediate_message", intermediate_message)
+    await update_user_data(user_id, "intermediate_message", intermediate_message)
     
     # Generate diagnosis immediately without requiring another user input
     symptoms_text = ", ".join(user_data.symptoms)
@@ -377,58 +1543,16 @@ def additional_symptoms_handler(state):
     Use bullet points (•) for main points and sub-bullets (-) for details.
     """
     
-    diagnosis = llm.invoke(diagnosis_prompt)
-    update_user_data(user_id, "diagnosis", diagnosis.content)
+    diagnosis = await stream_llm(diagnosis_prompt, family="diagnosis")
+    await update_user_data(user_id, "diagnosis", diagnosis.content)
     
     # Set the diagnosis as the current question and move to criticality step
     state_dict["current_question"] = diagnosis.content
     state_dict["current_step"] = "criticality"
     return state_dict
 
-# Update the diagnosis_prep_handler function to create better formatted output
-def diagnosis_prep_handler(state):
-    state_dict = ensure_dict(state)
-    user_id = state_dict["user_id"]
-    
-    # Initialize custom_context if not present
-    if "custom_context" not in state_dict:
-        state_dict["custom_context"] = {}
-    
-    # Create a local variable for easier access
-    custom_context = state_dict["custom_context"]
-    
-    # Get user data
-    user_data = get_user_data(user_id)
-    
-    # Check for critical health conditions first
-    has_asthma = False
-    lost_inhaler = False
-    breathing_issues = False
-    
-    for item in user_data.history:
-        for key, value in item.items():
-            if isinstance(value, str):
-                if "asthma" in value.lower():
-                    has_asthma = True
-                if "lost" in value.lower() and "inhaler" in value.lower():
-                    lost_inhaler = True
-                if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
-                    breathing_issues = True
-    
-    # Extract all user inputs to create a comprehensive patient history
-    all_inputs = []
-    for item in user_data.history:
-        for key, value in item.items():
-            # Only include user responses, not system messages or questions
-            if key in ["symptoms", "previous_history", "medication_history", "additional_symptoms", "response"]:
-                if isinstance(value, str) and len(value) > 3 and "continue" not in value.lower():
-                    all_inputs.append(value)
-    
-    # Create a comprehensive patient description
-    patient_description = "\n".join(all_inputs)
-    
-    # Enhanced diagnosis prompt that focuses on relevant conditions
-    diagnosis_prompt = f"""
+# Prompt templates filled by build_prompt
+DIAGNOSIS_PROMPT = """
     You are a medical AI assistant providing a preliminary analysis of a patient's symptoms.
     Based on the following patient description, provide a focused, relevant diagnosis:
     
@@ -455,9 +1579,78 @@ def diagnosis_prep_handler(state):
     
     DO NOT include generic advice that isn't directly related to the patient's specific symptoms.
     """
+
+URGENT_STEPS_PROMPT = """
+    Based on this patient's information:
+    
+    {patient_description}
+    
+    Provide 4 SPECIFIC emergency first aid steps that are directly relevant to their condition.
+    These should be clear, actionable instructions that address their urgent medical situation.
+    
+    Format your response as 4 numbered steps, each being a concise, direct instruction.
+    """
+
+SUMMARY_PROMPT = """Generate a concise, professional medical case summary for a doctor based on the following patient information:
+    
+    Presenting Symptoms: {symptoms}
+    Medical History: {previous_history}
+    Medication History: {medication_history}
+    Additional Symptoms: {additional_symptoms}
+    Preliminary Diagnosis: {diagnosis}
+    Urgency Assessment: {urgency}
+    
+    Additional Extracted Details: {extracted_details}
+    
+    Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
+    """
+
+# Case summary prompt; the diagnosis and extracted details give way first when the conversation is long
+def build_summary_prompt(user_data):
+    extracted_details = {}
+    
+    for validation in user_data.history.iter_details():
+        if "extracted_symptoms" in validation:
+            extracted_details["symptoms"] = validation["extracted_symptoms"]
+        if "extracted_diagnosis" in validation:
+            extracted_details["diagnosis"] = validation["extracted_diagnosis"]
+        if "medications" in validation:
+            extracted_details["medications"] = validation["medications"]
+        if "side_effects" in validation:
+            extracted_details["side_effects"] = validation["side_effects"]
+    
+    return build_prompt(
+        "summary",
+        SUMMARY_PROMPT,
+        symptoms=PromptSection(user_data.symptoms, priority=5, separator=", "),
+        urgency=PromptSection("Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended", priority=5),
+        previous_history=PromptSection(user_data.previous_history, priority=4, keep="head"),
+        medication_history=PromptSection(user_data.medication_history, priority=4, keep="head"),
+        additional_symptoms=PromptSection(user_data.additional_symptoms, priority=3, keep="head"),
+        diagnosis=PromptSection(user_data.diagnosis, priority=2, keep="head"),
+        extracted_details=PromptSection([f"{key}: {value}" for key, value in extracted_details.items()], priority=1, separator="; ")
+    )
+
+# Update the diagnosis_prep_handler function to create better formatted output
+async def diagnosis_prep_handler(state):
+    state_dict = ensure_dict(state)
+    user_id = state_dict["user_id"]
+    
+    # Initialize custom_context if not present
+    if "custom_context" not in state_dict:
+        state_dict["custom_context"] = {}
+    
+    # Create a local variable for easier access
+    custom_context = state_dict["custom_context"]
+    
+    # Get user data
+    user_data = await get_user_data(user_id)
     
-    diagnosis = llm.invoke(diagnosis_prompt)
-    update_user_data(user_id, "diagnosis", diagnosis.content)
+    # Enhanced diagnosis prompt that focuses on relevant conditions, built from the user's own answers
+    diagnosis_prompt = build_prompt("diagnosis", DIAGNOSIS_PROMPT, patient_description=user_data.profile.diagnosis_description)
+    
+    diagnosis = await stream_llm(diagnosis_prompt, family="diagnosis")
+    await update_user_data(user_id, "diagnosis", diagnosis.content)
     
     # Format the diagnosis as HTML for better presentation
     diagnosis_text = diagnosis.content.strip()
@@ -512,10 +1705,10 @@ def diagnosis_prep_handler(state):
     return state_dict
 
 # Update the generate_diagnosis function with the same improved format
-def generate_diagnosis(state):
+async def generate_diagnosis(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
-    user_data = get_user_data(user_id)
+    user_data = await get_user_data(user_id)
     
     # Generate diagnosis
     symptoms_text = ", ".join(user_data.symptoms)
@@ -559,8 +1752,8 @@ def generate_diagnosis(state):
     - Asthma attack: Use rescue inhaler, sit upright, seek help if not improving
     """
     
-    diagnosis = llm.invoke(diagnosis_prompt)
-    update_user_data(user_id, "diagnosis", diagnosis.content)
+    diagnosis = await stream_llm(diagnosis_prompt, family="diagnosis")
+    await update_user_data(user_id, "diagnosis", diagnosis.content)
     
     # Format the diagnosis as HTML
     formatted_html = f"""<div class="diagnosis-card">
@@ -585,10 +1778,10 @@ def generate_diagnosis(state):
     return state_dict
 
 # Criticality assessment with improved formatting
-def assess_criticality(state):
+async def assess_criticality(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
-    user_data = get_user_data(user_id)
+    user_data = await get_user_data(user_id)
     
     symptoms_text = ", ".join(user_data.symptoms)
     prev_history = user_data.previous_history
@@ -606,13 +1799,18 @@ def assess_criticality(state):
     Answer with ONLY 'YES' or 'NO'.
     """
     
-    urgency_response = llm.invoke(urgency_check_prompt).strip().upper()
+    if MERGED_TRIAGE:
+        merged = await assess_criticality_merged(user_id, state_dict, symptoms_text, prev_history, med_history, diagnosis)
+        if merged is not None:
+            return merged
+    
+    urgency_response = (await llm.ainvoke(urgency_check_prompt, family="criticality_check")).content.strip().upper()
     
     if urgency_response == 'YES':
         print("Detected urgent medical situation, routing to urgent follow-up handler")
         state_dict["urgency_level"] = "urgent"
-        update_user_state(user_id, state_dict)
-        return urgent_follow_up_handler(state_dict)
+        await update_user_state(user_id, state_dict)
+        return await urgent_follow_up_handler(state_dict)
     
     criticality_prompt = f"""Based on the following patient information:
     
@@ -640,62 +1838,72 @@ def assess_criticality(state):
     [A brief medical disclaimer that this is not a substitute for professional care]
     """
     
-    assessment = llm.invoke(criticality_prompt)
+    assessment = await stream_llm(criticality_prompt, family="criticality")
     assessment_text = assessment.content
     
     is_critical = "URGENT" in assessment_text
-    update_user_data(user_id, "critical", "yes" if is_critical else "no")
+    await update_user_data(user_id, "critical", "yes" if is_critical else "no")
     
     state_dict["current_question"] = assessment_text
     state_dict["current_step"] = "end"
     return state_dict
 
-# Add a new handler for generating summary
-def generate_summary(state):
-    state_dict = ensure_dict(state)
-    user_id = state_dict["user_id"]
-    user_data = get_user_data(user_id)
+# Urgency check and full assessment in one structured call; None if the reply is unusable
+async def assess_criticality_merged(user_id, state_dict, symptoms_text, prev_history, med_history, diagnosis):
+    criticality_prompt = f"""Based on the following patient information:
     
-    if not user_data or not user_data.symptoms:
-        return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
+    Symptoms: {symptoms_text}
+    Previous Medical History: {prev_history}
+    Medication History: {med_history}
+    Diagnosis: {diagnosis}
     
-    # Create a professional medical summary for doctors
-    symptoms_text = ", ".join(user_data.symptoms)
+    Decide whether this is potentially an urgent medical situation requiring immediate attention,
+    and provide a clear assessment of urgency and recommendations.
     
-    # Extract validation details for more accurate summary
-    history_with_validation = [item for item in user_data.history if "validation_details" in item]
-    extracted_details = {}
+    Format your response as JSON:
+    {{
+        "is_urgent": true/false,
+        "urgency_level": "URGENT/PROMPT/ROUTINE",
+        "timeframe": "when the patient should see a doctor: immediately, within 24 hours, within a week, or at their convenience",
+        "precautions": ["precaution1", "precaution2", "precaution3"],
+        "disclaimer": "a brief medical disclaimer that this is not a substitute for professional care"
+    }}
+    """
     
-    for entry in history_with_validation:
-        validation = entry.get("validation_details", {})
-        if "extracted_symptoms" in validation:
-            extracted_details["symptoms"] = validation["extracted_symptoms"]
-        if "extracted_diagnosis" in validation:
-            extracted_details["diagnosis"] = validation["extracted_diagnosis"]
-        if "medications" in validation:
-            extracted_details["medications"] = validation["medications"]
-        if "side_effects" in validation:
-            extracted_details["side_effects"] = validation["side_effects"]
+    assessment = await structured_llm(criticality_prompt, CriticalityAssessment, family="criticality")
+    if assessment is None:
+        return None
+    
+    if assessment.is_urgent:
+        print("Detected urgent medical situation, routing to urgent follow-up handler")
+        state_dict["urgency_level"] = "urgent"
+        await update_user_state(user_id, state_dict)
+        return await urgent_follow_up_handler(state_dict)
     
-    summary_prompt = f"""Generate a concise, professional medical case summary for a doctor based on the following patient information:
+    is_critical = assessment.urgency_level == "URGENT"
+    await update_user_data(user_id, "critical", "yes" if is_critical else "no")
     
-    Presenting Symptoms: {symptoms_text}
-    Medical History: {user_data.previous_history}
-    Medication History: {user_data.medication_history}
-    Additional Symptoms: {user_data.additional_symptoms}
-    Preliminary Diagnosis: {user_data.diagnosis}
-    Urgency Assessment: {"Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended"}
+    state_dict["current_question"] = assessment.to_markdown()
+    state_dict["current_step"] = "end"
+    return state_dict
+
+# Add a new handler for generating summary
+async def generate_summary(state):
+    state_dict = ensure_dict(state)
+    user_id = state_dict["user_id"]
+    user_data = await get_user_data(user_id)
     
-    Additional Extracted Details: {extracted_details}
+    if not user_data or not user_data.symptoms:
+        return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
     
-    Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
-    """
+    # Create a professional medical summary for doctors
+    summary_prompt = build_summary_prompt(user_data)
     
-    summary = llm.invoke(summary_prompt)
+    summary = await llm.ainvoke(summary_prompt, family="summary")
     return {"summary": f"## Medical Case Summary\n\n{summary.content}"}
 
 # Update function to specifically handle accidents
-def assess_initial_urgency(state):
+async def assess_initial_urgency(state):
     state_dict = ensure_dict(state)
     
     # Make sure custom_context is initialized
@@ -705,9 +1913,10 @@ def assess_initial_urgency(state):
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
     
+    keyword_hits = triage_matcher.scan(user_response)
+    
     # ACCIDENT DETECTION: Explicitly check for accident-related phrases
-    accident_keywords = ["accident", "crash", "fell", "injured", "hit", "collision", "car accident"]
-    if any(keyword in user_response.lower() for keyword in accident_keywords):
+    if "accident" in keyword_hits:
         # Set high urgency for accidents
         state_dict["urgency_level"] = "urgent"
         state_dict["custom_path"] = "injury_assessment"
@@ -718,8 +1927,8 @@ def assess_initial_urgency(state):
         }
         
         # Store the accident information
-        update_user_data(user_id, "accident_info", user_response)
-        update_user_data(user_id, "symptoms", "accident injury")
+        await update_user_data(user_id, "accident_info", user_response)
+        await update_user_data(user_id, "symptoms", "accident injury")
         
         # Generate specific questions for accidents
         accident_prompt = f"""
@@ -734,7 +1943,7 @@ def assess_initial_urgency(state):
         Format as 2-3 clear questions that assess the urgency of their injuries.
         """
         
-        accident_questions = llm.invoke(accident_prompt)
+        accident_questions = await llm.ainvoke(accident_prompt, family="accident_questions")
         
         # Format the emergency message with bold numbered points
         state_dict["current_question"] = f"""<div class="urgent-message">
@@ -752,8 +1961,7 @@ def assess_initial_urgency(state):
         return state_dict
     
     # Check for known chronic conditions first
-    chronic_conditions = ["diabetes", "diabetic", "hypertension", "asthma", "copd", "arthritis", "thyroid"]
-    mentioned_conditions = [c for c in chronic_conditions if c in user_response.lower()]
+    mentioned_conditions = keyword_hits.get("chronic_condition", [])
     
     if mentioned_conditions:
         # Create a customized follow-up for chronic conditions
@@ -769,8 +1977,8 @@ def assess_initial_urgency(state):
         }
         
         # Store condition in user data
-        update_user_data(user_id, "medical_condition", condition)
-        update_user_data(user_id, "symptoms", condition)
+        await update_user_data(user_id, "medical_condition", condition)
+        await update_user_data(user_id, "symptoms", condition)
         
         # Generate condition-specific follow-up
         condition_questions = {
@@ -813,36 +2021,22 @@ def assess_initial_urgency(state):
     }}
     """
     
-    urgency_assessment = llm.invoke(urgency_prompt)
-    
-    # Extract JSON from the response
-    import json
-    import re
-    
-    json_pattern = r'\{.*\}'
-    json_match = re.search(json_pattern, urgency_assessment.content, re.DOTALL)
+    # Merged mode also asks for the follow-up, saving the second round trip below
+    triage = None
+    if MERGED_TRIAGE:
+        triage_prompt = f"""{urgency_prompt}
+    In the same JSON object, also include:
+    - "next_question": for PROMPT or ROUTINE cases, the most relevant next question to ask the patient,
+      tailored to their specific situation (e.g. for diarrhea, ask about recent food consumption and travel)
+    - "first_aid_steps": for URGENT cases, the 4 most critical first aid steps to take immediately
+    """
+        triage = await structured_llm(triage_prompt, TriageAssessment, family="triage")
     
-    if json_match:
-        try:
-            assessment = json.loads(json_match.group())
-        except:
-            # Default assessment if JSON parsing fails
-            assessment = {
-                "urgency_level": "ROUTINE",
-                "category": "general",
-                "reasoning": "Unable to determine urgency from description",
-                "key_symptoms": [],
-                "recommended_questions": []
-            }
-    else:
-        # Default assessment if JSON parsing fails
-        assessment = {
-            "urgency_level": "ROUTINE",
-            "category": "general",
-            "reasoning": "Unable to determine urgency from description",
-            "key_symptoms": [],
-            "recommended_questions": []
-        }
+    assessment = triage or await structured_llm(urgency_prompt, UrgencyAssessment, family="urgency")
+    if assessment is None:
+        # Default assessment if the reply could not be parsed
+        assessment = UrgencyAssessment(urgency_level="ROUTINE", reasoning="Unable to determine urgency from description")
+    assessment = assessment.dict(include=set(UrgencyAssessment.__fields__))
     
     # Update the state with urgency assessment
     state_dict["urgency_level"] = assessment["urgency_level"].lower()
@@ -853,10 +2047,12 @@ def assess_initial_urgency(state):
     }
     
     # Store the assessment in user data
-    update_user_data(user_id, "urgency_assessment", json.dumps(assessment))
+    await update_user_data(user_id, "urgency_assessment", json.dumps(assessment))
     
     # For URGENT cases, create a simpler message without relying on markdown
-    if assessment.get("urgency_level") == "URGENT":
+    if assessment.get("urgency_level") == "URGENT" and triage and triage.first_aid_steps:
+        urgent_advice = "\n".join(f"{number}. {step}" for number, step in enumerate(triage.first_aid_steps[:4], 1))
+    elif assessment.get("urgency_level") == "URGENT":
         urgent_advice_prompt = f"""
         The patient has described: "{user_response}"
         
@@ -871,13 +2067,14 @@ def assess_initial_urgency(state):
         4. Final immediate instruction
         """
         
-        urgent_advice = llm.invoke(urgent_advice_prompt)
-        
+        urgent_advice = (await llm.ainvoke(urgent_advice_prompt, family="urgent_advice")).content
+    
+    if assessment.get("urgency_level") == "URGENT":
         # Format the emergency message with the entire advice content
         state_dict["current_question"] = f"""<div class="urgent-message">
 <div class="urgent-header">⚠️ URGENT MEDICAL GUIDANCE ⚠️</div>
 <div class="urgent-content">
-  {urgent_advice.content}
+  {urgent_advice}
 </div>
 <div class="urgent-footer">If this is life-threatening, stop using this app and call emergency services (911) immediately.</div>
 </div>"""
@@ -886,27 +2083,13 @@ def assess_initial_urgency(state):
         return state_dict
     
     # For less urgent cases, generate dynamic personalized questions
-    next_questions_prompt = f"""
-    The patient has described: "{user_response}"
-    
-    Based on this information and the medical category identified ({assessment.get("category", "general")}),
-    generate the most relevant next question to ask.
-    
-    Consider:
-    1. The specific symptoms described ({', '.join(assessment.get("key_symptoms", []))})
-    2. The urgency level ({assessment.get("urgency_level", "ROUTINE")})
-    3. What additional information would help most with diagnosis
-    
-    Your question should be tailored to the specific medical situation, not generic.
-    For example, if they mentioned diarrhea, ask about recent food consumption and travel.
-    
-    Format your response as a direct question to the patient.
-    """
-    
-    next_question = llm.invoke(next_questions_prompt)
+    if triage and triage.next_question:
+        next_question = triage.next_question
+    else:
+        next_question = await generate_next_question(user_response, assessment)
     
     # Set dynamic question and create a custom conversation path
-    state_dict["current_question"] = next_question.content
+    state_dict["current_question"] = next_question
     
     # Choose appropriate next step based on category
     category_to_path = {
@@ -928,8 +2111,29 @@ def assess_initial_urgency(state):
     
     return state_dict
 
+async def generate_next_question(user_response, assessment):
+    next_questions_prompt = f"""
+    The patient has described: "{user_response}"
+    
+    Based on this information and the medical category identified ({assessment.get("category", "general")}),
+    generate the most relevant next question to ask.
+    
+    Consider:
+    1. The specific symptoms described ({', '.join(assessment.get("key_symptoms", []))})
+    2. The urgency level ({assessment.get("urgency_level", "ROUTINE")})
+    3. What additional information would help most with diagnosis
+    
+    Your question should be tailored to the specific medical situation, not generic.
+    For example, if they mentioned diarrhea, ask about recent food consumption and travel.
+    
+    Format your response as a direct question to the patient.
+    """
+    
+    next_question = await llm.ainvoke(next_questions_prompt, family="next_question")
+    return next_question.content
+
 # Add a generic dynamic follow-up question handler
-def dynamic_follow_up_handler(state):
+async def dynamic_follow_up_handler(state):
     state_dict = ensure_dict(state)
     
     # Make sure custom_context is initialized
@@ -942,7 +2146,7 @@ def dynamic_follow_up_handler(state):
     current_step = state_dict.get("current_step", "dynamic_symptoms")
     
     # Save the user's response in the appropriate category
-    update_user_data(user_id, current_step, user_response)
+    await update_user_data(user_id, current_step, user_response)
     
     # Update context with new information
     current_context["last_response"] = user_response
@@ -961,18 +2165,13 @@ def dynamic_follow_up_handler(state):
         return state_dict
     
     # Get all previous responses to build context
-    user_data = get_user_data(user_id)
-    conversation_history = [
-        f"Patient: {item.get(key, '')}" 
-        for item in user_data.history 
-        for key in item 
-        if key not in ["current_question", "current_step", "validation", "validation_details"]
-    ]
+    user_data = await get_user_data(user_id)
+    conversation_history = user_data.profile.recent_conversation
     
     # Create a prompt for generating the next question based on all previous information
     next_question_prompt = f"""
     Patient history:
-    {conversation_history[-5:] if len(conversation_history) > 5 else conversation_history}
+    {conversation_history}
     
     Latest response: "{user_response}"
     
@@ -1001,33 +2200,15 @@ def dynamic_follow_up_handler(state):
     }}
     """
     
-    response = llm.invoke(next_question_prompt)
-    
-    # Extract JSON from the response
-    import json
-    import re
-    
-    json_pattern = r'\{.*\}'
-    json_match = re.search(json_pattern, response.content, re.DOTALL)
-    
-    if json_match:
-        try:
-            follow_up = json.loads(json_match.group())
-        except:
-            follow_up = {
-                "next_question": "Could you tell me more about your symptoms?",
-                "move_to_diagnosis": False,
-                "reasoning": "Could not determine validity",
-                "additional_context": {}
-            }
-    else:
-        # Default if JSON parsing fails
-        follow_up = {
-            "next_question": "Could you tell me more about your symptoms?",
-            "move_to_diagnosis": False,
-            "reasoning": "Could not determine validity",
-            "additional_context": {}
-        }
+    follow_up = await structured_llm(next_question_prompt, FollowUpPlan, family="follow_up")
+    if follow_up is None:
+        # Default if the reply could not be parsed
+        follow_up = FollowUpPlan(
+            next_question="Could you tell me more about your symptoms?",
+            move_to_diagnosis=False,
+            reasoning="Could not determine validity"
+        )
+    follow_up = follow_up.dict()
     
     # Update context with new information
     if "additional_context" in follow_up and follow_up["additional_context"]:
@@ -1042,10 +2223,10 @@ def dynamic_follow_up_handler(state):
         state_dict["current_step"] = "diagnosis_prep"
     else:
         # Continue with dynamic questioning
-        state_dict["current_question"] = follow_up["next_question"]
+        state_dict["current_question"] = follow_up["next_question"] or "Could you tell me more about your symptoms?"
         
         # Determine if we should change the path based on new information
-        if "path_update" in follow_up:
+        if follow_up.get("path_update"):
             state_dict["custom_path"] = follow_up["path_update"]
             state_dict["current_step"] = follow_up["path_update"]
         else:
@@ -1055,40 +2236,20 @@ def dynamic_follow_up_handler(state):
     return state_dict
 
 # Add handlers for urgent situations
-def urgent_follow_up_handler(state):
+async def urgent_follow_up_handler(state):
     state_dict = ensure_dict(state)
     user_id = state_dict["user_id"]
     user_response = state_dict.get("response", "")
     
-    update_user_data(user_id, "urgent_follow_up", user_response)
+    await update_user_data(user_id, "urgent_follow_up", user_response)
     
     # Get user data to provide context
-    user_data = get_user_data(user_id)
-    
-    # Extract all relevant inputs to understand the patient's situation
-    all_inputs = []
-    for item in user_data.history:
-        for key, value in item.items():
-            if key in ["symptoms", "previous_history", "medication_history", "additional_symptoms", "response"]:
-                if isinstance(value, str) and len(value) > 3:
-                    all_inputs.append(value)
-    
-    # Create a comprehensive patient description
-    patient_description = "\n".join(all_inputs)
+    user_data = await get_user_data(user_id)
     
-    # Generate urgency-specific prompt based on the actual medical situation
-    prompt = f"""
-    Based on this patient's information:
+    # Urgency-specific prompt from the comprehensive patient description built from all relevant inputs
+    prompt = build_prompt("urgent_steps", URGENT_STEPS_PROMPT, patient_description=user_data.profile.urgent_description)
     
-    {patient_description}
-    
-    Provide 4 SPECIFIC emergency first aid steps that are directly relevant to their condition.
-    These should be clear, actionable instructions that address their urgent medical situation.
-    
-    Format your response as 4 numbered steps, each being a concise, direct instruction.
-    """
-    
-    urgent_advice = llm.invoke(prompt)
+    urgent_advice = await llm.ainvoke(prompt, family="urgent_steps")
     
     # Parse the response to extract specific steps
     advice_text = urgent_advice.content
@@ -1102,7 +2263,6 @@ def urgent_follow_up_handler(state):
     ]
     
     # Try to extract numbered steps
-    import re
     numbered_steps = re.findall(r'\d+\.\s*(.*?)(?=\d+\.|$)', advice_text, re.DOTALL)
     
     # Use extracted steps if available, otherwise use defaults
@@ -1127,76 +2287,234 @@ def urgent_follow_up_handler(state):
     state_dict["current_step"] = "emergency_services"
     return state_dict
 
-# Define the graph with updated nodes and flow
+# Conversation nodes. Each /chat turn runs exactly one of them: route_turn picks it from
+# the thread's state, and the node records the answer and asks the next question.
+CHAT_NODES = {
+    "start": start_node,
+    "collect_symptoms": collect_symptoms_handler,
+    "prev_history_node": previous_history_handler,
+    "med_history_node": medication_history_handler,
+    "additional_symptoms_node": additional_symptoms_handler,
+    "diagnosis_prep": diagnosis_prep_handler,
+    "diagnosis_node": generate_diagnosis,
+    "criticality_node": assess_criticality,
+    "summary_node": generate_summary,
+    # Dynamic, category-specific paths
+    "initial_assessment": assess_initial_urgency,
+    "dynamic_symptoms": dynamic_follow_up_handler,
+    "injury_assessment": dynamic_follow_up_handler,
+    "infection_assessment": dynamic_follow_up_handler,
+    "digestive_assessment": dynamic_follow_up_handler,
+    "respiratory_assessment": dynamic_follow_up_handler,
+    "chronic_condition": dynamic_follow_up_handler,
+    # Urgent situations
+    "urgent_follow_up": urgent_follow_up_handler,
+    "emergency_services": urgent_follow_up_handler
+}
+
+# Graph node that handles a step name from determine_next_step
+def node_for_step(step_name):
+    if "_continued_continued" in step_name:
+        print(f"Detected nested continuations in {step_name}, forcing diagnosis")
+        return "diagnosis_prep"
+    if step_name not in CHAT_NODES:
+        print(f"Warning: Unknown step requested: {step_name}")
+        return "start"
+    return step_name
+
+def route_turn(state):
+    return node_for_step(determine_next_step(ensure_dict(state)))
+
 graph = StateGraph(state_schema=ChatState)
+for node_name, handler in CHAT_NODES.items():
+    graph.add_node(node_name, handler)
+    graph.add_edge(node_name, END)
+graph.add_conditional_edges(START, route_turn, {node_name: node_name for node_name in CHAT_NODES})
+
+# Checkpointer holding each user's conversation thread: "memory", "sqlite" or "mongo"
+CHAT_CHECKPOINTER = os.getenv("CHAT_CHECKPOINTER", "memory")
+CHAT_CHECKPOINT_SQLITE_PATH = os.getenv("CHAT_CHECKPOINT_SQLITE_PATH", "chat_checkpoints.sqlite")
+CHAT_THREAD_MAX_COUNT = int(os.getenv("CHAT_THREAD_MAX_COUNT", str(SESSION_MAX_COUNT)))
+CHAT_CHECKPOINT_PRUNE_BATCH = int(os.getenv("CHAT_CHECKPOINT_PRUNE_BATCH", "16"))
+checkpointer_stack = AsyncExitStack()
+
+# Checkpointer that keeps only the latest checkpoint of each thread, and at most
+# max_threads threads (the least recently written one is dropped first). Each thread
+# lives in its own MemorySaver, which a put replaces with one holding just the new
+# checkpoint, so nothing is ever deleted from a saver's storage.
+class BoundedMemorySaver(BaseCheckpointSaver):
+    def __init__(self, max_threads=CHAT_THREAD_MAX_COUNT):
+        super().__init__()
+        self.max_threads = max_threads
+        self.threads = OrderedDict()  # thread_id -> MemorySaver holding its latest checkpoint
+    
+    def get_tuple(self, config):
+        saver = self.threads.get(config["configurable"]["thread_id"])
+        return saver.get_tuple(config) if saver else None
+    
+    def list(self, config, *, filter=None, before=None, limit=None):
+        if config is None:
+            savers = list(self.threads.values())
+        else:
+            saver = self.threads.get(config["configurable"]["thread_id"])
+            savers = [saver] if saver else []
+        for saver in savers:
+            yield from saver.list(config, filter=filter, before=before, limit=limit)
+    
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        saver = MemorySaver(serde=self.serde)
+        # Store every channel's value, not just the new ones: the older values went with the old saver
+        result = saver.put(config, checkpoint, metadata, checkpoint["channel_versions"])
+        self.threads[thread_id] = saver
+        self.threads.move_to_end(thread_id)
+        
+        while len(self.threads) > self.max_threads:
+            self.threads.popitem(last=False)
+            perf_metrics.incr("chat_threads.evicted")
+        return result
+    
+    def put_writes(self, config, writes, task_id, task_path=""):
+        saver = self.threads.get(config["configurable"]["thread_id"])
+        if saver:
+            saver.put_writes(config, writes, task_id, task_path)
+    
+    def delete_thread(self, thread_id):
+        self.threads.pop(thread_id, None)
+    
+    def get_next_version(self, current, channel):
+        return MemorySaver.get_next_version(self, current, channel)
+    
+    async def aget_tuple(self, config):
+        return self.get_tuple(config)
+    
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+    
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return self.put(config, checkpoint, metadata, new_versions)
+    
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        self.put_writes(config, writes, task_id, task_path)
+    
+    async def adelete_thread(self, thread_id):
+        self.delete_thread(thread_id)
+
+async def open_checkpointer():
+    if CHAT_CHECKPOINTER == "sqlite":
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        return await checkpointer_stack.enter_async_context(AsyncSqliteSaver.from_conn_string(CHAT_CHECKPOINT_SQLITE_PATH))
+    if CHAT_CHECKPOINTER == "mongo":
+        from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
+        return await checkpointer_stack.enter_async_context(
+            AsyncMongoDBSaver.from_conn_string(repository.MONGODB_URI, db_name="medbot_db")
+        )
+    return BoundedMemorySaver()
+
+# Compile Graph (recompiled at startup once the configured checkpointer is open)
+chatbot = graph.compile(checkpointer=BoundedMemorySaver())
+
+@app.on_event("startup")
+async def compile_chatbot():
+    global chatbot
+    chatbot = graph.compile(checkpointer=await open_checkpointer())
 
-# Define nodes with dynamic capabilities
-graph.add_node("start", start_node)
-graph.add_node("collect_symptoms", collect_symptoms_handler)
-graph.add_node("prev_history_node", previous_history_handler)
-graph.add_node("med_history_node", medication_history_handler)
-graph.add_node("additional_symptoms_node", additional_symptoms_handler)
-graph.add_node("diagnosis_prep", diagnosis_prep_handler)
-graph.add_node("diagnosis_node", generate_diagnosis)
-graph.add_node("criticality_node", assess_criticality)
-graph.add_node("summary_node", generate_summary)
-
-# Add new dynamic nodes
-graph.add_node("initial_assessment", assess_initial_urgency)
-graph.add_node("dynamic_symptoms", dynamic_follow_up_handler)
-graph.add_node("injury_assessment", dynamic_follow_up_handler)
-graph.add_node("infection_assessment", dynamic_follow_up_handler)
-graph.add_node("digestive_assessment", dynamic_follow_up_handler)
-graph.add_node("respiratory_assessment", dynamic_follow_up_handler)
-graph.add_node("chronic_condition", dynamic_follow_up_handler)
-graph.add_node("urgent_follow_up", urgent_follow_up_handler)
-graph.add_node("emergency_services", urgent_follow_up_handler)
-
-# Connect nodes with flexible flow
-graph.add_edge(START, "start")
-graph.add_edge("start", "initial_assessment")
-
-# Connect initial assessment to different paths
-graph.add_edge("initial_assessment", "dynamic_symptoms")
-graph.add_edge("initial_assessment", "injury_assessment")
-graph.add_edge("initial_assessment", "infection_assessment")
-graph.add_edge("initial_assessment", "digestive_assessment")
-graph.add_edge("initial_assessment", "respiratory_assessment")
-graph.add_edge("initial_assessment", "chronic_condition")
-graph.add_edge("initial_assessment", "urgent_follow_up")
-
-# Connect dynamic symptom collectors to themselves for continuation
-graph.add_edge("dynamic_symptoms", "dynamic_symptoms")
-graph.add_edge("injury_assessment", "injury_assessment")
-graph.add_edge("infection_assessment", "infection_assessment")
-graph.add_edge("digestive_assessment", "digestive_assessment")
-graph.add_edge("respiratory_assessment", "respiratory_assessment")
-graph.add_edge("chronic_condition", "chronic_condition")
-
-# Connect urgent paths
-graph.add_edge("urgent_follow_up", "emergency_services")
-graph.add_edge("emergency_services", "emergency_services")
-
-# Connect all paths to diagnosis
-graph.add_edge("dynamic_symptoms", "diagnosis_prep")
-graph.add_edge("injury_assessment", "diagnosis_prep") 
-graph.add_edge("infection_assessment", "diagnosis_prep")
-graph.add_edge("digestive_assessment", "diagnosis_prep")
-graph.add_edge("respiratory_assessment", "diagnosis_prep")
-graph.add_edge("chronic_condition", "diagnosis_prep")
-graph.add_edge("urgent_follow_up", "diagnosis_prep")
-graph.add_edge("emergency_services", "diagnosis_prep")
-
-# Connect original nodes for backward compatibility
-graph.add_edge("collect_symptoms", "prev_history_node")
-graph.add_edge("prev_history_node", "med_history_node")
-graph.add_edge("med_history_node", "additional_symptoms_node")
-graph.add_edge("additional_symptoms_node", "diagnosis_prep")
-graph.add_edge("diagnosis_prep", "diagnosis_node")
-graph.add_edge("diagnosis_node", "criticality_node")
-
-# Compile Graph
-chatbot = graph.compile()
+@app.on_event("shutdown")
+async def close_checkpointer():
+    await checkpointer_stack.aclose()
+
+def chat_thread_config(user_id):
+    return {"configurable": {"thread_id": user_id}}
+
+# Thread state as checkpointed, plus the cursor fields to seed it with when the
+# checkpointer has nothing for this user yet (e.g. the in-memory one after a restart)
+async def load_chat_thread(user_id, user):
+    snapshot = await chatbot.aget_state(chat_thread_config(user_id))
+    if snapshot.values:
+        return dict(snapshot.values), {}
+    if user is None:
+        return {}, {}
+    seed = {"current_step": user.current_step or "start", "current_question": user.current_question}
+    return seed, seed
+
+# Run one conversation turn through the graph and return the thread's new state
+async def run_graph_turn(user_id, turn_input):
+    # custom_path only steers the node that sets it; between turns routing follows current_step
+    result = await chatbot.ainvoke({"user_id": user_id, **turn_input, "custom_path": None}, chat_thread_config(user_id))
+    await compact_chat_thread(user_id)
+    return result if isinstance(result, dict) else ensure_dict(result)
+
+# Move the conversation outside a graph run, keeping the session and the thread in step
+async def set_conversation_cursor(user_id, question, step, as_node):
+    await update_user_data(user_id, "current_question", question)
+    await update_user_data(user_id, "current_step", step)
+    await chatbot.aupdate_state(
+        chat_thread_config(user_id),
+        {"user_id": user_id, "current_question": question, "current_step": step},
+        as_node=as_node
+    )
+    await compact_chat_thread(user_id)
+
+# Each turn writes several checkpoints, but only the latest one is ever read back.
+# BoundedMemorySaver keeps just that one; for the other checkpointers the ones it
+# superseded are deleted with their pending writes, at most CHAT_CHECKPOINT_PRUNE_BATCH
+# per call. The checkpointer interface only deletes whole threads, so this goes to the
+# sqlite and mongo savers' own tables.
+async def compact_chat_thread(user_id):
+    checkpointer = chatbot.checkpointer
+    if isinstance(checkpointer, BoundedMemorySaver):
+        return
+    if hasattr(checkpointer, "checkpoint_collection"):
+        await prune_mongo_checkpoints(checkpointer, user_id)
+    else:
+        await prune_sqlite_checkpoints(checkpointer, user_id)
+
+async def prune_mongo_checkpoints(checkpointer, thread_id):
+    superseded = checkpointer.checkpoint_collection.find(
+        {"thread_id": thread_id, "checkpoint_ns": ""}, {"checkpoint_id": 1, "_id": 0}
+    ).sort("checkpoint_id", -1).skip(1).limit(CHAT_CHECKPOINT_PRUNE_BATCH)
+    checkpoint_ids = [doc["checkpoint_id"] async for doc in superseded]
+    if checkpoint_ids:
+        selector = {"thread_id": thread_id, "checkpoint_ns": "", "checkpoint_id": {"$in": checkpoint_ids}}
+        await checkpointer.writes_collection.delete_many(selector)
+        await checkpointer.checkpoint_collection.delete_many(selector)
+
+async def prune_sqlite_checkpoints(checkpointer, thread_id):
+    superseded = """SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''
+                    ORDER BY checkpoint_id DESC LIMIT ? OFFSET 1"""
+    async with checkpointer.lock, checkpointer.conn.cursor() as cursor:
+        # Writes first, while the checkpoints they belong to can still be found
+        for table in ("writes", "checkpoints"):
+            await cursor.execute(
+                f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id IN ({superseded})",
+                (thread_id, thread_id, CHAT_CHECKPOINT_PRUNE_BATCH)
+            )
+        await checkpointer.conn.commit()
+
+# Drop a user's conversation thread once their session is gone for good
+async def forget_chat_thread(user_id):
+    delete_thread = getattr(chatbot.checkpointer, "adelete_thread", None)
+    if delete_thread is None:
+        return
+    try:
+        await delete_thread(user_id)
+    except NotImplementedError:
+        pass
+
+# Drop a user's thread when their session leaves this process's cache but lives on in
+# the shared session store. A thread held in this process's memory always goes, since
+# load_chat_thread re-seeds it from the session; one in a shared checkpointer only once
+# no worker has written to it for SESSION_IDLE_SECONDS.
+async def release_chat_thread(user_id):
+    if not isinstance(chatbot.checkpointer, BoundedMemorySaver):
+        snapshot = await chatbot.aget_state(chat_thread_config(user_id))
+        if not snapshot.created_at:
+            return
+        idle = datetime.now(timezone.utc) - datetime.fromisoformat(snapshot.created_at)
+        if idle.total_seconds() < SESSION_IDLE_SECONDS:
+            return
+    await forget_chat_thread(user_id)
 
 # Add these new models for user registration
 class UserRegistration(BaseModel):
@@ -1221,11 +2539,13 @@ class TokenData(BaseModel):
     email: Optional[str] = None
 
 # User authentication helper functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -1238,15 +2558,84 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 # User database functions
-def get_user_by_email(email: str):
-    user = users_collection.find_one({"email": email})
+async def get_user_by_email(email: str):
+    user = await find_user_by_email(email)
     return user
 
-def authenticate_user(email: str, password: str):
-    user = get_user_by_email(email)
+# Authenticated principals (profile fields only) cached by token subject
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+
+class PrincipalCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+    
+    def get(self, subject):
+        item = self.entries.get(subject)
+        if item is None:
+            return None
+        principal, expires_at = item
+        if expires_at < time.monotonic():
+            del self.entries[subject]
+            return None
+        self.entries.move_to_end(subject)
+        return principal
+    
+    def set(self, subject, principal):
+        self.entries[subject] = (principal, time.monotonic() + self.ttl)
+        self.entries.move_to_end(subject)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, subject):
+        self.entries.pop(subject, None)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+
+# Profile of the user a token was issued to, from the cache when possible
+async def get_principal(email: str):
+    principal = principal_cache.get(email)
+    if principal is not None:
+        perf_metrics.incr("auth.principal_cache.hits")
+        return principal
+    
+    perf_metrics.incr("auth.principal_cache.misses")
+    principal = await find_principal(email)
+    if principal is not None:
+        principal_cache.set(email, principal)
+    return principal
+
+# Call after any change to a user's profile fields so other requests stop seeing the old copy
+def invalidate_principal(email: str):
+    principal_cache.invalidate(email)
+
+@app.on_event("startup")
+async def create_indexes():
+    await repository.create_indexes()
+    if llm.shared_cache is not None:
+        await llm.shared_cache.create_indexes()
+
+@app.on_event("startup")
+async def start_transcript_writer():
+    if repository.TRANSCRIPT_DURABILITY == "async":
+        repository.transcript_writer.start()
+
+@app.on_event("shutdown")
+async def stop_transcript_writer():
+    # Write out whatever is still buffered before the process exits
+    await repository.transcript_writer.stop()
+
+@app.on_event("shutdown")
+async def stop_password_executor():
+    password_executor.shutdown(wait=False)
+
+async def authenticate_user(email: str, password: str):
+    user = await get_user_by_email(email)
     if not user:
         return False
-    if not verify_password(password, user["hashed_password"]):
+    if not await verify_password(password, user["hashed_password"]):
         return False
     return user
 
@@ -1264,7 +2653,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = get_user_by_email(email=token_data.email)
+    user = await get_principal(token_data.email)
     if user is None:
         raise credentials_exception
     return user
@@ -1272,31 +2661,32 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 # Add these new endpoints for user registration and login
 @app.post("/register", response_model=dict)
 async def register_user(user_data: UserRegistration):
-    # Check if user already exists
-    existing_user = users_collection.find_one({"email": user_data.email})
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
-        )
-    
     # Create new user document
     new_user = {
         "user_id": f"user-{uuid.uuid4().hex[:8]}",
         "name": user_data.name,
         "email": user_data.email,
-        "hashed_password": get_password_hash(user_data.password),
+        "hashed_password": await get_password_hash(user_data.password),
         "gender": user_data.gender,
         "age": user_data.age,
         "comorbidities": user_data.comorbidities,
         "medications": user_data.medications,
         "allergies": user_data.allergies,
-        "created_at": datetime.utcnow(),
-        "chat_history": []
+        "created_at": datetime.utcnow()
     }
     
     try:
-        users_collection.insert_one(new_user)
+        # The unique email index rejects duplicates, so there is no need to look first
+        try:
+            await insert_user(new_user)
+        except DuplicateKeyError as e:
+            if "email" in (e.details or {}).get("keyPattern", {"email": 1}):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Email already registered"
+                )
+            raise
+        invalidate_principal(new_user["email"])
         # Create access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
@@ -1318,7 +2708,7 @@ async def register_user(user_data: UserRegistration):
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1333,7 +2723,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @app.post("/login", response_model=dict)
 async def login_user(user_data: UserLogin):
-    user = authenticate_user(user_data.email, user_data.password)
+    user = await authenticate_user(user_data.email, user_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1366,280 +2756,212 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
         "allergies": current_user["allergies"]
     }
 
-# Modify the existing chat endpoint to work with registered users
-@app.post("/chat")
-async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme)):
+# Resolve the chat user's ID from the bearer token
+async def get_chat_user_id(token: str):
+    # Decode token to get user
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email = payload.get("sub")
+    user_db = await get_principal(email)
+    
+    if not user_db:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    
+    # Use the user's ID from the database
+    return user_db["user_id"]
+
+# Run a single conversation turn for an authenticated user; the session is read once
+# at the start and written back once at the end
+async def run_chat_turn(user_id: str, user_response: UserResponse):
+    turn = {"user_id": user_id, "user": await session_store.get(user_id), "journal": []}
+    token = chat_turn_session.set(turn)
     try:
-        # Decode token to get user
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        user_db = get_user_by_email(email)
+        return await process_chat_turn(user_id, user_response)
+    finally:
+        chat_turn_session.reset(token)
+        await commit_chat_turn(turn)
+
+# Conversation logic of a turn; get_user_data and update_user_data work on the turn's session
+async def process_chat_turn(user_id: str, user_response: UserResponse):
+    print(f"Received request: {user_response}")
+    
+    # ADDED: Special handling for "get_diagnosis" token to force diagnosis generation
+    if user_response.response in ["get_diagnosis", "provide diagnosis", "diagnose"]:
+        # Process through diagnosis_prep
+        next_state = await run_graph_turn(user_id, {
+            "response": "proceed to diagnosis",
+            "is_existing": True,
+            "current_step": "diagnosis_prep"
+        })
         
-        if not user_db:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
-            )
+        # Extract and return
+        next_question = next_state.get("current_question") or "Unable to generate diagnosis with current information"
         
-        # Use the user's ID from the database
-        user_id = user_db["user_id"]
-        
-        # Rest of your existing chat logic here, using user_id
-        print(f"Received request: {user_response}")
-        
-        # ADDED: Special handling for "get_diagnosis" token to force diagnosis generation
-        if user_response.response in ["get_diagnosis", "provide diagnosis", "diagnose"]:
-            # Create a state object for diagnosis
-            user = get_user_data(user_id)
-            state_dict = {
-                "user_id": user_id,
-                "response": "proceed to diagnosis",
-                "is_existing": True,
-                "symptoms": user.symptoms,
-                "previous_history": user.previous_history,
-                "medication_history": user.medication_history,
-                "additional_symptoms": user.additional_symptoms,
-                "diagnosis": user.diagnosis,
-                "critical": user.critical,
-                "current_step": "diagnosis_prep"
-            }
-            
-            # Ensure state has custom_context initialized
-            if "custom_context" not in state_dict:
-                state_dict["custom_context"] = {}
+        # Store the updated state
+        await set_conversation_cursor(user_id, next_question, "criticality", as_node="diagnosis_prep")
+        
+        # Store chat history in the user's transcript
+        await record_chat_turn(user_id, user_response.response, next_question)
+        
+        return {"next_question": next_question, "current_step": "criticality"}
+    
+    # Special handling for "continue" token to always proceed to next step
+    if user_response.response == "continue":
+        user = await find_user_data(user_id)
+        if user is not None:
+            _, seed = await load_chat_thread(user_id, user)
             
-            # Process through diagnosis_prep
-            next_state = diagnosis_prep_handler(state_dict)
+            # Force progress to the next step in the flow
+            next_state = await run_graph_turn(user_id, {**seed, "response": "continue", "is_existing": True})
             
-            # Extract and return
-            next_question = next_state.get("current_question", "Unable to generate diagnosis with current information")
+            # Extract question and step
+            next_question = next_state.get("current_question") or "What can I help you with?"
+            current_step = next_state.get("current_step") or "unknown"
             
-            # Store the updated state
-            update_user_data(user_id, "current_question", next_question)
-            update_user_data(user_id, "current_step", "criticality")
+            # Store the current question and step
+            await update_user_data(user_id, "current_question", next_question)
+            await update_user_data(user_id, "current_step", current_step)
             
-            # Store chat history in user document
-            users_collection.update_one(
-                {"user_id": user_id},
-                {"$push": {"chat_history": {
-                    "timestamp": datetime.utcnow(),
-                    "user_message": user_response.response,
-                    "bot_response": next_question
-                }}}
-            )
+            # Store chat history in the user's transcript
+            await record_chat_turn(user_id, user_response.response, next_question)
             
-            return {"next_question": next_question, "current_step": "criticality"}
-        
-        # Special handling for "continue" token to always proceed to next step
-        if user_response.response == "continue":
-            if user_id in user_data_store:
-                user = user_data_store[user_id]
-                current_step = next((item.get("current_step") for item in reversed(user.history) 
-                                   if "current_step" in item), "start")
-                
-                # Force progress to next step in the flow
-                state_dict = {
-                    "user_id": user_id,
-                    "response": "continue",
-                    "is_existing": True,
-                    "symptoms": user.symptoms,
-                    "previous_history": user.previous_history,
-                    "medication_history": user.medication_history,
-                    "additional_symptoms": user.additional_symptoms,
-                    "diagnosis": user.diagnosis,
-                    "critical": user.critical,
-                    "current_step": current_step
-                }
-                
-                # If we're at the additional_symptoms step, we need to move to diagnosis
-                if current_step == "additional_symptoms":
-                    next_step = determine_next_step(state_dict)
-                else:
-                    next_step = determine_next_step(state_dict)
-                
-                # Process the next step
-                next_state = process_step(next_step, state_dict)
-                
-                # Extract question and step
-                next_question = next_state.get("current_question", "What can I help you with?")
-                current_step = next_state.get("current_step", "unknown")
-                
-                # Store the current question and step
-                update_user_data(user_id, "current_question", next_question)
-                update_user_data(user_id, "current_step", current_step)
-                
-                # Store chat history in user document
-                users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$push": {"chat_history": {
-                        "timestamp": datetime.utcnow(),
-                        "user_message": user_response.response,
-                        "bot_response": next_question
-                    }}}
-                )
-                
-                return {"next_question": next_question, "current_step": current_step}
+            return {"next_question": next_question, "current_step": current_step}
+    
+    # Check if this is a first-time interaction with this user
+    user = await find_user_data(user_id)
+    is_first_interaction = user is None
+    next_state = None
+    
+    # MAJOR FIX: Create the user record FIRST and process their input
+    if is_first_interaction:
+        # Initialize new user in data store
+        await create_user_data(user_id)
+        
+        # Store their initial response as a symptom/issue
+        await update_user_data(user_id, "symptoms", user_response.response)
+        
+        # Start the thread over with the actual user response, going directly to assessment
+        turn_input = {
+            "response": user_response.response,
+            "is_existing": False,
+            "current_step": "initial_assessment",
+            "current_question": None,
+            "urgency_level": "normal",
+            "custom_context": {}
+        }
+    else:
+        # Existing user was loaded above; the thread remembers where the conversation is
+        thread_state, seed = await load_chat_thread(user_id, user)
+        current_step = user.current_step or "start"
+        turn_input = {**seed, "response": user_response.response, "is_existing": True}
         
-        # Check if this is a first-time interaction with this user
-        is_first_interaction = user_id not in user_data_store
+        # Skip validation for special tokens
+        skip_validation = user_response.response in ["continue", "continue_anyway"]
         
-        # MAJOR FIX: Create the user record FIRST and process their input
-        if is_first_interaction:
-            # Initialize new user in data store
-            user_data_store[user_id] = UserData(user_id=user_id)
-            
-            # Store their initial response as a symptom/issue
-            update_user_data(user_id, "symptoms", user_response.response)
+        if not skip_validation:
+            # Get the previous question to validate against
+            previous_question = user.current_question or "How can I help you?"
             
-            # Create state dictionary with the actual user response
-            state_dict = {
-                "user_id": user_id,
-                "response": user_response.response,  # <-- CRITICAL FIX: Use their actual response
-                "is_existing": False,
-                "symptoms": [user_response.response],
-                "previous_history": None,
-                "medication_history": None,
-                "additional_symptoms": None,
-                "diagnosis": None,
-                "critical": False,
-                "current_step": "initial_assessment"  # Go directly to assessment
+            # Determine the expected response type based on current step
+            expected_type_map = {
+                "start": "symptoms",
+                "symptoms": "symptoms",
+                "previous_history": "previous_history",
+                "medication_history": "medication_history",
+                "additional_symptoms": "additional_symptoms",
+                "diagnosis_prep": "general",
+                "diagnosis": "general",
+                "criticality": "general",
+                "end": "general"
             }
-        else:
-            # Get existing user
-            user = user_data_store[user_id]
+            expected_type = expected_type_map.get(current_step, "general")
             
-            # Extract current step to determine next action
-            current_step = next((item.get("current_step") for item in reversed(user.history) 
-                               if "current_step" in item), "start")
+            # Optionally start generating the next node while the answer is being validated
+            speculation = start_speculative_step({**thread_state, **turn_input, "user_id": user_id, "custom_path": None}, user)
             
-            # Create a state dict based on where we are in the conversation
-            state_dict = {
-                "user_id": user_id,
-                "response": user_response.response,
-                "is_existing": True,
-                "symptoms": user.symptoms,
-                "previous_history": user.previous_history,
-                "medication_history": user.medication_history,
-                "additional_symptoms": user.additional_symptoms,
-                "diagnosis": user.diagnosis,
-                "critical": user.critical,
-                "current_step": current_step
-            }
+            # When processing validation results, check for partial answers 
+            validation = await validate_response(previous_question, user_response.response, expected_type)
             
-            # Skip validation for special tokens
-            skip_validation = user_response.response in ["continue", "continue_anyway"]
+            # Store validation details for future use
+            validation_details = validation.get("details", {})
             
-            if not skip_validation:
-                # Get the previous question to validate against
-                previous_question = next((item.get("current_question") for item in reversed(user.history) 
-                                         if "current_question" in item), "How can I help you?")
-                
-                # Determine the expected response type based on current step
-                expected_type_map = {
-                    "start": "symptoms",
-                    "symptoms": "symptoms",
-                    "previous_history": "previous_history",
-                    "medication_history": "medication_history",
-                    "additional_symptoms": "additional_symptoms",
-                    "diagnosis_prep": "general",
-                    "diagnosis": "general",
-                    "criticality": "general",
-                    "end": "general"
-                }
-                expected_type = expected_type_map.get(current_step, "general")
-                
-                # When processing validation results, check for partial answers 
-                validation = await validate_response(previous_question, user_response.response, expected_type)
-                
-                # Store validation details for future use
-                validation_details = validation.get("details", {})
+            # If the response is invalid but it's a partial answer to a multi-part question
+            if not validation["is_valid"]:
+                await discard_speculative_step(speculation, "rejected")
                 
-                # If the response is invalid but it's a partial answer to a multi-part question
-                if not validation["is_valid"]:
-                    if validation_details.get("partial_answer", False):
-                        # Store the partial answer but stay on the same step
-                        update_user_data(user_id, "partial_" + current_step, user_response.response, validation_details)
-                        
-                        next_question = validation["feedback"]
-                        
-                        # Store chat history in user document
-                        users_collection.update_one(
-                            {"user_id": user_id},
-                            {"$push": {"chat_history": {
-                                "timestamp": datetime.utcnow(),
-                                "user_message": user_response.response,
-                                "bot_response": next_question
-                            }}}
-                        )
-                        
-                        return {
-                            "next_question": next_question,
-                            "current_step": current_step  # Stay on the same step
-                        }
-                    else:
-                        # Regular invalid response
-                        next_question = validation["feedback"]
-                        
-                        # Store chat history in user document
-                        users_collection.update_one(
-                            {"user_id": user_id},
-                            {"$push": {"chat_history": {
-                                "timestamp": datetime.utcnow(),
-                                "user_message": user_response.response,
-                                "bot_response": next_question
-                            }}}
-                        )
-                        
-                        return {
-                            "next_question": next_question,
-                            "current_step": current_step  # Stay on the same step
-                        }
-                
-                # Update the response with processed version
-                state_dict["response"] = validation["processed_response"]
-                
-                # Store validation details
-                update_user_data(user_id, "validation", "valid", validation_details)
-            elif user_response.response == "continue_anyway":
-                # For continue_anyway, use the previous user response but skip validation
-                last_user_response = next((item.get("response") for item in reversed(user.history) 
-                                          if "response" in item), "")
-                state_dict["response"] = last_user_response
-        
-        print(f"Processing state: {state_dict}")
-        
-        # Update the current step based on the conversation flow
-        next_step = determine_next_step(state_dict)
-        
-        # Process just the specific node for this step
-        next_state = process_step(next_step, state_dict)
-        
-        # Extract question and step from state
-        if not isinstance(next_state, dict):
-            raise HTTPException(status_code=500, detail=f"Expected dict, got {type(next_state)}")
+                if validation_details.get("partial_answer", False):
+                    # Store the partial answer but stay on the same step
+                    await update_user_data(user_id, "partial_" + current_step, user_response.response, validation_details)
+                    
+                    next_question = validation["feedback"]
+                    
+                    # Store chat history in the user's transcript
+                    await record_chat_turn(user_id, user_response.response, next_question)
+                    
+                    return {
+                        "next_question": next_question,
+                        "current_step": current_step  # Stay on the same step
+                    }
+                else:
+                    # Regular invalid response
+                    next_question = validation["feedback"]
+                    
+                    # Store chat history in the user's transcript
+                    await record_chat_turn(user_id, user_response.response, next_question)
+                    
+                    return {
+                        "next_question": next_question,
+                        "current_step": current_step  # Stay on the same step
+                    }
             
-        next_question = next_state.get("current_question", "What can I help you with?")
-        current_step = next_state.get("current_step", "unknown")
-        
-        # Store the current question for future validation
-        update_user_data(user_id, "current_question", next_question)
-        
-        # Store the current step in history for next time
-        update_user_data(user_id, "current_step", current_step)
-        
-        print(f"Returning question: {next_question}, step: {current_step}")
-        
-        # Store chat history in user document
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$push": {"chat_history": {
-                "timestamp": datetime.utcnow(),
-                "user_message": user_response.response,
-                "bot_response": next_question
-            }}}
-        )
-        
-        return {"next_question": next_question, "current_step": current_step}
+            # Update the response with processed version
+            turn_input["response"] = validation["processed_response"]
+            
+            # Store validation details
+            await update_user_data(user_id, "validation", "valid", validation_details)
+            
+            # Keep the speculative result only if it was computed from the same answer
+            if speculation and turn_input["response"] == user_response.response:
+                next_state = await commit_speculative_step(user_id, speculation)
+            elif speculation:
+                await discard_speculative_step(speculation, "rewritten")
+        elif user_response.response == "continue_anyway":
+            # For continue_anyway, use the previous user response but skip validation
+            turn_input["response"] = user.last_response or ""
+    
+    print(f"Processing turn: {turn_input}")
+    
+    if next_state is None:
+        # Route to and run just the node for the current step
+        next_state = await run_graph_turn(user_id, turn_input)
+    
+    next_question = next_state.get("current_question") or "What can I help you with?"
+    current_step = next_state.get("current_step") or "unknown"
+    
+    # Store the current question for future validation
+    await update_user_data(user_id, "current_question", next_question)
+    
+    # Store the current step in history for next time
+    await update_user_data(user_id, "current_step", current_step)
+    
+    print(f"Returning question: {next_question}, step: {current_step}")
+    
+    # Store chat history in the user's transcript
+    await record_chat_turn(user_id, user_response.response, next_question)
+    
+    return {"next_question": next_question, "current_step": current_step}
+
+# Modify the existing chat endpoint to work with registered users
+@app.post("/chat")
+async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme)):
+    try:
+        user_id = await get_chat_user_id(token)
+        started = time.perf_counter()
+        result = await run_chat_turn(user_id, user_response)
+        perf_metrics.observe("chat.turn_seconds", time.perf_counter() - started)
+        return result
     
     except JWTError:
         raise HTTPException(
@@ -1655,6 +2977,60 @@ async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme))
             detail=f"An error occurred: {str(e)}"
         )
 
+# Format a server-sent event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming variant of /chat: emits LLM tokens as they arrive, then the formatted reply
+@app.post("/chat/stream")
+async def chat_stream(user_response: UserResponse, token: str = Depends(oauth2_scheme)):
+    try:
+        user_id = await get_chat_user_id(token)
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials"
+        )
+    
+    token_queue = asyncio.Queue()
+    
+    async def run_turn_with_sink():
+        stream_token_sink.set(token_queue)
+        try:
+            return await run_chat_turn(user_id, user_response)
+        finally:
+            await token_queue.put(None)
+    
+    async def event_generator():
+        turn = asyncio.create_task(run_turn_with_sink())
+        try:
+            while True:
+                text = await token_queue.get()
+                if text is None:
+                    break
+                yield sse_event("token", {"text": text})
+            
+            result = await turn
+            # The card-wrapped HTML replaces the raw streamed text on the client
+            yield sse_event("done", {
+                "next_question": result.get("next_question"),
+                "current_step": result.get("current_step")
+            })
+        except Exception as e:
+            print(f"Error in chat stream: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event("error", {"detail": f"An error occurred: {str(e)}"})
+        finally:
+            if not turn.done():
+                turn.cancel()
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Helper function to determine the next step based on the current step
 def determine_next_step(state):
     current_step = state.get("current_step", "start")
@@ -1693,70 +3069,83 @@ def determine_next_step(state):
     
     return step_flow.get(current_step, "initial_assessment")
 
-# Process a specific step in the conversation
-def process_step(step_name, state):
-    state_dict = ensure_dict(state)
+# Run the node for a step directly, outside the graph (used for speculative execution)
+async def process_step(step_name, state):
+    return await CHAT_NODES[node_for_step(step_name)](ensure_dict(state))
+
+# Nodes that read the validation details stored for the current answer, so they cannot run ahead of validation
+VALIDATION_DEPENDENT_NODES = {"med_history_node", "additional_symptoms_node"}
+
+# Run a node against a private copy of the user's data, journaling its writes
+async def run_speculative_step(step_name, state_dict, user):
+    session = {"user": user.copy(deep=True), "journal": []}
+    speculative_session.set(session)
+    next_state = await process_step(step_name, state_dict)
+    return next_state, session["journal"], node_for_step(step_name)
+
+# Start speculative execution of the next node, if enabled and safe for this step
+def start_speculative_step(state_dict, user):
+    if not SPECULATIVE_EXECUTION or stream_token_sink.get() is not None:
+        return None
     
-    if "custom_context" not in state_dict:
-        state_dict["custom_context"] = {}
+    next_step = determine_next_step(state_dict)
+    if next_step in VALIDATION_DEPENDENT_NODES:
+        perf_metrics.incr("speculation.skipped")
+        return None
     
-    if step_name.endswith("_continued") and "_continued_continued" in step_name:
-        print(f"Detected nested continuations in {step_name}, forcing diagnosis")
-        state_dict["current_question"] = "I believe I have sufficient information now. Let me provide a preliminary diagnosis based on what you've shared."
-        state_dict["current_step"] = "diagnosis_prep"
-        return diagnosis_prep_handler(state_dict)
-    
-    if step_name == "initial_assessment" and state_dict.get("response", "").lower() and "accident" in state_dict.get("response", "").lower():
-        return assess_initial_urgency(state_dict)
-    
-    if step_name == "diagnosis_prep":
-        return diagnosis_prep_handler(state_dict)
-    elif step_name == "additional_symptoms_node":
-        return additional_symptoms_handler(state_dict)
-    
-    handlers = {
-        "start": start_node,
-        "initial_assessment": assess_initial_urgency,
-        "collect_symptoms": collect_symptoms_handler,
-        "prev_history_node": previous_history_handler,
-        "med_history_node": medication_history_handler,
-        "additional_symptoms_node": additional_symptoms_handler,
-        "diagnosis_prep": diagnosis_prep_handler,
-        "diagnosis_node": generate_diagnosis,
-        "criticality_node": assess_criticality,
-        "dynamic_symptoms": dynamic_follow_up_handler,
-        "injury_assessment": dynamic_follow_up_handler,
-        "infection_assessment": dynamic_follow_up_handler,
-        "digestive_assessment": dynamic_follow_up_handler,
-        "respiratory_assessment": dynamic_follow_up_handler,
-        "chronic_condition": dynamic_follow_up_handler,
-        "urgent_follow_up": urgent_follow_up_handler,
-        "emergency_services": urgent_follow_up_handler
-    }
+    return asyncio.create_task(run_speculative_step(next_step, copy.deepcopy(state_dict), user))
+
+# Apply a finished speculative node to the real user data and the conversation thread,
+# or return None to run it normally
+async def commit_speculative_step(user_id, speculation):
+    try:
+        next_state, journal, node_name = await speculation
+    except Exception as e:
+        print(f"Speculative step failed, running it again: {str(e)}")
+        perf_metrics.incr("speculation.misses.error")
+        return None
     
-    handler = handlers.get(step_name)
+    for key, value, validation_details in journal:
+        await update_user_data(user_id, key, value, validation_details)
+    await chatbot.aupdate_state(chat_thread_config(user_id), next_state, as_node=node_name)
+    await compact_chat_thread(user_id)
     
-    if handler:
-        return handler(state_dict)
-    else:
-        print(f"Warning: Unknown step requested: {step_name}")
-        return start_node(state_dict)
+    perf_metrics.incr("speculation.hits")
+    return next_state
+
+# Throw away a speculative node whose answer did not validate as-is
+async def discard_speculative_step(speculation, reason):
+    if not speculation:
+        return
+    
+    speculation.cancel()
+    try:
+        await speculation
+    except (asyncio.CancelledError, Exception):
+        pass
+    
+    perf_metrics.incr(f"speculation.misses.{reason}")
 
 # Helper function to update user state
-def update_user_state(user_id, state):
-    if user_id not in user_data_store:
-        user_data_store[user_id] = UserData(user_id=user_id)
+async def update_user_state(user_id, state):
+    if not await session_store.contains(user_id):
+        await create_user_data(user_id)
     
     pass
 
 @app.get("/user/{user_id}")
-def get_user(user_id: str):
-    user_data = get_user_data(user_id)
-    return user_data
+async def get_user(user_id: str):
+    user_data = await get_user_data(user_id)
+    return user_data.export()
 
 @app.get("/debug/users")
-def debug_users():
-    return {"user_count": len(user_data_store), "users": {k: v.dict() for k, v in user_data_store.items()}}
+async def debug_users():
+    sessions = await session_store.items()
+    return {"user_count": len(sessions), "users": {k: v.export() for k, v in sessions}}
+
+@app.get("/debug/metrics")
+def debug_metrics():
+    return perf_metrics.snapshot()
 
 @app.post("/generate_summary")
 async def generate_summary_endpoint(user_data_request: dict):
@@ -1765,42 +3154,14 @@ async def generate_summary_endpoint(user_data_request: dict):
         if not user_id:
             raise HTTPException(status_code=400, detail="User ID is required")
             
-        user_data = get_user_data(user_id)
+        user_data = await get_user_data(user_id)
         
         if not user_data or not user_data.symptoms:
             return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
         
-        symptoms_text = ", ".join(user_data.symptoms)
-        
-        history_with_validation = [item for item in user_data.history if "validation_details" in item]
-        extracted_details = {}
-        
-        for entry in history_with_validation:
-            validation = entry.get("validation_details", {})
-            if "extracted_symptoms" in validation:
-                extracted_details["symptoms"] = validation["extracted_symptoms"]
-            if "extracted_diagnosis" in validation:
-                extracted_details["diagnosis"] = validation["extracted_diagnosis"]
-            if "medications" in validation:
-                extracted_details["medications"] = validation["medications"]
-            if "side_effects" in validation:
-                extracted_details["side_effects"] = validation["side_effects"]
-        
-        summary_prompt = f"""Generate a concise, professional medical case summary for a doctor based on the following patient information:
-        
-        Presenting Symptoms: {symptoms_text}
-        Medical History: {user_data.previous_history}
-        Medication History: {user_data.medication_history}
-        Additional Symptoms: {user_data.additional_symptoms}
-        Preliminary Diagnosis: {user_data.diagnosis}
-        Urgency Assessment: {"Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended"}
+        summary_prompt = build_summary_prompt(user_data)
         
-        Additional Extracted Details: {extracted_details}
-        
-        Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
-        """
-        
-        summary = llm.invoke(summary_prompt)
+        summary = await llm.ainvoke(summary_prompt, family="summary")
         return {"summary": f"## Medical Case Summary\n\n{summary.content}"}
         
     except Exception as e:
@@ -1809,6 +3170,194 @@ async def generate_summary_endpoint(user_data_request: dict):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# Lexicons for the local answer classifier
+SYMPTOM_TERMS = [
+    "fever", "high temperature", "chills", "sweating", "headache", "migraine", "dizziness", "dizzy",
+    "cough", "coughing", "sore throat", "runny nose", "stuffy nose", "congestion", "sneezing",
+    "shortness of breath", "difficulty breathing", "wheezing", "chest pain", "chest tightness",
+    "palpitations", "nausea", "vomiting", "diarrhea", "diarrhoea", "constipation", "bloating",
+    "stomach ache", "stomach pain", "abdominal pain", "cramps", "heartburn", "loss of appetite",
+    "fatigue", "tiredness", "weakness", "body ache", "body aches", "muscle pain", "joint pain",
+    "back pain", "neck pain", "ear pain", "toothache", "rash", "itching", "itchy", "hives",
+    "swelling", "bleeding", "bruising", "burning", "numbness", "tingling", "blurred vision",
+    "insomnia", "anxiety", "fainting", "pain", "ache", "aches", "sore"
+]
+MEDICATION_TERMS = [
+    "paracetamol", "acetaminophen", "tylenol", "crocin", "dolo", "calpol", "ibuprofen", "advil",
+    "motrin", "brufen", "aspirin", "naproxen", "diclofenac", "amoxicillin", "augmentin",
+    "azithromycin", "ciprofloxacin", "doxycycline", "antibiotic", "antibiotics", "cetirizine",
+    "loratadine", "fexofenadine", "antihistamine", "antihistamines", "omeprazole", "pantoprazole",
+    "ranitidine", "antacid", "antacids", "loperamide", "ors", "metformin", "insulin", "amlodipine",
+    "lisinopril", "losartan", "atorvastatin", "levothyroxine", "salbutamol", "albuterol",
+    "inhaler", "prednisone", "prednisolone", "cough syrup", "lozenges", "nasal spray",
+    "decongestant", "painkiller", "painkillers"
+]
+SIDE_EFFECT_TERMS = [
+    "drowsiness", "drowsy", "sleepy", "nausea", "vomiting", "dizziness", "dizzy", "rash",
+    "itching", "upset stomach", "stomach upset", "diarrhea", "constipation", "dry mouth",
+    "headache", "palpitations", "swelling"
+]
+SIDE_EFFECT_CUES = ["side effect", "side-effect", "made me", "caused", "gave me", "after taking", "reaction"]
+# Words that mention a symptom or a medication, whether or not the lexicons know the phrase they are part of
+SYMPTOM_MENTIONS = [
+    r"fever\w*", r"temperature", r"chill\w*", r"sweat\w*", r"head\w*", r"migraine\w*", r"dizz\w*", r"faint\w*",
+    r"cough\w*", r"throat", r"nose", r"congest\w*", r"sneez\w*", r"breath\w*", r"wheez\w*", r"chest", r"tight\w*",
+    r"palpitation\w*", r"heart\w*", r"nause\w*", r"vomit\w*", r"diarrh\w*", r"constipat\w*", r"bloat\w*",
+    r"stomach\w*", r"abdom\w*", r"belly", r"cramp\w*", r"appetite", r"fatigue\w*", r"tired\w*", r"exhaust\w*",
+    r"weak\w*", r"ach(?:e|es|ing|y)", r"pain\w*", r"hurt\w*", r"sore\w*", r"muscle\w*", r"joints?", r"back", r"neck",
+    r"ears?", r"tooth\w*", r"rash\w*", r"itch\w*", r"hives", r"swell\w*", r"swollen", r"bleed\w*", r"bruis\w*",
+    r"burn\w*", r"numb\w*", r"tingl\w*", r"vision", r"blur\w*", r"sleep\w*", r"insomnia", r"anxi\w*", r"drows\w*",
+    r"mouth", r"ring\w*"
+]
+MEDICATION_MENTIONS = [
+    r"pills?", r"tablets?", r"capsules?", r"syrups?", r"drops", r"creams?", r"ointments?", r"sprays?", r"medicines?",
+    r"medications?", r"meds", r"tea", r"supplements?", r"vitamins?", r"injections?", r"\d+\s?mg"
+]
+# Symptom terms too vague to account for a mention on their own ("sore" in "my throat is sore")
+VAGUE_SYMPTOM_TERMS = {"pain", "ache", "aches", "sore"}
+NEGATION_CUES = {"no", "not", "without", "never", "none", "haven't", "hasn't", "didn't", "don't", "doesn't", "nor"}
+NEGATIVE_ANSWER_PREFIXES = [
+    "no", "nope", "none", "nothing", "not really", "not at all", "that's all", "thats all",
+    "i haven't", "i have not", "i didn't", "i did not", "i don't", "i do not", "i'm not", "i am not"
+]
+
+# Build a word-boundary regex that matches the longest phrase first
+def compile_lexicon(terms):
+    ordered = sorted(set(terms), key=len, reverse=True)
+    return re.compile(r"\b(" + "|".join(re.escape(term) for term in ordered) + r")\b")
+
+SYMPTOM_PATTERN = compile_lexicon(SYMPTOM_TERMS)
+MEDICATION_PATTERN = compile_lexicon(MEDICATION_TERMS)
+SIDE_EFFECT_PATTERN = compile_lexicon(SIDE_EFFECT_TERMS)
+SYMPTOM_MENTION_PATTERN = re.compile(r"\b(?:" + "|".join(SYMPTOM_MENTIONS) + r")\b")
+MEDICATION_MENTION_PATTERN = re.compile(r"\b(?:" + "|".join(MEDICATION_MENTIONS) + r")\b")
+CLAUSE_BREAK_PATTERN = re.compile(r"[,.;:!?]|\bbut\b|\bhowever\b|\bexcept\b")
+
+# Check whether a match is negated within its own clause ("no fever", "haven't had a cough")
+def is_negated(text, start):
+    clause = CLAUSE_BREAK_PATTERN.split(text[:start])[-1]
+    return bool(NEGATION_CUES.intersection(clause.split()[-3:]))
+
+# Extract lexicon matches that are not negated, keeping first-seen order
+def extract_terms(pattern, text):
+    found = []
+    for match in pattern.finditer(text):
+        term = match.group(1)
+        if term not in found and not is_negated(text, match.start()):
+            found.append(term)
+    return found
+
+# Where the extracted terms were matched in the text
+def term_spans(pattern, text, terms):
+    return [match.span() for match in pattern.finditer(text) if match.group(1) in terms]
+
+# Share of the answer's mentions (other than negated ones) that fall inside one of the
+# spans, i.e. how much of what the patient said the extraction accounts for
+def mention_coverage(mention_pattern, text, spans):
+    mentions = [match.start() for match in mention_pattern.finditer(text) if not is_negated(text, match.start())]
+    if not mentions:
+        return 1.0
+    covered = sum(1 for start in mentions if any(begin <= start < end for begin, end in spans))
+    return round(covered / len(mentions), 2)
+
+# Coverage of the answer's symptom mentions by the extracted symptoms
+def symptom_coverage(text, symptoms):
+    specific = [term for term in symptoms if term not in VAGUE_SYMPTOM_TERMS]
+    return mention_coverage(SYMPTOM_MENTION_PATTERN, text, term_spans(SYMPTOM_PATTERN, text, specific))
+
+# Check whether the whole answer is a plain "no"
+def is_negative_answer(text):
+    stripped = text.strip(" .!")
+    if "not sure" in stripped:
+        # "I'm not sure, maybe ..." is a hedge, not a no
+        return False
+    return any(stripped == prefix or stripped.startswith(prefix + " ") or stripped.startswith(prefix + ",")
+               for prefix in NEGATIVE_ANSWER_PREFIXES)
+
+# Detail fields filled in by the local classifier, and how they are compared with the LLM's
+FAST_VALIDATION_FIELDS = ("extracted_symptoms", "medications", "side_effects", "has_additional_symptoms")
+
+def normalize_detail(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        # Order, case and plurals ("headaches" vs "headache") don't count as disagreement
+        return sorted({str(item).strip().lower().rstrip("s") for item in value if str(item).strip()})
+    return value
+
+# Field -> whether the two details dicts agree, for each field the local classifier filled in
+def compare_validation_details(fast_details, other_details):
+    return {
+        field: normalize_detail(fast_details[field]) == normalize_detail(other_details.get(field))
+        for field in FAST_VALIDATION_FIELDS
+        if field in fast_details
+    }
+
+# Classify obvious answers locally; returns None when the LLM should decide. The
+# confidence is how much of the answer the extraction covers (see mention_coverage).
+def fast_validate_response(response, expected_type):
+    text = response.lower()
+    details = None
+    
+    if expected_type == "symptoms":
+        symptoms = extract_terms(SYMPTOM_PATTERN, text)
+        if symptoms:
+            details = {
+                "reason": "Response describes symptoms",
+                "extracted_symptoms": symptoms,
+                "confidence": symptom_coverage(text, symptoms)
+            }
+    elif expected_type == "medication_history":
+        medications = extract_terms(MEDICATION_PATTERN, text)
+        medication_spans = term_spans(MEDICATION_PATTERN, text, medications)
+        confidence = mention_coverage(MEDICATION_MENTION_PATTERN, text, medication_spans)
+        side_effects = []
+        if any(cue in text for cue in SIDE_EFFECT_CUES):
+            side_effects = [term for term in extract_terms(SIDE_EFFECT_PATTERN, text) if term not in medications]
+            # Whatever the answer says a medication caused should be among the side effects found
+            spans = medication_spans + term_spans(SIDE_EFFECT_PATTERN, text, side_effects)
+            confidence = min(confidence, mention_coverage(SYMPTOM_MENTION_PATTERN, text, spans))
+        if medications:
+            details = {
+                "reason": "Response names medications",
+                "medications": medications,
+                "side_effects": side_effects,
+                "confidence": confidence
+            }
+        elif is_negative_answer(text) and not MEDICATION_PATTERN.search(text):
+            details = {
+                "reason": "Patient has not taken any medications",
+                "medications": [],
+                "side_effects": [],
+                "confidence": confidence
+            }
+    elif expected_type == "additional_symptoms":
+        symptoms = extract_terms(SYMPTOM_PATTERN, text)
+        if symptoms:
+            details = {
+                "reason": "Response describes additional symptoms",
+                "has_additional_symptoms": True,
+                "additional_symptoms": symptoms,
+                "extracted_symptoms": symptoms,
+                "confidence": symptom_coverage(text, symptoms)
+            }
+        elif is_negative_answer(text):
+            # "No, but my knee is swollen" still mentions a symptom
+            details = {
+                "reason": "Patient has no additional symptoms",
+                "has_additional_symptoms": False,
+                "additional_symptoms": [],
+                "extracted_symptoms": [],
+                "confidence": symptom_coverage(text, [])
+            }
+    
+    if not details or details["confidence"] < FAST_VALIDATION_MIN_CONFIDENCE:
+        return None
+    
+    details["is_valid"] = True
+    details["source"] = "fast_path"
+    return {"is_valid": True, "feedback": None, "processed_response": response, "details": details}
+
 async def validate_response(question, response, expected_type):
     if response == "continue":
         return {"is_valid": True, "feedback": None, "processed_response": response}
@@ -1825,11 +3374,10 @@ async def validate_response(question, response, expected_type):
             }
         }
     
-    if expected_type == "symptoms" and any(condition in response.lower() for condition in ["diabetes", "diabetic", "hypertension", "asthma", "chronic"]):
-        conditions = []
-        for condition in ["diabetes", "diabetic", "hypertension", "asthma", "copd", "arthritis", "thyroid"]:
-            if condition in response.lower():
-                conditions.append(condition)
+    keyword_hits = triage_matcher.scan(response)
+    
+    if expected_type == "symptoms" and "condition_disclosure" in keyword_hits:
+        conditions = keyword_hits.get("chronic_condition", [])
         
         condition_str = ", ".join(conditions)
         
@@ -1854,7 +3402,7 @@ async def validate_response(question, response, expected_type):
                 "processed_response": response,
                 "details": {"is_valid": False, "reason": "Greeting instead of symptoms"}
             }
-        elif expected_type == "symptoms" and not any(word in response.lower() for word in ["diabetes", "pain", "ache", "hurt", "sick"]):
+        elif expected_type == "symptoms" and "brief_symptom" not in keyword_hits:
             return {
                 "is_valid": False,
                 "feedback": "I notice your response is quite brief. Could you please provide more details about your current health concerns or symptoms? This will help me assist you better.",
@@ -1878,7 +3426,7 @@ async def validate_response(question, response, expected_type):
         else:
             return {"is_valid": True, "feedback": None, "processed_response": response}
     
-    multi_part_check = validate_multi_part_response(question, response, expected_type)
+    multi_part_check = validate_multi_part_response(question, response, expected_type, keyword_hits)
     
     if not multi_part_check["is_complete"]:
         return {
@@ -1892,6 +3440,25 @@ async def validate_response(question, response, expected_type):
             }
         }
     
+    fast_result = fast_validate_response(response, expected_type)
+    if fast_result is None:
+        perf_metrics.incr("validation.llm")
+        return await llm_validate_response(question, response, expected_type)
+    
+    perf_metrics.incr("validation.fast_path")
+    if FAST_VALIDATION_SHADOW:
+        # Measure how often the local classifier agrees with the LLM, on validity and on each extracted field
+        llm_result = await llm_validate_response(question, response, expected_type)
+        agrees = llm_result["is_valid"] == fast_result["is_valid"]
+        perf_metrics.incr("validation.shadow.agree" if agrees else "validation.shadow.disagree")
+        if "details" in llm_result:
+            for field, same in compare_validation_details(fast_result["details"], llm_result["details"]).items():
+                perf_metrics.incr(f"validation.shadow.{field}.{'agree' if same else 'disagree'}")
+    
+    return fast_result
+
+# Ask the LLM whether a response answers the question, and extract its details
+async def llm_validate_response(question, response, expected_type):
     validation_prompts = {
         "previous_history": f"""
             As a medical assistant, evaluate if the following response addresses medical history or doctor consultations.
@@ -1986,22 +3553,10 @@ async def validate_response(question, response, expected_type):
     prompt = validation_prompts.get(expected_type, validation_prompts["general"])
     
     try:
-        validation_result = llm.invoke(prompt)
-        
-        import json
-        import re
-        
-        json_pattern = r'\{.*\}'
-        json_match = re.search(json_pattern, validation_result.content, re.DOTALL)
-        
-        if json_match:
-            validation_json = json.loads(json_match.group())
-        else:
-            validation_json = {
-                "is_valid": True,
-                "reason": "Could not determine validity",
-                "processed_response": response
-            }
+        validation_result = await structured_llm(prompt, ResponseValidation, family="validation")
+        if validation_result is None:
+            validation_result = ResponseValidation(is_valid=True, reason="Could not determine validity", processed_response=response)
+        validation_json = validation_result.dict()
         
         feedback = None
         if not validation_json.get("is_valid", True):
@@ -2018,17 +3573,18 @@ async def validate_response(question, response, expected_type):
         print(f"Validation error: {str(e)}")
         return {"is_valid": True, "feedback": None, "processed_response": response}
 
-def validate_multi_part_response(question, response, expected_type):
+# keyword_hits: triage_matcher.scan(response), already computed by validate_response
+def validate_multi_part_response(question, response, expected_type, keyword_hits):
     multi_part_patterns = {
         "previous_history": {
             "parts": ["Have you consulted a doctor", "what was their diagnosis"],
-            "triggers": ["yes", "i have", "i did", "consulted"],
-            "required_follow_up": ["diagnosis", "said", "told me", "found"],
+            "triggers": "history_confirmation",
+            "required_follow_up": "history_detail",
         },
         "medication_history": {
             "parts": ["Have you taken any medications", "what medications", "side effects"],
-            "triggers": ["yes", "i have", "i did", "taking", "took"],
-            "required_follow_up": ["medication", "drug", "pill", "medicine", "paracetamol", "ibuprofen"],
+            "triggers": "medication_confirmation",
+            "required_follow_up": "medication_detail",
         },
     }
     
@@ -2036,12 +3592,10 @@ def validate_multi_part_response(question, response, expected_type):
         return {"is_complete": True}
     
     pattern = multi_part_patterns[expected_type]
-    lower_response = response.lower()
-    
-    has_trigger = any(trigger in lower_response for trigger in pattern["triggers"])
+    has_trigger = pattern["triggers"] in keyword_hits
     
     if has_trigger:
-        has_follow_up = any(follow_up in lower_response for follow_up in pattern["required_follow_up"])
+        has_follow_up = pattern["required_follow_up"] in keyword_hits
         
         if not has_follow_up:
             missing_part = pattern["parts"][1] if pattern["parts"][0] in question.lower() else pattern["parts"][0]
@@ -2059,25 +3613,12 @@ async def force_diagnosis(user_data_request: dict):
         if not user_id:
             raise HTTPException(status_code=400, detail="User ID is required")
             
-        user_data = get_user_data(user_id)
+        user_data = await get_user_data(user_id)
         if not user_data:
             raise HTTPException(status_code=404, detail="User not found")
         
-        has_asthma = False
-        lost_inhaler = False
-        breathing_issues = False
-        
-        for item in user_data.history:
-            for key, value in item.items():
-                if isinstance(value, str):
-                    if "asthma" in value.lower():
-                        has_asthma = True
-                    if "lost" in value.lower() and "inhaler" in value.lower():
-                        lost_inhaler = True
-                    if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
-                        breathing_issues = True
-        
-        if has_asthma and (lost_inhaler or breathing_issues):
+        profile = user_data.profile
+        if profile.has_asthma and (profile.lost_inhaler or profile.breathing_issues):
             urgent_html = f"""<div class="urgent-message">
 <div class="urgent-header">⚠️ URGENT ASTHMA EMERGENCY ⚠️</div>
 <div class="urgent-content">
@@ -2089,33 +3630,22 @@ async def force_diagnosis(user_data_request: dict):
 <div class="urgent-footer">Without an inhaler, an asthma attack can be life-threatening. Seek emergency help immediately.</div>
 </div>"""
             
-            update_user_data(user_id, "current_question", urgent_html)
-            update_user_data(user_id, "current_step", "emergency_services")
+            await set_conversation_cursor(user_id, urgent_html, "emergency_services", as_node="emergency_services")
             
             return {
                 "next_question": urgent_html,
                 "current_step": "emergency_services"
             }
         
-        state_dict = {
-            "user_id": user_id,
+        next_state = await run_graph_turn(user_id, {
             "response": "proceed to diagnosis",
             "is_existing": True,
-            "symptoms": user_data.symptoms,
-            "previous_history": user_data.previous_history,
-            "medication_history": user_data.medication_history,
-            "additional_symptoms": user_data.additional_symptoms,
-            "diagnosis": user_data.diagnosis,
-            "critical": user_data.critical,
             "current_step": "diagnosis_prep"
-        }
-        
-        next_state = diagnosis_prep_handler(state_dict)
+        })
         
-        diagnosis = next_state.get("current_question", "Unable to generate diagnosis with current information")
+        diagnosis = next_state.get("current_question") or "Unable to generate diagnosis with current information"
         
-        update_user_data(user_id, "current_question", diagnosis)
-        update_user_data(user_id, "current_step", "criticality")
+        await set_conversation_cursor(user_id, diagnosis, "criticality", as_node="diagnosis_prep")
         
         return {
             "next_question": diagnosis,
@@ -2145,62 +3675,11 @@ async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(o
         )
     
     try:
-        # Get the user's document from MongoDB
-        user_doc = users_collection.find_one({"user_id": entry_data.user_id})
-        
-        if not user_doc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
-            
-        # Initialize chat_history if it doesn't exist
-        if "chat_history" not in user_doc:
-            user_doc["chat_history"] = []
-        
-        # Check if this is a summary entry
-        is_summary = entry_data.history_entry.get("type") == "summary"
-        
-        if is_summary:
-            # For summaries, check if we already have a summary from the same consultation
-            # (within 5 minutes of this entry)
-            entry_time = datetime.fromisoformat(entry_data.history_entry.get("timestamp")) if "timestamp" in entry_data.history_entry else datetime.fromtimestamp(entry_data.history_entry.get("id") / 1000)
-            
-            # Look for existing summaries in the last 5 minutes
-            existing_summaries = []
-            for i, history_item in enumerate(user_doc["chat_history"]):
-                if history_item.get("type") == "summary":
-                    item_time = datetime.fromisoformat(history_item.get("timestamp")) if "timestamp" in history_item else datetime.fromtimestamp(history_item.get("id") / 1000)
-                    time_diff = abs((entry_time - item_time).total_seconds())
-                    
-                    # If within 5 minutes, consider it from the same consultation
-                    if time_diff < 300:  # 5 minutes in seconds
-                        existing_summaries.append((i, history_item))
-            
-            if existing_summaries:
-                # If we have existing summaries from this consultation
-                # If this is a Doctor Summary, replace any existing summary
-                if entry_data.history_entry.get("title") == "Doctor Summary":
-                    for idx, _ in existing_summaries:
-                        user_doc["chat_history"].pop(idx)
-                    user_doc["chat_history"].append(entry_data.history_entry)
-                # Otherwise, only add if we don't already have a Doctor Summary
-                else:
-                    has_doctor_summary = any(s[1].get("title") == "Doctor Summary" for s in existing_summaries)
-                    if not has_doctor_summary:
-                        user_doc["chat_history"].append(entry_data.history_entry)
-            else:
-                # No existing summaries found, add this one
-                user_doc["chat_history"].append(entry_data.history_entry)
+        # Summaries go to their own collection, one per consultation, where a Doctor Summary takes precedence
+        if entry_data.history_entry.get("type") == "summary":
+            await upsert_summary(entry_data.user_id, entry_data.history_entry)
         else:
-            # Add the new history entry (not a summary)
-            user_doc["chat_history"].append(entry_data.history_entry)
-        
-        # Update the user document
-        users_collection.update_one(
-            {"user_id": entry_data.user_id},
-            {"$set": {"chat_history": user_doc["chat_history"]}}
-        )
+            await append_chat_message(entry_data.user_id, entry_data.history_entry)
         
         return {"status": "success", "message": "Chat history saved successfully"}
         
@@ -2222,23 +3701,8 @@ async def view_summary(user_id: str, summary_id: str, token: str = Depends(oauth
         )
     
     try:
-        # Get the user's document from MongoDB
-        user_doc = users_collection.find_one({"user_id": user_id})
-        
-        if not user_doc or "chat_history" not in user_doc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User or chat history not found"
-            )
-        
-        # Find the summary in the chat history
-        summary = None
-        for entry in user_doc["chat_history"]:
-            # Check by id (could be string or int)
-            entry_id = str(entry.get("id"))
-            if entry_id == summary_id:
-                summary = entry
-                break
+        # Indexed lookup on (user_id, summary_id)
+        summary = await find_summary(user_id, summary_id)
         
         if not summary:
             raise HTTPException(
@@ -2256,7 +3720,9 @@ async def view_summary(user_id: str, summary_id: str, token: str = Depends(oauth
 
 # Add endpoint to get chat history
 @app.get("/chat_history/{user_id}")
-async def get_chat_history(user_id: str, token: str = Depends(oauth2_scheme)):
+async def get_chat_history(user_id: str, limit: Optional[int] = None, before: Optional[datetime] = None,
+                           after: Optional[datetime] = None, fields: Optional[str] = None,
+                           summary_only: bool = False, token: str = Depends(oauth2_scheme)):
     # Validate the user through token
     current_user = await get_current_user(token)
     if current_user["user_id"] != user_id:
@@ -2265,20 +3731,33 @@ async def get_chat_history(user_id: str, token: str = Depends(oauth2_scheme)):
             detail="Not authorized to access history for this user"
         )
     
+    if limit is not None and limit < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit must be a positive integer"
+        )
+    
+    # Cursors are entry timestamps; compare them as naive UTC like the stored ts values
+    if before and before.tzinfo:
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    if after and after.tzinfo:
+        after = after.astimezone(timezone.utc).replace(tzinfo=None)
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    
     try:
-        # Get the user's document from MongoDB
-        user_doc = users_collection.find_one({"user_id": user_id})
-        
-        if not user_doc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
-            
         # Return chat history or empty list if none exists
-        chat_history = user_doc.get("chat_history", [])
+        chat_history, has_more = await page_chat_messages(
+            user_id, limit=limit, before=before, after=after,
+            fields=field_list, summary_only=summary_only
+        )
         
-        return {"chat_history": chat_history}
+        return {
+            "chat_history": chat_history,
+            "has_more": has_more,
+            # Pass these back as `before`/`after` to fetch the neighbouring pages
+            "before": chat_history[0]["ts"].isoformat() if chat_history else None,
+            "after": chat_history[-1]["ts"].isoformat() if chat_history else None
+        }
         
     except Exception as e:
         raise HTTPException(
@@ -0,0 +1,130 @@
+"""Move the legacy users.chat_history arrays into the bucketed chat_messages collection.
+
+Usage:
+    python migrate_chat_history.py [--dry-run]
+
+Each user's transcript entries are grouped into day-long buckets of at most
+CHAT_BUCKET_SIZE messages and summaries are saved with repository.upsert_summary,
+so they get the same consultation ids and Doctor Summary precedence as summaries
+saved by the API. Only then is the chat_history array removed from the user
+document. Summaries that were saved into chat_messages buckets before the
+summaries collection existed are moved over as well.
+
+The script can be re-run after an interruption: buckets get deterministic ids
+and are skipped if already inserted, and saving a summary again leaves its
+consultation as it was.
+"""
+import argparse
+import asyncio
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+import repository
+from repository import CHAT_BUCKET_SIZE, bucket_window, entry_timestamp, upsert_summary
+
+
+def timestamped(entries, created_at):
+    last_ts = created_at
+    for entry in entries:
+        # Keep the original order even if some entries lack a usable timestamp
+        ts = max(entry_timestamp(entry, last_ts), last_ts)
+        last_ts = ts
+        yield entry, ts
+
+
+def summary_entries(entries, created_at):
+    return [(entry, ts) for entry, ts in timestamped(entries, created_at) if entry.get("type") == "summary"]
+
+
+def build_buckets(user_id, entries, created_at):
+    buckets = []
+    current = None
+    for entry, ts in timestamped(entries, created_at):
+        if entry.get("type") == "summary":
+            continue
+        window = bucket_window(ts)
+        if current is None or current["window"] != window or current["count"] >= CHAT_BUCKET_SIZE:
+            # Numbered per day, so a re-run produces the same ids
+            number = sum(1 for bucket in buckets if bucket["window"] == window)
+            current = {
+                "_id": f"{user_id}:{window:%Y-%m-%d}:{number}",
+                "user_id": user_id, "window": window, "ts": ts, "last_ts": ts, "count": 0, "messages": []
+            }
+            buckets.append(current)
+        current["messages"].append({**entry, "ts": ts})
+        current["count"] += 1
+        current["last_ts"] = ts
+    return buckets
+
+
+# Insert buckets, skipping those a previous (interrupted) run already inserted
+async def insert_buckets(buckets):
+    try:
+        await repository.chat_messages_collection.insert_many(buckets, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+
+# In their original order, so later summaries meet the earlier ones they may replace
+async def save_summaries(user_id, summaries):
+    for entry, ts in summaries:
+        await upsert_summary(user_id, entry, ts)
+
+
+async def move_bucketed_summaries(dry_run):
+    moved = 0
+    buckets = repository.chat_messages_collection.find({"messages.type": "summary"}, {"user_id": 1, "messages": 1})
+    async for bucket in buckets:
+        entries = [message for message in bucket["messages"] if message.get("type") == "summary"]
+        moved += len(entries)
+        if not dry_run:
+            await save_summaries(bucket["user_id"], summary_entries(entries, datetime(1970, 1, 1)))
+            await repository.chat_messages_collection.update_one(
+                {"_id": bucket["_id"]},
+                {"$pull": {"messages": {"type": "summary"}}, "$inc": {"count": -len(entries)}}
+            )
+    return moved
+
+
+async def migrate(dry_run=False):
+    if not dry_run:
+        # The unique consultation index is what lets a Doctor Summary take precedence
+        await repository.create_indexes()
+    migrated_users = 0
+    migrated_messages = 0
+
+    users = repository.users_collection.find(
+        {"chat_history.0": {"$exists": True}}, {"user_id": 1, "chat_history": 1, "created_at": 1}
+    )
+    async for user in users:
+        created_at = user.get("created_at") or datetime(1970, 1, 1)
+        buckets = build_buckets(user["user_id"], user["chat_history"], created_at)
+        summaries = summary_entries(user["chat_history"], created_at)
+        print(f"{user['user_id']}: {len(user['chat_history'])} entries -> {len(buckets)} buckets, {len(summaries)} summaries")
+
+        if not dry_run:
+            if buckets:
+                await insert_buckets(buckets)
+            await save_summaries(user["user_id"], summaries)
+            await repository.users_collection.update_one({"_id": user["_id"]}, {"$unset": {"chat_history": ""}})
+
+        migrated_users += 1
+        migrated_messages += len(user["chat_history"])
+
+    if not dry_run:
+        # Empty arrays have nothing to move but still don't belong on the profile
+        await repository.users_collection.update_many({"chat_history": {"$size": 0}}, {"$unset": {"chat_history": ""}})
+
+    print(f"{'Would migrate' if dry_run else 'Migrated'} {migrated_messages} entries for {migrated_users} users")
+
+    moved = await move_bucketed_summaries(dry_run)
+    print(f"{'Would move' if dry_run else 'Moved'} {moved} summaries out of chat_messages buckets")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report what would be moved without writing")
+    args = parser.parse_args()
+    asyncio.run(migrate(dry_run=args.dry_run))
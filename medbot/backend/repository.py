@@ -0,0 +1,369 @@
+"""Async MongoDB data layer for the MedBot backend.
+
+All database access from request handlers goes through Motor so that no query
+blocks the event loop. Connection pool size and timeouts can be tuned with the
+MONGO_* environment variables below.
+"""
+import asyncio
+import heapq
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+load_dotenv()
+
+MONGODB_URI = os.getenv("MONGODB_URI")
+
+# Pool sized for one worker process; requests wait at most MONGO_WAIT_QUEUE_TIMEOUT_MS
+# for a free connection instead of queueing without bound when the pool is exhausted
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "5")),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_MS", "300000")),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "20000")),
+    "retryWrites": True,
+}
+
+# Chat transcripts are stored in per-user buckets of at most CHAT_BUCKET_SIZE messages per day
+CHAT_BUCKET_SIZE = int(os.getenv("CHAT_BUCKET_SIZE", "100"))
+
+# Summaries saved without an explicit consultation_id belong to the consultation of the
+# window of this many seconds their timestamp falls in
+CONSULTATION_WINDOW_SECONDS = int(os.getenv("CONSULTATION_WINDOW_SECONDS", "300"))
+
+# "async" buffers per-turn transcript writes and flushes them in batches every
+# TRANSCRIPT_FLUSH_MS or TRANSCRIPT_BATCH_SIZE entries; "sync" writes before the reply
+TRANSCRIPT_DURABILITY = os.getenv("TRANSCRIPT_DURABILITY", "async")
+TRANSCRIPT_FLUSH_MS = int(os.getenv("TRANSCRIPT_FLUSH_MS", "200"))
+TRANSCRIPT_BATCH_SIZE = int(os.getenv("TRANSCRIPT_BATCH_SIZE", "100"))
+
+SUMMARY_INTERNAL_FIELDS = ("user_id", "consultation_id", "summary_id", "is_doctor_summary")
+
+
+def make_client(uri: Optional[str]):
+    return AsyncIOMotorClient(uri, **MONGO_CLIENT_OPTIONS)
+
+
+client = make_client(MONGODB_URI)
+db = client.medbot_db
+users_collection = db.users
+chat_messages_collection = db.chat_messages
+summaries_collection = db.summaries
+
+
+# Schema bootstrap run at startup; create_index is a no-op when the index already exists
+async def create_indexes():
+    await users_collection.create_index("email", unique=True)
+    await users_collection.create_index("user_id", unique=True)
+    await chat_messages_collection.create_index([("user_id", ASCENDING), ("ts", ASCENDING)])
+    await chat_messages_collection.create_index([("user_id", ASCENDING), ("window", ASCENDING)])
+    # One summary per consultation; an earlier version kept several under a non-unique index
+    consultation_index = (await summaries_collection.index_information()).get("user_id_1_consultation_id_1")
+    if not (consultation_index and consultation_index.get("unique")):
+        await keep_one_summary_per_consultation()
+        if consultation_index:
+            await summaries_collection.drop_index("user_id_1_consultation_id_1")
+    await summaries_collection.create_index([("user_id", ASCENDING), ("consultation_id", ASCENDING)], unique=True)
+    await summaries_collection.create_index([("user_id", ASCENDING), ("ts", ASCENDING)])
+    await summaries_collection.create_index([("user_id", ASCENDING), ("summary_id", ASCENDING)])
+
+
+# Delete all but the summary upsert_summary would have kept of each consultation:
+# its latest Doctor Summary, or else its latest summary
+async def keep_one_summary_per_consultation():
+    groups = summaries_collection.aggregate([
+        {"$sort": {"is_doctor_summary": DESCENDING, "ts": DESCENDING}},
+        {"$group": {"_id": {"user_id": "$user_id", "consultation_id": "$consultation_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ])
+    async for group in groups:
+        await summaries_collection.delete_many({"_id": {"$in": group["ids"][1:]}})
+
+
+# Users
+
+async def find_user_by_email(email: str):
+    return await users_collection.find_one({"email": email})
+
+
+# Fields of a user document that identify an authenticated principal (no password hash)
+PRINCIPAL_FIELDS = ("user_id", "name", "email", "gender", "age", "comorbidities", "medications", "allergies")
+
+
+async def find_principal(email: str):
+    return await users_collection.find_one({"email": email}, {"_id": 0, **{field: 1 for field in PRINCIPAL_FIELDS}})
+
+
+# Raises DuplicateKeyError if the email (or, very rarely, the generated user_id) is taken
+async def insert_user(user: dict):
+    await users_collection.insert_one(user)
+
+
+# Chat transcripts
+
+# Start of the day-long window a chat message is bucketed into
+def bucket_window(ts: datetime):
+    return datetime(ts.year, ts.month, ts.day)
+
+
+# Best-effort timestamp of a chat history entry (datetime, ISO string, or millisecond id)
+def entry_timestamp(entry: dict, default: Optional[datetime] = None):
+    value = entry.get("timestamp")
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+        except ValueError:
+            pass
+    if isinstance(entry.get("id"), (int, float)):
+        return datetime.utcfromtimestamp(entry["id"] / 1000)
+    return default or datetime.utcnow()
+
+
+# Filter and update that append an entry to the user's transcript,
+# opening a new bucket when the current one is full (used with upsert=True)
+def chat_message_upsert(user_id: str, entry: dict, ts: datetime):
+    return (
+        {"user_id": user_id, "window": bucket_window(ts), "count": {"$lt": CHAT_BUCKET_SIZE}},
+        {
+            "$push": {"messages": {**entry, "ts": ts}},
+            "$inc": {"count": 1},
+            "$max": {"last_ts": ts},
+            "$setOnInsert": {"ts": ts}
+        }
+    )
+
+
+async def append_chat_message(user_id: str, entry: dict, ts: Optional[datetime] = None):
+    await chat_messages_collection.update_one(*chat_message_upsert(user_id, entry, ts or datetime.utcnow()), upsert=True)
+
+
+# Write-behind buffer for transcript appends. Pending upserts are sent with one ordered
+# bulk_write per batch, so entries still land in their buckets in arrival order.
+class TranscriptWriter:
+    def __init__(self, collection, flush_seconds: float, batch_size: int):
+        self.collection = collection
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.pending = []
+        self.task = None
+        self.wakeup = None
+        self.lock = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def enqueue(self, user_id: str, entry: dict, ts: datetime):
+        self.pending.append(UpdateOne(*chat_message_upsert(user_id, entry, ts), upsert=True))
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                # Unsent entries stay pending and are retried on the next tick
+                print(f"Transcript flush failed: {str(e)}")
+            except Exception as e:
+                # Not a database error, so the next tick would most likely fail the same way.
+                # Stop buffering: record_chat_turn writes synchronously from now on, and
+                # stop() makes a last attempt at the entries still pending.
+                print(f"Transcript writer stopped after unexpected error: {e!r}")
+                self.task = None
+                return
+
+    async def flush(self):
+        if not self.pending:
+            return
+        async with (self.lock or asyncio.Lock()):
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                try:
+                    await self.collection.bulk_write(batch, ordered=True)
+                except BulkWriteError as e:
+                    # Everything before the failed operation was applied; drop those and the
+                    # failing one (a write error, not a network error, would fail again)
+                    failed_index = e.details["writeErrors"][0]["index"]
+                    print(f"Dropping transcript entry after write error: {e.details['writeErrors'][0].get('errmsg')}")
+                    del self.pending[:failed_index + 1]
+                    continue
+                del self.pending[:len(batch)]
+
+
+transcript_writer = TranscriptWriter(chat_messages_collection, TRANSCRIPT_FLUSH_MS / 1000, TRANSCRIPT_BATCH_SIZE)
+
+
+# Store one /chat exchange in the user's transcript, through the write-behind buffer
+# when TRANSCRIPT_DURABILITY is "async" and the writer is running
+async def record_chat_turn(user_id: str, user_message: str, bot_response: str):
+    ts = datetime.utcnow()
+    entry = {"timestamp": ts, "user_message": user_message, "bot_response": bot_response}
+    if TRANSCRIPT_DURABILITY == "async" and transcript_writer.running:
+        transcript_writer.enqueue(user_id, entry, ts)
+    else:
+        await append_chat_message(user_id, entry, ts)
+
+
+# Newest-first (or, with an `after` cursor, oldest-first) transcript entries from the buckets
+async def iter_transcript(user_id: str, before: Optional[datetime], after: Optional[datetime], fields: Optional[List[str]]):
+    query = {"user_id": user_id}
+    if before:
+        query["ts"] = {"$lt": before}
+    if after:
+        query["last_ts"] = {"$gt": after}
+
+    if fields:
+        projection = {f"messages.{field}": 1 for field in fields}
+        projection["messages.ts"] = 1
+    else:
+        projection = {"messages": 1}
+    projection["_id"] = 0
+
+    newest_first = after is None
+    async for bucket in chat_messages_collection.find(query, projection).sort("ts", DESCENDING if newest_first else ASCENDING):
+        messages = bucket.get("messages", [])
+        for message in (reversed(messages) if newest_first else messages):
+            ts = message.get("ts")
+            if (before and ts >= before) or (after and ts <= after):
+                continue
+            yield message
+
+
+# Summaries in the same order as iter_transcript, shaped like the entries that were saved
+async def iter_summaries(user_id: str, before: Optional[datetime], after: Optional[datetime], fields: Optional[List[str]]):
+    query = {"user_id": user_id}
+    if before or after:
+        query["ts"] = {}
+        if before:
+            query["ts"]["$lt"] = before
+        if after:
+            query["ts"]["$gt"] = after
+
+    if fields:
+        projection = {field: 1 for field in fields if field not in SUMMARY_INTERNAL_FIELDS}
+        projection["ts"] = 1
+    else:
+        projection = {field: 0 for field in SUMMARY_INTERNAL_FIELDS}
+    projection["_id"] = 0
+
+    async for summary in summaries_collection.find(query, projection).sort("ts", DESCENDING if after is None else ASCENDING):
+        yield summary
+
+
+# Up to `limit` entries from an async source (all of them without a limit)
+async def take(entries, limit: Optional[int]):
+    taken = []
+    try:
+        async for entry in entries:
+            if limit is not None and len(taken) >= limit:
+                break
+            taken.append(entry)
+    finally:
+        await entries.aclose()
+    return taken
+
+
+# One page of a user's history, oldest first, plus whether more entries lie beyond it.
+# Without an `after` cursor the page is the newest `limit` entries before `before`;
+# with one it is the oldest `limit` entries after it. summary_only lists just the
+# summaries, leaving out the transcript turns and their bot_response bodies.
+async def page_chat_messages(user_id: str, limit: Optional[int] = None, before: Optional[datetime] = None,
+                             after: Optional[datetime] = None, fields: Optional[List[str]] = None,
+                             summary_only: bool = False):
+    # Reads see every turn already answered, even those still waiting in the buffer
+    await transcript_writer.flush()
+
+    # One extra entry per source tells us whether there is a next page
+    fetch = limit + 1 if limit is not None else None
+    sources = [await take(iter_summaries(user_id, before, after, fields), fetch)]
+    if not summary_only:
+        sources.append(await take(iter_transcript(user_id, before, after, fields), fetch))
+
+    newest_first = after is None
+    entries = list(heapq.merge(*sources, key=lambda entry: entry["ts"], reverse=newest_first))
+    page = entries[:limit] if limit is not None else entries
+    has_more = limit is not None and len(entries) > limit
+
+    if newest_first:
+        page.reverse()
+    return page, has_more
+
+
+# Summaries
+
+# Consultation a summary belongs to: its explicit consultation_id, or else the
+# CONSULTATION_WINDOW_SECONDS window its timestamp falls in, so every save of the
+# same consultation derives the same id without reading the collection
+def consultation_id_for(entry: dict, ts: datetime):
+    if entry.get("consultation_id"):
+        return str(entry["consultation_id"])
+    ts_ms = int(ts.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    window_ms = CONSULTATION_WINDOW_SECONDS * 1000
+    return str(ts_ms - ts_ms % window_ms)
+
+
+# Stored summaries a new one may replace: a Doctor Summary replaces anything but a
+# later Doctor Summary, any other summary only an earlier one that is not a Doctor Summary
+def replaceable_summary(is_doctor_summary: bool, ts: datetime):
+    if is_doctor_summary:
+        return {"$or": [{"is_doctor_summary": False}, {"ts": {"$lte": ts}}]}
+    return {"is_doctor_summary": False, "ts": {"$lte": ts}}
+
+
+# Store a summary as the one summary of its consultation, unless the stored one takes
+# precedence. The precedence is part of the upsert filter, so when it does the upsert
+# tries to insert a second summary for the consultation and the unique index rejects
+# it. Returns whether the summary was stored.
+async def upsert_summary(user_id: str, entry: dict, ts: Optional[datetime] = None):
+    ts = ts or entry_timestamp(entry)
+    is_doctor_summary = entry.get("title") == "Doctor Summary"
+    key = {"user_id": user_id, "consultation_id": consultation_id_for(entry, ts)}
+    document = {**entry, **key, "summary_id": str(entry.get("id")), "ts": ts, "is_doctor_summary": is_doctor_summary}
+    selector = {**key, **replaceable_summary(is_doctor_summary, ts)}
+    try:
+        await summaries_collection.replace_one(selector, document, upsert=True)
+        return True
+    except DuplicateKeyError:
+        # The stored summary takes precedence, or a concurrent save inserted the first one;
+        # without upsert the replace only goes through in the second case
+        result = await summaries_collection.replace_one(selector, document)
+        return result.matched_count > 0
+
+
+# Indexed lookup on (user_id, summary_id); ids are stored as strings
+async def find_summary(user_id: str, summary_id: str):
+    return await summaries_collection.find_one(
+        {"user_id": user_id, "summary_id": summary_id},
+        {field: 0 for field in ("_id",) + SUMMARY_INTERNAL_FIELDS}
+    )
@@ -110,6 +110,8 @@ const ChatPage = () => {
   const [showSummaryButton, setShowSummaryButton] = useState(false);
   const [messageCount, setMessageCount] = useState(0);
   const messagesEndRef = useRef(null);
+  // Identifies the current consultation, so the backend keeps one summary per consultation
+  const consultationIdRef = useRef(`consultation-${Date.now()}`);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -458,6 +460,7 @@ const ChatPage = () => {
     setConversationComplete(false);
     setShowSummaryButton(false);
     setMessageCount(0); // Reset message counter
+    consultationIdRef.current = `consultation-${Date.now()}`;
     
     // Create a fresh user ID to completely isolate this conversation
     // This is a more aggressive approach but ensures a clean slate
@@ -576,6 +579,7 @@ const ChatPage = () => {
       id: Date.now(),
       title: title,
       type: "summary", // Mark as a special entry type
+      consultation_id: consultationIdRef.current,
       messages: [
         { role: 'assistant', content: content }
       ],
@@ -1092,7 +1096,7 @@ const ChatPage = () => {
   // Update the fetchChatHistory function to filter duplicates
   const fetchChatHistory = async (userId) => {
     try {
-      const response = await fetchWithAuth(`https://medbot-bknd.onrender.com/chat_history/${userId}`);
+      const response = await fetchWithAuth(`https://medbot-bknd.onrender.com/chat_history/${userId}?summary_only=true`);
       
       if (response.ok) {
         const data = await response.json();